@@ -1,9 +1,12 @@
 '''
 Module used for the server initialization and configuration.
 '''
+from threading import Lock
 import flask
-from app.data_ingestor import DataIngestor
 from app.task_runner import ThreadPool
+from app.datasets import create_registry
+from app.reloader import create_reloader
+from app.retention import create_compactor
 from app.conf_log import conf_logging
 
 webserver = flask.Flask(__name__)
@@ -11,11 +14,22 @@ webserver.tasks_runner = ThreadPool()
 
 webserver.tasks_runner.start()
 
-webserver.data_ingestor = DataIngestor("./nutrition_activity_obesity_usa_subset.csv")
+webserver.datasets = create_registry(webserver.tasks_runner,
+                                     "./nutrition_activity_obesity_usa_subset.csv")
+webserver.datasets.get()
 webserver.job_counter = 1
+webserver.batch_counter = 1
+webserver.counter_lock = Lock()
+webserver.batches = {}
 
 conf_logging(webserver)
 
+webserver.reloader = create_reloader(webserver)
+webserver.reloader.start()
+
+webserver.compactor = create_compactor(webserver.tasks_runner, webserver.batches)
+webserver.compactor.start()
+
 webserver.tasks_runner.join()
 
 from app import routes
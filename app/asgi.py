@@ -0,0 +1,290 @@
+'''
+Module with an asyncio version of the webserver, written as a plain ASGI
+application, so it can be served by any ASGI server without depending on
+one, for example:
+
+    uvicorn app.asgi:application --port 5000
+
+It exposes the same routes as 'routes.py' and shares their logic from
+'handlers.py', as well as the state of the Flask server (the threadpool,
+the datasets and the counters), so the jobs are still computed by
+the TaskRunner threads. The difference is in the waiting: a long-poll
+request does not keep a thread blocked until the result is saved, but
+awaits a future that is resolved, from the thread that saved the result,
+through a callback registered in the result store. This way, an idle
+connection costs a coroutine and a future, not a thread. The requests that
+read a CSV file, to load a dataset or to reload it, are handled in the
+default executor of the event loop, so they do not stall the other
+connections.
+'''
+import json
+import asyncio
+from urllib.parse import parse_qs
+from app import webserver
+from app.handlers import (parse_id, wait_timeout, client_key, submit_query, submit_batch,
+                          job_result, batch_result, jobs_status, num_jobs_status,
+                          profile_status, profile_configure, reload_dataset,
+                          retention_status, result_status, unknown_batch)
+from app.task_runner import COMMANDS
+from app.datasets import DEFAULT_DATASET
+from app.scheduler import QueueFull
+from app import metrics
+from app.responses import EncodedResult, encoded_response
+
+async def wait_result(server, job_id, timeout):
+    '''
+    Function used to wait, for at most 'timeout' seconds, until the result
+    of the given job is saved in the result store. The future is resolved
+    on the event loop through 'call_soon_threadsafe', because the callback
+    is called from the TaskRunner thread that saved the result.
+    '''
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve():
+        if not future.done():
+            future.set_result(True)
+
+    def callback():
+        loop.call_soon_threadsafe(resolve)
+
+    results = server.tasks_runner.results
+    results.subscribe(job_id, callback)
+    try:
+        await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        results.unsubscribe(job_id, callback)
+
+async def get_response(server, job_id, args):
+    '''
+    Asyncio version of the '/api/get_results/<job_id>' route.
+    '''
+    try:
+        jid = parse_id(job_id)
+    except ValueError:
+        jid = server.job_counter
+    if jid >= server.job_counter:
+        return {'status': 'error', 'reason': 'Invalid job_id'}
+
+    try:
+        timeout = wait_timeout(args)
+    except ValueError:
+        return {'status': 'error', 'reason': 'Invalid timeout'}
+
+    if timeout > 0 and result_status(server, jid) == 'running':
+        await wait_result(server, jid, timeout)
+    return job_result(server, jid)
+
+async def get_batch_response(server, batch_id, args):
+    '''
+    Asyncio version of the '/api/get_batch_results/<batch_id>' route.
+    '''
+    try:
+        bid = parse_id(batch_id)
+    except ValueError:
+        bid = None
+    job_ids = server.batches.get(bid)
+    if job_ids is None:
+        return unknown_batch(server, bid)
+
+    try:
+        timeout = wait_timeout(args)
+    except ValueError:
+        return {'status': 'error', 'reason': 'Invalid timeout'}
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    for jid in job_ids:
+        remaining = deadline - loop.time()
+        status = result_status(server, jid)
+        if remaining <= 0 or status not in ('done', 'running'):
+            break
+        if status == 'running':
+            await wait_result(server, jid, remaining)
+    return batch_result(server, job_ids)
+
+def loading_needed(server, data):
+    '''
+    Function used to check if a query, or a batch of queries, asks for a
+    registered dataset that is not loaded, which 'select_dataset' would
+    load from its CSV file.
+    '''
+    if not isinstance(data, dict):
+        return False
+    default = data.get("dataset", DEFAULT_DATASET)
+    names = {default}
+    if isinstance(data.get("queries"), list):
+        names.update(query.get("dataset", default) for query in data["queries"]
+                     if isinstance(query, dict))
+    return any(isinstance(name, str) and name in server.datasets
+               and not server.datasets.is_loaded(name) for name in names)
+
+async def run_blocking(blocking, function, *args):
+    '''
+    Function used to call a handler in the default executor of the event
+    loop if it blocks, and directly otherwise, to avoid the cost of the
+    executor for the usual requests.
+    '''
+    if not blocking:
+        return function(*args)
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+async def post_route(server, route, body, client):
+    '''
+    Function used to call the handler of a 'POST' route. It returns the
+    HTTP status and the dictionary sent back to the client. The queries
+    for a dataset that must be loaded and the reloads run in the executor.
+    '''
+    try:
+        data = json.loads(body or b'null')
+    except ValueError:
+        return 400, {'status': 'error', 'reason': 'Invalid JSON'}
+
+    if route in COMMANDS:
+        if not isinstance(data, dict) or 'question' not in data:
+            return 400, {'status': 'error', 'reason': 'Invalid query'}
+        return 200, await run_blocking(loading_needed(server, data),
+                                       submit_query, server, data, route, client)
+
+    if route == 'batch':
+        return 200, await run_blocking(loading_needed(server, data),
+                                       submit_batch, server, data, client)
+    if route == 'reload':
+        return 200, await run_blocking(True, reload_dataset, server, data)
+
+    handlers = {
+        'post_endpoint': lambda: {"message": "Received data successfully", "data": data},
+        'profile': lambda: profile_configure(server, data),
+    }
+    if route in handlers:
+        return 200, handlers[route]()
+    return 404, {'status': 'error', 'reason': 'Not found'}
+
+def get_route(server, route, args):
+    '''
+    Function used to call the handler of a 'GET' route without a parameter.
+    It returns the HTTP status and the dictionary sent back to the client.
+    '''
+    handlers = {
+        'num_jobs': num_jobs_status,
+        'query_cache': lambda server: server.tasks_runner.query_cache.stats(),
+        'scheduler': lambda server: server.tasks_runner.jobs_queue.stats(),
+        'metrics': metrics.render,
+        'datasets': lambda server: server.datasets.stats(),
+        'retention': retention_status,
+    }
+    if route == 'graceful_shutdown':
+        server.tasks_runner.stop()
+        server.reloader.stop()
+        server.compactor.stop()
+        return 200, {"status": "ok"}
+    if route == 'profile':
+        return 200, profile_status(server, args)
+    if route == 'jobs':
+        return 200, jobs_status(server, args)
+    if route in handlers:
+        return 200, handlers[route](server)
+    return 404, {'status': 'error', 'reason': 'Not found'}
+
+async def dispatch(server, request, args, body):
+    '''
+    Function used to call the handler of the requested route, from the
+    (method, path, client) tuple of the request. It returns the HTTP status
+    and the dictionary sent back to the client.
+    '''
+    method, path, client = request
+    parts = path.strip('/').split('/')
+    if len(parts) < 2 or parts[0] != 'api':
+        return 404, {'status': 'error', 'reason': 'Not found'}
+
+    if method == 'POST' and len(parts) == 2:
+        return await post_route(server, parts[1], body, client)
+    if method == 'GET' and len(parts) == 2:
+        return get_route(server, parts[1], args)
+    if method == 'GET' and len(parts) == 3 and parts[1] == 'get_results':
+        return 200, await get_response(server, parts[2], args)
+    if method == 'GET' and len(parts) == 3 and parts[1] == 'get_batch_results':
+        return 200, await get_batch_response(server, parts[2], args)
+    return 404, {'status': 'error', 'reason': 'Not found'}
+
+async def read_body(receive):
+    '''
+    Function used to read the whole body of a request, which the ASGI
+    server may send in several messages.
+    '''
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+async def lifespan(receive, send):
+    '''
+    Function used to answer the startup and shutdown messages of the ASGI
+    server. On shutdown, the threadpool is stopped, as by
+    '/api/graceful_shutdown'.
+    '''
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            webserver.tasks_runner.stop()
+            webserver.reloader.stop()
+            webserver.compactor.stop()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    '''
+    The ASGI application. The query parameters are parsed in a dictionary
+    with the first value of each parameter, as the Flask 'request.args',
+    the client is identified as by the Flask routes and the responses are
+    JSON documents, except for the metrics. The results of the jobs are
+    sent as they were serialized, compressed as in 'routes.py'. A job that
+    is not admitted by the scheduler gets the 429 status and the
+    'Retry-After' header, as in 'routes.py'.
+    '''
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    body = await read_body(receive)
+    args = {key: values[0] for (key, values)
+            in parse_qs(scope.get('query_string', b'').decode('latin-1')).items()}
+
+    headers = {key.decode('latin-1').title(): value.decode('latin-1')
+               for (key, value) in scope.get('headers', [])}
+    client = client_key(headers, (scope.get('client') or (None,))[0])
+
+    extra_headers = []
+    try:
+        status, response = await dispatch(webserver, (scope['method'], scope['path'], client),
+                                          args, body)
+    except QueueFull as error:
+        status = 429
+        response = {'status': 'error', 'reason': 'Server overloaded',
+                    'retry_after': error.retry_after}
+        extra_headers.append((b'retry-after', str(error.retry_after).encode('latin-1')))
+
+    if isinstance(response, str):
+        payload, content_type = response.encode('utf-8'), metrics.CONTENT_TYPE
+    elif isinstance(response, EncodedResult):
+        payload, encoding_headers = encoded_response(response, headers.get('Accept-Encoding'))
+        content_type = 'application/json'
+        extra_headers.extend((key.lower().encode('latin-1'), value.encode('latin-1'))
+                             for (key, value) in encoding_headers.items())
+    else:
+        payload, content_type = json.dumps(response).encode('utf-8'), 'application/json'
+    await send({'type': 'http.response.start',
+                'status': status,
+                'headers': [(b'content-type', content_type.encode('latin-1')),
+                            (b'content-length', str(len(payload)).encode('latin-1'))]
+                           + extra_headers})
+    await send({'type': 'http.response.body', 'body': payload})
@@ -0,0 +1,261 @@
+'''
+Module used to store the data from the CSV file in a columnar layout and
+answer the TaskRunner queries with vectorized NumPy reductions. NumPy is
+an optional dependency, needed only when the columnar engine is enabled.
+'''
+from itertools import chain
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class ColumnarEngine:
+    '''
+    Class used to keep the rows of the CSV file as NumPy columns. The
+    question, the state, the category and the category value of each row
+    are replaced by integer codes (given in the order in which they first
+    appear in the file) and the values are kept in a float64 array. The
+    rows are sorted by question, so the rows of a question are a contiguous
+    slice of each column, and every group-by mean is computed over that
+    slice with 'np.bincount' instead of summing Python lists.
+    '''
+    COLUMNS = ('question', 'state', 'category', 'category_value', 'value', 'offsets')
+    LABELS = ('questions', 'states', 'categories', 'category_values')
+
+    def __init__(self, columns, labels, questions_best_is_min, questions_best_is_max):
+        if np is None:
+            raise ImportError("The columnar engine requires numpy to be installed")
+
+        self.questions_best_is_min = questions_best_is_min
+        self.questions_best_is_max = questions_best_is_max
+
+        self.questions = labels['questions']
+        self.states = labels['states']
+        self.categories = labels['categories']
+        self.category_values = labels['category_values']
+
+        self.question = columns['question']
+        self.state = columns['state']
+        self.category = columns['category']
+        self.category_value = columns['category_value']
+        self.value = columns['value']
+        self.offsets = columns['offsets']
+
+        self.question_ids = {question: i for (i, question) in enumerate(self.questions)}
+        self.state_ids = {state: i for (i, state) in enumerate(self.states)}
+        self.empty_category = self.categories.index('') if '' in self.categories else -1
+        self.empty_value = self.category_values.index('') if '' in self.category_values else -1
+
+    @classmethod
+    def from_groups(cls, groups, questions_best_is_min, questions_best_is_max):
+        '''
+        Method used to build the engine from a dictionary with (question,
+        state, category, category_value) keys and lists of values, as
+        'DataIngestor.data_by_category'. The codes are computed once for
+        each key and repeated for each of its values, so no intermediate
+        list of rows is built.
+        '''
+        if np is None:
+            raise ImportError("The columnar engine requires numpy to be installed")
+
+        keys = list(groups)
+        counts = np.fromiter((len(values) for values in groups.values()),
+                             dtype=np.int64, count=len(keys))
+        values = np.fromiter(chain.from_iterable(groups.values()), dtype=np.float64,
+                             count=int(counts.sum()))
+
+        labels = {}
+        codes = {}
+        for position, name in enumerate(cls.LABELS):
+            labels[name], key_codes = cls.factorize([key[position] for key in keys])
+            codes[name] = np.repeat(key_codes, counts)
+
+        order = np.argsort(codes['questions'], kind='stable')
+        columns = {
+            'question': codes['questions'][order],
+            'state': codes['states'][order],
+            'category': codes['categories'][order],
+            'category_value': codes['category_values'][order],
+            'value': values[order],
+        }
+        question_counts = np.bincount(columns['question'], minlength=len(labels['questions']))
+        columns['offsets'] = np.concatenate(([0], np.cumsum(question_counts)))
+
+        return cls(columns, labels, questions_best_is_min, questions_best_is_max)
+
+    def export(self):
+        '''
+        Method used to get the columns and the labels of the engine, in the
+        form received by the constructor.
+        '''
+        return ({name: getattr(self, name) for name in self.COLUMNS},
+                {name: getattr(self, name) for name in self.LABELS})
+
+    @staticmethod
+    def factorize(labels):
+        '''
+        Method used to replace every label from the given list with an
+        integer code. It returns the list of distinct labels, in the order
+        of their first appearance, and the array of codes.
+        '''
+        codes = {}
+        array = np.fromiter((codes.setdefault(label, len(codes)) for label in labels),
+                            dtype=np.int32, count=len(labels))
+        return list(codes), array
+
+    def question_rows(self, question):
+        '''
+        Method used to get the slice of rows that belong to the given question.
+        If the question does not exist, an empty slice is returned.
+        '''
+        i = self.question_ids.get(question)
+        if i is None:
+            return slice(0, 0)
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+    def state_means(self, question):
+        '''
+        Method used to compute the mean of each state for the given question.
+        It returns the array of state codes, in the order in which the states
+        first appear for the question, and the array of their means.
+        '''
+        rows = self.question_rows(question)
+        states = self.state[rows]
+        sums = np.bincount(states, weights=self.value[rows], minlength=len(self.states))
+        counts = np.bincount(states, minlength=len(self.states))
+
+        codes, first = np.unique(states, return_index=True)
+        codes = codes[np.argsort(first, kind='stable')]
+        return codes, sums[codes] / counts[codes]
+
+    def ranking(self, question):
+        '''
+        Method used to get the list of (state, mean) tuples for the given
+        question, sorted ascending by mean.
+        '''
+        codes, means = self.state_means(question)
+        order = np.argsort(means, kind='stable')
+        return [(self.states[code], float(mean))
+                for (code, mean) in zip(codes[order], means[order])]
+
+    def global_mean(self, question):
+        '''
+        Method used to compute the mean of all the values of the given question.
+        '''
+        values = self.value[self.question_rows(question)]
+        if values.size == 0:
+            raise KeyError(question)
+        return float(values.sum() / values.size)
+
+    def category_means(self, question, state=None):
+        '''
+        Method used to compute the mean for each (state, category,
+        category_value) group of the given question, optionally only for
+        the given state. The groups with an empty category or category
+        value are skipped. It returns a dictionary with the label tuples
+        as keys.
+        '''
+        rows = self.question_rows(question)
+        states = self.state[rows]
+        categories = self.category[rows]
+        category_values = self.category_value[rows]
+
+        mask = (categories != self.empty_category) & (category_values != self.empty_value)
+        if state is not None:
+            mask &= states == self.state_ids.get(state, -1)
+
+        keys = ((states[mask].astype(np.int64) * len(self.categories) + categories[mask])
+                * len(self.category_values) + category_values[mask])
+        groups, inverse = np.unique(keys, return_inverse=True)
+        sums = np.bincount(inverse, weights=self.value[rows][mask], minlength=len(groups))
+        counts = np.bincount(inverse, minlength=len(groups))
+
+        result = {}
+        for group, mean in zip(groups.tolist(), (sums / counts).tolist()):
+            group, category_value = divmod(group, len(self.category_values))
+            state_code, category = divmod(group, len(self.categories))
+            result[(self.states[state_code], self.categories[category],
+                    self.category_values[category_value])] = mean
+        return result
+
+    def states_mean_solve(self, question):
+        '''
+        Columnar version of 'TaskRunner.states_mean_solve'.
+        '''
+        return dict(self.ranking(question))
+
+    def state_mean_solve(self, question, state):
+        '''
+        Columnar version of 'TaskRunner.state_mean_solve'.
+        '''
+        rows = self.question_rows(question)
+        values = self.value[rows][self.state[rows] == self.state_ids.get(state, -1)]
+        if values.size == 0:
+            raise KeyError((question, state))
+        return {state: float(values.sum() / values.size)}
+
+    def best5_solve(self, question):
+        '''
+        Columnar version of 'TaskRunner.best5_solve'.
+        '''
+        if question in self.questions_best_is_min:
+            return dict(self.ranking(question)[:5])
+        if question in self.questions_best_is_max:
+            return dict(self.ranking(question)[-5:])
+        return None
+
+    def worst5_solve(self, question):
+        '''
+        Columnar version of 'TaskRunner.worst5_solve'.
+        '''
+        if question in self.questions_best_is_min:
+            return dict(self.ranking(question)[-5:])
+        if question in self.questions_best_is_max:
+            return dict(self.ranking(question)[:5])
+        return None
+
+    def global_mean_solve(self, question):
+        '''
+        Columnar version of 'TaskRunner.global_mean_solve'.
+        '''
+        return {"global_mean": self.global_mean(question)}
+
+    def diff_from_mean_solve(self, question):
+        '''
+        Columnar version of 'TaskRunner.diff_from_mean_solve'.
+        '''
+        global_mean = self.global_mean(question)
+        codes, means = self.state_means(question)
+        return {self.states[code]: float(global_mean - mean)
+                for (code, mean) in zip(codes, means)}
+
+    def state_diff_from_mean_solve(self, question, state):
+        '''
+        Columnar version of 'TaskRunner.state_diff_from_mean_solve'.
+        '''
+        return {state: self.global_mean(question)
+                - self.state_mean_solve(question, state)[state]}
+
+    def mean_by_category_solve(self, question):
+        '''
+        Columnar version of 'TaskRunner.mean_by_category_solve'.
+        '''
+        result = {str(key): mean for (key, mean) in self.category_means(question).items()}
+        return dict(sorted(result.items(), key=lambda x: x[0]))
+
+    def state_mean_by_category_solve(self, question, state):
+        '''
+        Columnar version of 'TaskRunner.state_mean_by_category_solve'.
+        '''
+        result = {str(key[1:]): mean
+                  for (key, mean) in self.category_means(question, state).items()}
+        return {state: dict(sorted(result.items(), key=lambda x: x[0]))}
+
+    def solve(self, command, question, state):
+        '''
+        Method used to solve the given command with the columnar engine.
+        '''
+        if command in ('state_mean', 'state_diff_from_mean', 'state_mean_by_category'):
+            return getattr(self, command + '_solve')(question, state)
+        return getattr(self, command + '_solve')(question)
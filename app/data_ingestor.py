@@ -3,35 +3,177 @@ Module used to parse the data from the CSV file and provide the necessary
 data structures to the TaskRunner.
 '''
 
+import io
+import os
+import sys
 import csv
+import copy
+import time
+import itertools
+from array import array
+from app.columnar import ColumnarEngine
+from app.snapshot import Snapshot
+
+class YearSlice:
+    '''
+    Class used to hold the indexes of a question restricted to a range of
+    years, in the same form as the ones of the DataIngestor, so the same
+    solvers of the TaskRunner answer the filtered queries. The indexes are
+    built from the per-year sums of the data_ingestor only when a solver
+    reads them: the aggregates, the ranking and the global mean together,
+    from the sums of the states, and the stratification cube on its own,
+    so the commands that do not use the categories never build it.
+    '''
+    __slots__ = ('data_ingestor', 'question', 'year_from', 'year_to', 'states', 'cube',
+                 'questions_best_is_min', 'questions_best_is_max', 'columnar')
+
+    def __init__(self, data_ingestor, question, year_from=None, year_to=None):
+        self.data_ingestor = data_ingestor
+        self.question = question
+        self.year_from = year_from
+        self.year_to = year_to
+        self.states = None
+        self.cube = None
+        self.questions_best_is_min = data_ingestor.questions_best_is_min
+        self.questions_best_is_max = data_ingestor.questions_best_is_max
+        self.columnar = None
+
+    @property
+    def aggregates(self):
+        '''
+        The (sum, count, mean) of each state of the question with values in
+        the range of years.
+        '''
+        return self.state_indexes()[0]
+
+    @property
+    def ranking(self):
+        '''
+        The (state, mean) pairs of the question, sorted by their mean.
+        '''
+        return self.state_indexes()[1]
+
+    @property
+    def global_means(self):
+        '''
+        The mean of all the values of the question in the range of years.
+        '''
+        return self.state_indexes()[2]
+
+    @property
+    def category_cube(self):
+        '''
+        The stratification cube of the question in the range of years.
+        '''
+        if self.cube is None:
+            self.cube = self.data_ingestor.year_cube(self.question, self.year_from, self.year_to)
+        return self.cube
+
+    def state_indexes(self):
+        '''
+        Method used to get the (aggregates, ranking, global_means) indexes,
+        built by the data_ingestor the first time they are needed.
+        '''
+        if self.states is None:
+            self.states = self.data_ingestor.year_states(self.question,
+                                                         self.year_from, self.year_to)
+        return self.states
 
 class DataIngestor:
     '''
     Class used to parse the data from the CSV file and provide the necessary
     data structures to the TaskRunner In the __init__ method, the csv file is
-    opened and I extract in a list every tuple containing the state, the value,
-    the question, the category and the category value, which I use further to
-    create a dictionary where each key represents a tuple containing the
-    question and the state that has the question, and the value is a list
-    of all the values that the state has for that question. I also do the
-    same for the categories but with a dictionary containing the question,
-    the state, the category and the category value as the key and the list
-    of values as the value.
+    read row by row and, from the state, the value, the question, the category
+    and the category value of each row, I build a dictionary where each key
+    represents a tuple containing the question and the state that has the
+    question, and the value is a list of all the values that the state has
+    for that question. I also do the same for the categories but with a
+    dictionary containing the question, the state, the category and the
+    category value as the key and the list of values as the value.
+    On top of these, I build an aggregate index holding the sum, the count
+    and the mean of the values for every (question, state) pair, the global
+    mean of every question and, for every question, the list of its states
+    sorted by their mean, so that the most requested endpoints are answered
+    by simple lookups instead of passing through all the values again.
+    The same value lists are also indexed by question first, so that the
+    queries about one question only go through that question's slice.
+    The engine used to answer the queries is chosen through the 'engine'
+    parameter or the DATA_ENGINE environment variable: 'dict' (the default)
+    uses the structures above, while 'columnar' also loads the rows in a
+    'ColumnarEngine', which computes the results with NumPy.
+    If a cache directory is given through 'cache_dir' or the DATA_CACHE_DIR
+    environment variable, the indexes are saved in a binary snapshot there
+    and loaded back on the next start instead of parsing the CSV file again,
+    as long as the file did not change.
+    Each DataIngestor gets a new 'version' number, used to tell apart the
+    results computed on different datasets, and keeps in 'timings' how many
+    seconds each phase of the loading took.
+    The rows appended to the CSV file after it was loaded are ingested
+    through 'read_rows' and 'extended', which builds a new DataIngestor
+    from the current one and the new rows only. The current DataIngestor is
+    never changed, so the jobs that already hold it keep computing on the
+    same data while the server switches to the new version.
+    The stratification cube in 'self.category_cube' holds, for each
+    question, a (sum, count, children) node with a child for each state,
+    whose children are the categories, whose children are the category
+    values, as (sum, count) leaves. The empty categories and category
+    values are left out, and the children of every node are in the order
+    of the keys of the '/api/mean_by_category' results, so the results
+    are read from it without sorting.
+    The sum and the count of the values are also kept for each year (the
+    'YearStart' column), in 'self.year_aggregates' by question and state,
+    and in 'self.year_category_aggregates' by question, state, category
+    and category value, as arrays of (year, sum, count) triples.
+    'year_slice' adds up the years of a range to answer the queries
+    filtered by year.
+    To keep the indexes compact, the values of each key are stored in an
+    'array' of doubles instead of a list of float objects, and the strings
+    of the rows go through 'self.strings', which maps each of
+    them to its first occurrence, so every key of every index refers to the
+    same objects instead of the copies parsed from each row.
     '''
-    def __init__(self, csv_path: str):
-        with open(csv_path, 'r', encoding='utf-8') as file:
-            csv_file = csv.reader(file)
-            states_stats = [(x[4], x[11], x[8], x[30], x[31]) for x in csv_file if x[11] != ''][1:]
-            self.data = {(question, state): [] for (state, _, question, _, _) in states_stats}
+    READ_BUFFER_SIZE = 1 << 20
+
+    VERSIONS = itertools.count(1)
 
-            for state, stat, question, _, _ in states_stats:
-                self.data[(question, state)].append(float(stat))
+    INDEXES = ('data', 'data_by_category', 'data_by_question', 'data_by_question_category',
+               'aggregates', 'ranking', 'global_means', 'year_aggregates',
+               'year_category_aggregates', 'strings', 'category_cube')
 
-            self.data_by_category = {(question, state, category, category_value): [] for (state, _, question, category, category_value) in states_stats}
+    def __init__(self, csv_path: str, engine=None, cache_dir=None):
+        self.version = next(DataIngestor.VERSIONS)
+        self.timings = {}
+        start = time.perf_counter()
 
-            for state, stat, question, category, category_value in states_stats:
-                item = (question, state, category, category_value)
-                self.data_by_category[item].append(float(stat))
+        if engine is None:
+            engine = os.environ.get('DATA_ENGINE', 'dict')
+        if engine not in ('dict', 'columnar'):
+            raise ValueError(f"Unknown data engine: {engine}")
+
+        if cache_dir is None:
+            cache_dir = os.environ.get('DATA_CACHE_DIR')
+        snapshot = Snapshot(csv_path, cache_dir) if cache_dir else None
+        indexes = None
+        if snapshot is not None:
+            indexes = snapshot.load_indexes()
+            if indexes is not None and any(name not in indexes for name in self.INDEXES):
+                indexes = None
+            start = self.timed('snapshot_load', start)
+
+        self.csv_path = csv_path
+        if indexes is not None:
+            for name in self.INDEXES:
+                setattr(self, name, indexes[name])
+            self.offset = snapshot.key['size']
+        else:
+            self.read_csv(csv_path)
+            start = self.timed('read_csv', start)
+            self.build_question_indexes()
+            self.build_aggregates()
+            start = self.timed('indexes', start)
+            if snapshot is not None:
+                snapshot.save_indexes({name: getattr(self, name) for name in self.INDEXES})
+                start = self.timed('snapshot_save', start)
 
         self.questions_best_is_min = [
             'Percent of adults aged 18 years and older who have an overweight classification',
@@ -48,12 +190,473 @@ class DataIngestor:
             'Percent of adults who engage in muscle-strengthening activities on 2 or more days a week',
         ]
 
+        self.columnar = None
+        if engine == 'columnar':
+            columns = snapshot.load_columns() if snapshot is not None else None
+            if columns is not None:
+                self.columnar = ColumnarEngine(*columns,
+                                               self.questions_best_is_min,
+                                               self.questions_best_is_max)
+            else:
+                self.columnar = ColumnarEngine.from_groups(self.data_by_category,
+                                                           self.questions_best_is_min,
+                                                           self.questions_best_is_max)
+                if snapshot is not None:
+                    snapshot.save_columns(*self.columnar.export())
+            self.timed('columnar', start)
+
+    def timed(self, phase, start):
+        '''
+        Method used to save in 'timings' the seconds passed since 'start' for
+        the given phase of the loading. It returns the end of the phase, which
+        is the start of the next one.
+        '''
+        end = time.perf_counter()
+        self.timings[phase] = end - start
+        return end
+
+    def read_csv(self, csv_path):
+        '''
+        Method used to parse the CSV file and build 'self.data' and
+        'self.data_by_category' from it in a single pass. The file is read
+        through a large buffer and every row is added to both dictionaries
+        as soon as it is parsed, so only the dictionaries stay in memory,
+        not the rows of the file. The value of a row is converted to float
+        once and appended to the arrays of both dictionaries, and its
+        strings are interned through 'self.strings'. The number
+        of bytes read is kept in 'self.offset', where the rows appended to
+        the file later start. The per-year sums and counts are updated from
+        the same rows.
+        '''
+        self.data = {}
+        self.data_by_category = {}
+        self.year_aggregates = {}
+        self.year_category_aggregates = {}
+        self.strings = {}
+        intern = self.strings.setdefault
+
+        with open(csv_path, 'r', encoding='utf-8', buffering=self.READ_BUFFER_SIZE) as file:
+            csv_file = csv.reader(file)
+            next(csv_file, None)
+
+            for row in csv_file:
+                if row[11] == '':
+                    continue
+
+                value = float(row[11])
+                question, state = intern(row[8], row[8]), intern(row[4], row[4])
+                category, category_value = intern(row[30], row[30]), intern(row[31], row[31])
+                self.append_value(self.data, (question, state), value)
+                self.append_value(self.data_by_category,
+                                  (question, state, category, category_value), value)
+
+                year = int(row[1])
+                self.add_year_total(self.year_aggregates.setdefault(question, {}),
+                                    state, year, value)
+                self.add_year_total(self.year_category_aggregates.setdefault(question, {})
+                                    .setdefault(state, {}).setdefault(category, {}),
+                                    category_value, year, value)
+
+            self.offset = file.buffer.tell()
+
+    @staticmethod
+    def append_value(index, key, value):
+        '''
+        Method used to append a value to the array of a key, creating the
+        array the first time the key is seen.
+        '''
+        numbers = index.get(key)
+        if numbers is None:
+            numbers = index[key] = array('d')
+        numbers.append(value)
+
+    @staticmethod
+    def read_rows(csv_path, offset=0):
+        '''
+        Method used to read the rows written in a CSV file after the byte
+        'offset', without its header if the offset is 0. Only the complete
+        lines are read, so a row that is still being written is read by the
+        next call. It returns the rows and the offset where the next call
+        should start. A ValueError is raised if the file is now smaller than
+        the offset, as it was replaced and must be loaded again.
+        '''
+        with open(csv_path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size < offset:
+                raise ValueError(f"{csv_path} is smaller than the ingested data")
+            file.seek(offset)
+            content = file.read()
+
+        end = content.rfind(b'\n') + 1
+        rows = list(csv.reader(io.StringIO(content[:end].decode('utf-8'), newline='')))
+        if offset == 0:
+            rows = rows[1:]
+        return rows, offset + end
+
+    def extended(self, rows, offset=None):
+        '''
+        Method used to build a new DataIngestor with the data of this one and
+        the given rows, with a new version. The arrays of values and the
+        nested dictionaries of the indexes are copied only for the keys that
+        get new values, the other ones are shared with this DataIngestor,
+        and the aggregates are updated only for the (question, state) pairs
+        of the new rows, by adding their values to the old sums, and the
+        ranking and the global mean only for their questions. Only the
+        columnar engine, if it is used, is built again from the groups. If
+        the rows were read from the CSV file, 'offset' is the new end of the
+        ingested data. The per-year sums are updated the same way, through
+        'add_year_value'.
+        '''
+        start = time.perf_counter()
+        new = copy.copy(self)
+        new.version = next(DataIngestor.VERSIONS)
+        new.timings = {}
+        if offset is not None:
+            new.offset = offset
+        for name in self.INDEXES:
+            setattr(new, name, dict(getattr(self, name)))
+
+        added = {}
+        copied = set()
+        copied_years = set()
+        intern = new.strings.setdefault
+        for row in rows:
+            if row[11] == '':
+                continue
+
+            value = float(row[11])
+            question, state = intern(row[8], row[8]), intern(row[4], row[4])
+            category, category_value = intern(row[30], row[30]), intern(row[31], row[31])
+            added.setdefault((question, state), []).append(value)
+            new.add_category_value((question, state, category, category_value), value, copied)
+
+            year = int(row[1])
+            new.add_year_value('year_aggregates', (question, state), year, value,
+                               copied_years)
+            new.add_year_value('year_category_aggregates',
+                               (question, state, category, category_value), year, value,
+                               copied_years)
+
+        questions = set()
+        for (question, state), numbers in added.items():
+            if question not in questions:
+                new.data_by_question[question] = dict(self.data_by_question.get(question, {}))
+                questions.add(question)
+
+            new.data[(question, state)] = self.data.get((question, state), array('d')) + \
+                array('d', numbers)
+            new.data_by_question[question][state] = new.data[(question, state)]
+
+            total, count, _ = self.aggregates.get((question, state), (0, 0, 0))
+            for number in numbers:
+                total += number
+            count += len(numbers)
+            new.aggregates[(question, state)] = (total, count, total / count)
+
+        for question in questions:
+            new.rank_question(question)
+            new.category_cube[question] = self.build_cube(new.data_by_question_category[question],
+                                                          self.values_cell)
+        start = new.timed('append', start)
+
+        if self.columnar is not None:
+            new.columnar = ColumnarEngine.from_groups(new.data_by_category,
+                                                      new.questions_best_is_min,
+                                                      new.questions_best_is_max)
+            new.timed('columnar', start)
+        return new
+
+    def rank_question(self, question):
+        '''
+        Method used by 'extended' to compute again the ranking and the global
+        mean of a question from the aggregates of its states, the same way
+        'build_aggregates' does for all the questions.
+        '''
+        ranking = []
+        total = 0
+        count = 0
+        for state in self.data_by_question[question]:
+            if (question, state) in self.aggregates:
+                state_total, state_count, mean = self.aggregates[(question, state)]
+                ranking.append((state, mean))
+                total += state_total
+                count += state_count
+
+        ranking.sort(key=lambda x: x[1])
+        self.ranking[question] = ranking
+        self.global_means[question] = total / count
+
+    def add_category_value(self, key, value, copied):
+        '''
+        Method used by 'extended' to add a value to the group of a (question,
+        state, category, category value) key. The first time a key gets a
+        value, its array and the dictionaries above it in
+        'self.data_by_question_category' are copied from the ones shared with
+        the old DataIngestor, and the copied keys are added to 'copied', so
+        the old DataIngestor does not see the new value.
+        '''
+        if key not in copied:
+            question, state, category, category_value = key
+            numbers = self.data_by_category[key] = array('d', self.data_by_category.get(key, ()))
+            if question not in copied:
+                self.data_by_question_category[question] = \
+                    dict(self.data_by_question_category.get(question, {}))
+                copied.add(question)
+            states = self.data_by_question_category[question]
+            if (question, state) not in copied:
+                states[state] = dict(states.get(state, {}))
+                copied.add((question, state))
+            if (question, state, category) not in copied:
+                states[state][category] = dict(states[state].get(category, {}))
+                copied.add((question, state, category))
+            states[state][category][category_value] = numbers
+            copied.add(key)
+        self.data_by_category[key].append(value)
+
+    def memory_size(self):
+        '''
+        Method used to estimate the memory taken by the indexes, in bytes, as
+        the sum of the sizes of all the objects reachable from them, each
+        object being counted once, even if it is shared by several indexes.
+        The arrays of the columnar engine are added if it is used.
+        '''
+        size = 0
+        seen = set()
+        stack = [getattr(self, name) for name in self.INDEXES]
+        while stack:
+            item = stack.pop()
+            if id(item) in seen:
+                continue
+            seen.add(id(item))
+            size += sys.getsizeof(item)
+            if isinstance(item, dict):
+                stack.extend(item.keys())
+                stack.extend(item.values())
+            elif isinstance(item, (list, tuple)):
+                stack.extend(item)
+
+        if self.columnar is not None:
+            columns, _ = self.columnar.export()
+            size += sum(column.nbytes for column in columns.values())
+        return size
+
+    @staticmethod
+    def add_year_total(index, key, year, value):
+        '''
+        Method used to add a value to the sum and the count of a year in the
+        array of (year, sum, count) triples of a key, creating the array the
+        first time the key is seen. There are only a few years, so the year
+        is looked up linearly.
+        '''
+        years = index.get(key)
+        if years is None:
+            years = index[key] = array('d')
+        for i in range(0, len(years), 3):
+            if years[i] == year:
+                years[i + 1] += value
+                years[i + 2] += 1
+                return
+        years.extend((year, value, 1))
+
+    def add_year_value(self, name, keys, year, value, copied):
+        '''
+        Method used by 'extended' to add a value to the sum and the count of a
+        year in the per-year index 'name', under the nested keys 'keys'. As
+        in 'add_category_value', the dictionaries and the array on the path
+        are copied the first time they get a value, and their paths are
+        added to 'copied'.
+        '''
+        level = getattr(self, name)
+        path = (name,)
+        for key in keys[:-1]:
+            path += (key,)
+            if path not in copied:
+                level[key] = dict(level.get(key, {}))
+                copied.add(path)
+            level = level[key]
+
+        path += (keys[-1],)
+        if path not in copied:
+            level[keys[-1]] = array('d', level.get(keys[-1], ()))
+            copied.add(path)
+        self.add_year_total(level, keys[-1], year, value)
+
+    @staticmethod
+    def year_total(years, year_from, year_to):
+        '''
+        Method used to add up the sums and the counts of the (year, sum,
+        count) triples of the years between 'year_from' and 'year_to',
+        inclusive. A bound that is None does not limit the range.
+        '''
+        total = 0
+        number = 0
+        for i in range(0, len(years), 3):
+            year = years[i]
+            if (year_from is None or year >= year_from) and (year_to is None or year <= year_to):
+                total += years[i + 1]
+                number += int(years[i + 2])
+        return total, number
+
+    def has_years(self, question, state, year_from=None, year_to=None):
+        '''
+        Method used to check if a question has values in the years between
+        'year_from' and 'year_to', for the given state, or for any of its
+        states if the state is None.
+        '''
+        states = self.year_aggregates.get(question, {})
+        years = states.values() if state is None else [states.get(state, ())]
+        return any(self.year_total(state_years, year_from, year_to)[1] > 0
+                   for state_years in years)
+
+    def year_slice(self, question, year_from=None, year_to=None):
+        '''
+        Method used to get the indexes of a question restricted to the
+        years between 'year_from' and 'year_to', as a 'YearSlice', which
+        builds them through 'year_states' and 'year_cube' when they are
+        first read.
+        '''
+        return YearSlice(self, question, year_from, year_to)
+
+    def year_states(self, question, year_from=None, year_to=None):
+        '''
+        Method used to build the aggregates, the ranking and the global
+        means of a question restricted to the years between 'year_from' and
+        'year_to', from the per-year sums and counts, without going through
+        the values again. The states without values in the range are left
+        out, as well as the question if none of its states has values.
+        '''
+        aggregates = {}
+        ranking = []
+        question_total = 0
+        question_count = 0
+        for state, years in self.year_aggregates.get(question, {}).items():
+            total, number = self.year_total(years, year_from, year_to)
+            if number == 0:
+                continue
+
+            aggregates[(question, state)] = (total, number, total / number)
+            ranking.append((state, total / number))
+            question_total += total
+            question_count += number
+        ranking.sort(key=lambda x: x[1])
+
+        if question_count == 0:
+            return aggregates, {}, {}
+        return aggregates, {question: ranking}, {question: question_total / question_count}
+
+    def year_cube(self, question, year_from=None, year_to=None):
+        '''
+        Method used to build the stratification cube of a question
+        restricted to the years between 'year_from' and 'year_to', from the
+        per-year sums and counts of its categories. The question is left
+        out if none of its cells has values in the range.
+        '''
+        cube = self.build_cube(self.year_category_aggregates.get(question, {}),
+                               lambda years: self.year_total(years, year_from, year_to))
+        return {question: cube} if cube[1] else {}
+
+    @staticmethod
+    def values_cell(numbers):
+        '''
+        Method used to get the (sum, count) cell of an array of values.
+        '''
+        return sum(numbers), len(numbers)
+
+    @staticmethod
+    def build_cube(states, cell):
+        '''
+        Method used to build the node of a question in the stratification
+        cube from its state -> category -> category value index, where
+        'cell' gives the (sum, count) of a leaf of the index. The cells
+        without values and the ones with an empty category or category
+        value are left out. The cells are sorted by the string of their
+        (state, category, category value) key, as in the results, and
+        added to the nodes in that order, then the sums and the counts are
+        rolled up to the category, the state and the question nodes.
+        '''
+        cells = []
+        for state, categories in states.items():
+            for category, values in categories.items():
+                if category == '':
+                    continue
+                for category_value, leaf in values.items():
+                    total, count = cell(leaf)
+                    if category_value != '' and count > 0:
+                        cells.append(((state, category, category_value), (total, count)))
+        cells.sort(key=lambda item: str(item[0]))
+
+        tree = {}
+        for (state, category, category_value), leaf in cells:
+            tree.setdefault(state, {}).setdefault(category, {})[category_value] = leaf
+
+        def rollup(children):
+            return (sum(child[0] for child in children.values()),
+                    sum(child[1] for child in children.values()),
+                    children)
+
+        return rollup({state: rollup({category: rollup(values)
+                                      for (category, values) in categories.items()})
+                       for (state, categories) in tree.items()})
+
     def helper(self, question):
         '''
-    	This is a helper function used to filter all those states that have a
-    	certain question given as a parameter and return a dictionary where the
-    	key is the state and the value is the list of values that the state has
-    	for that question.
-    	'''
-        items_by_question = list(filter(lambda x: x[0] == question, self.data.keys()))
-        return {state: self.data[(question, state)] for (_, state) in items_by_question}
+        This is a helper function used to get all those states that have a
+        certain question given as a parameter and return a dictionary where the
+        key is the state and the value is the list of values that the state has
+        for that question.
+        '''
+        return dict(self.data_by_question.get(question, {}))
+
+    def build_question_indexes(self):
+        '''
+        Method used to build the nested indexes keyed by question. In
+        'self.data_by_question' each question maps to a dictionary from
+        state to the list of values, and in 'self.data_by_question_category'
+        each question maps to state -> category -> category value -> list of
+        values. The arrays are the same objects as the ones in 'self.data'
+        and 'self.data_by_category', so the indexes don't copy any value.
+        '''
+        self.data_by_question = {}
+        for (question, state), numbers in self.data.items():
+            self.data_by_question.setdefault(question, {})[state] = numbers
+
+        self.data_by_question_category = {}
+        for (question, state, category, category_value), numbers in self.data_by_category.items():
+            states = self.data_by_question_category.setdefault(question, {})
+            categories = states.setdefault(state, {}).setdefault(category, {})
+            categories[category_value] = numbers
+
+    def build_aggregates(self):
+        '''
+        Method used to build the aggregate index from the question index. For each
+        (question, state) key it stores a tuple (sum, count, mean) in
+        'self.aggregates', for each question it stores the mean of all its
+        values in 'self.global_means' and the list of (state, mean) tuples
+        sorted ascending by mean in 'self.ranking'. The states keep their
+        order from 'self.data' when they have the same mean. The
+        stratification cube is built from the category index at the end.
+        '''
+        self.aggregates = {}
+        self.ranking = {}
+        question_sums = {}
+        question_counts = {}
+
+        for question, states in self.data_by_question.items():
+            for state, numbers in states.items():
+                total = sum(numbers)
+                count = len(numbers)
+                if count == 0:
+                    continue
+
+                self.aggregates[(question, state)] = (total, count, total / count)
+                self.ranking.setdefault(question, []).append((state, total / count))
+                question_sums[question] = question_sums.get(question, 0) + total
+                question_counts[question] = question_counts.get(question, 0) + count
+
+        for states in self.ranking.values():
+            states.sort(key=lambda x: x[1])
+
+        self.global_means = {question: total / question_counts[question]
+                            for (question, total) in question_sums.items()}
+
+        self.category_cube = {question: self.build_cube(states, self.values_cell)
+                              for (question, states) in self.data_by_question_category.items()}
@@ -0,0 +1,151 @@
+'''
+Module used to keep the datasets served by the webserver, loading each one
+the first time it is used and evicting the least recently used ones when
+they take more memory than the budget.
+'''
+import os
+from collections import OrderedDict
+from threading import Lock
+from app.data_ingestor import DataIngestor
+
+DEFAULT_DATASET = 'default'
+
+class DatasetRegistry:
+    '''
+    Class used to map the names of the datasets to their CSV files and to
+    the DataIngestors of the loaded ones. A dataset is loaded by 'get' the
+    first time a request asks for it, and the loaded datasets are kept in
+    an OrderedDict from the least to the most recently used one. When the
+    memory taken by the loaded datasets, as estimated by
+    'DataIngestor.memory_size', goes over 'memory_budget' bytes, the least
+    recently used ones are evicted, except for the one that was just used.
+    A budget of 0 means that no dataset is ever evicted.
+    An evicted DataIngestor is only dropped from the registry, so the jobs
+    that already hold it still finish on it, and the next request for
+    the dataset loads it again. Each dataset is loaded by a single thread,
+    under its own lock, so the requests for the other datasets are not
+    blocked by a slow load. The loaded datasets are registered in the
+    threadpool through 'share', for its worker processes, and removed
+    from it through 'forget' when they are evicted.
+    '''
+    def __init__(self, pool, memory_budget=0, engine=None):
+        self.pool = pool
+        self.memory_budget = memory_budget
+        self.engine = engine
+
+        self.paths = {}
+        self.loaded = OrderedDict()
+        self.sizes = {}
+        self.loading = {}
+        self.lock = Lock()
+
+    def register(self, name, csv_path):
+        '''
+        Method used to add a dataset to the registry, without loading it.
+        '''
+        with self.lock:
+            self.paths[name] = csv_path
+            self.loading.setdefault(name, Lock())
+
+    def __contains__(self, name):
+        return name in self.paths
+
+    def is_loaded(self, name):
+        '''
+        Method used to check if a dataset is loaded, so 'get' returns it
+        without reading its CSV file.
+        '''
+        with self.lock:
+            return name in self.loaded
+
+    def get(self, name=DEFAULT_DATASET):
+        '''
+        Method used to get the DataIngestor of a dataset, loading it if it
+        is not loaded, and to mark it as the most recently used one. A
+        KeyError is raised for a dataset that was not registered.
+        '''
+        with self.lock:
+            if name in self.loaded:
+                self.loaded.move_to_end(name)
+                return self.loaded[name]
+            loading = self.loading[name]
+
+        with loading:
+            with self.lock:
+                if name in self.loaded:
+                    self.loaded.move_to_end(name)
+                    return self.loaded[name]
+                csv_path = self.paths[name]
+
+            data_ingestor = DataIngestor(csv_path, self.engine)
+            self.put(name, data_ingestor)
+        return data_ingestor
+
+    def put(self, name, data_ingestor):
+        '''
+        Method used to set the DataIngestor of a loaded dataset, as the most
+        recently used one, and to evict the other datasets if the budget is
+        exceeded. It is also used to swap in a new version of a dataset.
+        '''
+        size = data_ingestor.memory_size()
+        self.pool.share(data_ingestor)
+
+        evicted = []
+        with self.lock:
+            old = self.loaded.get(name)
+            self.loaded[name] = data_ingestor
+            self.loaded.move_to_end(name)
+            self.sizes[name] = size
+
+            while (self.memory_budget > 0 and len(self.loaded) > 1
+                   and sum(self.sizes.values()) > self.memory_budget):
+                evicted_name, evicted_data = self.loaded.popitem(last=False)
+                del self.sizes[evicted_name]
+                evicted.append(evicted_data)
+
+        if old is not None and old is not data_ingestor:
+            evicted.append(old)
+        for evicted_data in evicted:
+            self.pool.forget(evicted_data)
+
+    def loaded_datasets(self):
+        '''
+        Method used to get the (name, DataIngestor) pairs of the loaded
+        datasets, without marking them as used.
+        '''
+        with self.lock:
+            return list(self.loaded.items())
+
+    def stats(self):
+        '''
+        Method used to get, for each registered dataset, its CSV file and,
+        if it is loaded, its version and its estimated size, together with
+        the memory budget and the memory taken by the loaded datasets.
+        '''
+        with self.lock:
+            datasets = {}
+            for name, csv_path in self.paths.items():
+                datasets[name] = {'path': csv_path, 'loaded': name in self.loaded}
+                if name in self.loaded:
+                    datasets[name]['version'] = self.loaded[name].version
+                    datasets[name]['size'] = self.sizes[name]
+            return {'memory_budget': self.memory_budget,
+                    'memory_used': sum(self.sizes.values()),
+                    'datasets': datasets}
+
+def create_registry(pool, default_path):
+    '''
+    Function used to create the registry of the datasets, configured through
+    the environment variables: DATASETS (a comma separated list of
+    'name=path' pairs, registered besides the 'default' dataset from
+    'default_path') and DATASETS_MEMORY_BUDGET (the budget in megabytes,
+    0 by default, for no eviction).
+    '''
+    registry = DatasetRegistry(pool, int(float(os.environ.get('DATASETS_MEMORY_BUDGET', 0))
+                                         * (1 << 20)))
+    registry.register(DEFAULT_DATASET, default_path)
+    for pair in os.environ.get('DATASETS', '').split(','):
+        if pair.strip():
+            name, csv_path = pair.split('=', 1)
+            registry.register(name.strip(), csv_path.strip())
+    return registry
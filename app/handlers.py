@@ -0,0 +1,586 @@
+'''
+Module with the logic behind the routes of the webserver, independent of
+the framework that serves them. Each function receives the server (the
+Flask object from __init__.py, which holds the threadpool, the datasets
+and the counters) and returns the dictionary sent back to the client, so
+the same logic is used by the Flask routes from 'routes.py' and by the
+asyncio application from 'asgi.py'.
+'''
+import os
+from app.task_runner import Job, Batch, COMMANDS
+from app.scheduler import QueueFull
+from app.metrics import REQUESTS, RESULT_LOOKUPS
+from app.datasets import DEFAULT_DATASET
+from app.responses import encode_batch
+from app.query_cache import STATE_COMMANDS
+
+DEFAULT_WAIT_TIMEOUT = float(os.environ.get('LONG_POLL_TIMEOUT', 10))
+MAX_WAIT_TIMEOUT = float(os.environ.get('LONG_POLL_MAX_TIMEOUT', 30))
+JOBS_PAGE_LIMIT = int(os.environ.get('JOBS_PAGE_LIMIT', 100))
+JOBS_MAX_PAGE_LIMIT = int(os.environ.get('JOBS_MAX_PAGE_LIMIT', 1000))
+
+def parse_id(value):
+    '''
+    Function used to extract the number from a 'job_id_{number}' or a
+    'batch_id_{number}' string. It raises a ValueError if there is none.
+    '''
+    parts = value.split("_")
+    if len(parts) != 3:
+        raise ValueError(value)
+    return int(parts[2])
+
+def wait_timeout(args):
+    '''
+    Function used to get how many seconds a '/api/get_results' request
+    should wait for the result, from its 'timeout' or 'wait' query
+    parameters. The timeout is capped at MAX_WAIT_TIMEOUT seconds and
+    it is 0 if the request should not wait.
+    '''
+    if 'timeout' in args:
+        timeout = float(args['timeout'])
+    elif args.get('wait', '').lower() in ('1', 'true', 'yes'):
+        timeout = DEFAULT_WAIT_TIMEOUT
+    else:
+        return 0
+    return min(max(timeout, 0), MAX_WAIT_TIMEOUT)
+
+def submit_job(server, job):
+    '''
+    Function used to look up a new job in the query cache. If an identical
+    job is running, the new job is attached to it. The outcome of the
+    lookup and the result of a hit, or None, are returned and the job must
+    be added to the queue only if the outcome is 'miss'. The jobs with the
+    'debug' flag are always computed, so they can be profiled, and their
+    outcome is 'debug'. The job is added in the job registry of the
+    threadpool as 'queued', before it can reach a thread, and the result of
+    a hit is saved for it by 'save_hit', once the request is admitted.
+    Its key is built first, so a job whose key cannot be built is never
+    left 'queued' in the registry.
+    '''
+    key = None if job.debug else job.key()
+    server.tasks_runner.registry.add(job.job_id, job.command)
+    if job.debug:
+        REQUESTS.inc(job.command, 'debug')
+        return 'debug', None
+
+    outcome, result = server.tasks_runner.query_cache.lookup(key, job.job_id)
+    REQUESTS.inc(job.command, outcome)
+    return outcome, result
+
+def save_hit(server, job, result):
+    '''
+    Function used to save the result found in the query cache for a job,
+    which is 'done' right away.
+    '''
+    server.tasks_runner.results.put(job.job_id, result)
+    server.tasks_runner.registry.set_status(job.job_id, 'done')
+
+def admit(server, task, jobs):
+    '''
+    Function used to check that the scheduler of the threadpool admits a
+    task, whose jobs went through 'submit_job' and must be queued, counting
+    its jobs as rejected in the metrics if it does not. The rejected
+    request never sends its ids to the client, so all its 'jobs', queued
+    or not, are removed from the job registry and the ones attached to a
+    running query are detached from it. The queries of the rejected jobs
+    are no longer in flight in the query cache, so the jobs of the other
+    requests that were attached to them fail, and their waiting clients
+    are woken up.
+    '''
+    try:
+        server.tasks_runner.jobs_queue.admit(task)
+    except QueueFull:
+        pool = server.tasks_runner
+        rejected = {job.job_id for job in jobs}
+        for job in jobs:
+            pool.registry.remove(job.job_id)
+            if not job.debug:
+                pool.query_cache.detach(job.key(), job.job_id)
+        for job in task.jobs():
+            REQUESTS.inc(job.command, 'rejected')
+            if job.debug:
+                continue
+            for job_id in pool.query_cache.fail(job.key()):
+                if job_id not in rejected:
+                    pool.registry.set_status(job_id, 'failed')
+                    pool.results.notify(job_id)
+        raise
+
+def select_dataset(server, data, default=DEFAULT_DATASET):
+    '''
+    Function used to get the DataIngestor of the dataset named by the
+    "dataset" field of a request, or of the 'default' one if the field is
+    missing, loading it if needed. A KeyError is raised if the dataset is
+    not registered.
+    '''
+    name = data.get("dataset", default) if isinstance(data, dict) else default
+    if not isinstance(name, str) or name not in server.datasets:
+        raise KeyError(name)
+    return server.datasets.get(name)
+
+def year_range(data):
+    '''
+    Function used to get the (year_from, year_to) range of the years a query
+    is restricted to, from its optional "year_from" and "year_to" fields,
+    where a missing bound is None. It returns None if the query has none of
+    them and raises a ValueError if they are not years or not in order.
+    '''
+    if "year_from" not in data and "year_to" not in data:
+        return None
+
+    years = []
+    for name in ("year_from", "year_to"):
+        year = data.get(name)
+        if year is not None:
+            if isinstance(year, bool) or not isinstance(year, (int, str)):
+                raise ValueError(year)
+            year = int(year)
+        years.append(year)
+
+    if None not in years and years[0] > years[1]:
+        raise ValueError(years)
+    return tuple(years)
+
+def reserve_ids(server, jobs, batch=False):
+    '''
+    Function used to give consecutive ids to the given jobs, from the
+    job_counter of the server, and to get a new batch_id if 'batch' is set.
+    The counters are read and advanced under the lock of the server, so the
+    requests handled at the same time never get the same ids.
+    '''
+    batch_id = None
+    with server.counter_lock:
+        first = server.job_counter
+        server.job_counter += len(jobs)
+        if batch:
+            batch_id = server.batch_counter
+            server.batch_counter += 1
+    for i, job in enumerate(jobs):
+        job.job_id = first + i
+    return batch_id
+
+def query_fields(query):
+    '''
+    Function used to get the question and the state of a query, or None
+    for a missing state, without the spaces around them, so the key of the
+    query in the query cache and the solvers get the same strings. A
+    ValueError is raised if the question is not a string, or if the state
+    is given but is not one.
+    '''
+    if not isinstance(query, dict):
+        raise ValueError(query)
+    question, state = query.get("question"), query.get("state")
+    if not isinstance(question, str) or not (state is None or isinstance(state, str)):
+        raise ValueError(query)
+    return question.strip(), state.strip() if state is not None else None
+
+def range_has_data(data_ingestor, command, question, state, years):
+    '''
+    Function used to check that a query restricted to a range of years has
+    values to be computed on: the question must have values in the range,
+    for the state of the commands that use one. A query without a range
+    always has.
+    '''
+    if years is None:
+        return True
+    return data_ingestor.has_years(question, state if command in STATE_COMMANDS else None,
+                                   *years)
+
+def submit_query(server, data, command, client=None):
+    '''
+    Function used to create the job of a query received on the route of
+    the given command. The question, the state(if it exists), the new id,
+    the data_ingestor of the dataset selected by 'select_dataset' and the
+    key of the client are sent to the threadpool as a 'Job', unless
+    'submit_job' found the query in the query cache. The job gets its id
+    from 'reserve_ids' and the new job_id is returned. If the server
+    is shutting down, an error message is returned, and if the job must be
+    queued, but the scheduler of the threadpool does not admit it, its
+    QueueFull exception is raised. The query cache hits and the coalesced
+    jobs take no place in the queue, so they are never rejected. An
+    unknown dataset or an invalid range of years, as parsed by
+    'year_range', gets an error message, as well as a range without values
+    for the query, checked by 'range_has_data', and so does a question or
+    a state that is not a string, as checked by 'query_fields'.
+    '''
+    server.logger.info(f"Received data: {data}")
+
+    if not server.tasks_runner.shutdown.is_set():
+        try:
+            question, state = query_fields(data)
+        except ValueError:
+            return {"status": "error", "reason": "Invalid query"}
+        try:
+            data_ingestor = select_dataset(server, data)
+        except KeyError:
+            return {"status": "error", "reason": "Invalid dataset"}
+        try:
+            years = year_range(data)
+        except ValueError:
+            return {"status": "error", "reason": "Invalid year range"}
+        if not range_has_data(data_ingestor, command, question, state, years):
+            return {"status": "error", "reason": "No data in year range"}
+
+        job = Job(None,
+                  command,
+                  question,
+                  state,
+                  data_ingestor,
+                  client,
+                  bool(data.get("debug")),
+                  years)
+        reserve_ids(server, [job])
+
+        outcome, result = submit_job(server, job)
+        if outcome in ('miss', 'debug'):
+            admit(server, job, [job])
+            server.tasks_runner.jobs_queue.put(job)
+        elif outcome == 'hit':
+            save_hit(server, job, result)
+
+        server.logger.info(f"Added job with id: job_id_{job.job_id} to the queue ({outcome})")
+
+        return {"job_id": "job_id_" + str(job.job_id)}
+
+    return {"status": "error", "reason": "Server is shutting down"}
+
+def client_key(headers, address):
+    '''
+    Function used to get the key of the client that sent a request, used
+    by the scheduler to share the threads fairly between the clients: the
+    'X-Client-Id' header if it is given, or the address of the client.
+    '''
+    return headers.get('X-Client-Id') or address
+
+def submit_batch(server, data, client=None):
+    '''
+    Function used to create the jobs of a batch of queries of the form
+    {"endpoint": ..., "question": ..., "state": ...}, received under the
+    "queries" key. Each query gets its own job_id, so its result can also
+    be requested through '/api/get_results', and the jobs that are not
+    answered by the query cache are added in the queue together, as a
+    single 'Batch' task. The new batch_id and the job_ids of the queries,
+    in the same order, are returned. As for 'submit_query', the QueueFull
+    exception of the scheduler is raised if the task of the queued jobs is
+    not admitted.
+    Each query is computed on its own "dataset", or on the "dataset" of
+    the batch if it has none, and restricted to its own range of years,
+    which must have values for the query, and its question and state are
+    checked and stripped by 'query_fields', as for 'submit_query'.
+    '''
+    server.logger.info(f"Received batch: {data}")
+
+    if server.tasks_runner.shutdown.is_set():
+        return {"status": "error", "reason": "Server is shutting down"}
+
+    queries = data.get("queries") if isinstance(data, dict) else None
+    if not isinstance(queries, list) or not queries:
+        return {"status": "error", "reason": "Invalid batch"}
+
+    fields = []
+    for i, query in enumerate(queries):
+        if not isinstance(query, dict) or query.get("endpoint") not in COMMANDS:
+            return {"status": "error", "reason": f"Invalid query at position {i}"}
+        try:
+            fields.append(query_fields(query))
+        except ValueError:
+            return {"status": "error", "reason": f"Invalid query at position {i}"}
+
+    data_ingestors = []
+    years = []
+    for i, query in enumerate(queries):
+        try:
+            data_ingestors.append(select_dataset(server, query,
+                                                 data.get("dataset", DEFAULT_DATASET)))
+        except KeyError:
+            return {"status": "error", "reason": f"Invalid dataset at position {i}"}
+        try:
+            years.append(year_range(query))
+        except ValueError:
+            return {"status": "error", "reason": f"Invalid year range at position {i}"}
+        if not range_has_data(data_ingestors[i], query["endpoint"], *fields[i], years[i]):
+            return {"status": "error", "reason": f"No data in year range at position {i}"}
+
+    jobs = [Job(None,
+                query["endpoint"],
+                question,
+                state,
+                data_ingestor,
+                client,
+                bool(query.get("debug")),
+                query_years)
+            for (query, (question, state), data_ingestor, query_years)
+            in zip(queries, fields, data_ingestors, years)]
+    batch_id = reserve_ids(server, jobs, batch=True)
+
+    job_ids = []
+    misses = []
+    hits = []
+    for job in jobs:
+        outcome, result = submit_job(server, job)
+        if outcome in ('miss', 'debug'):
+            misses.append(job)
+        elif outcome == 'hit':
+            hits.append((job, result))
+        job_ids.append(job.job_id)
+
+    if misses:
+        batch = Batch(batch_id, misses, client)
+        admit(server, batch, jobs)
+        server.tasks_runner.jobs_queue.put(batch)
+    for job, result in hits:
+        save_hit(server, job, result)
+    server.batches[batch_id] = job_ids
+
+    server.logger.info(f"Added batch with id: batch_id_{batch_id} "
+                       f"({len(job_ids)} jobs, {len(misses)} queued)")
+
+    return {"batch_id": "batch_id_" + str(batch_id),
+            "job_ids": ["job_id_" + str(job_id) for job_id in job_ids]}
+
+def missing_result(server, job_id):
+    '''
+    Function used to get why the result of a job is not in the result
+    store: 'failed' if the job failed, 'expired' or 'evicted' if its result
+    was removed, or None if the job is still running. A finished job whose
+    removal is no longer remembered by the store, or that was already
+    forgotten by the job registry, has expired.
+    '''
+    reason = server.tasks_runner.results.removal_reason(job_id)
+    if reason is None:
+        status = server.tasks_runner.registry.status(job_id)
+        if status == 'failed':
+            reason = 'failed'
+        elif status in (None, 'done'):
+            reason = 'expired'
+    return reason
+
+def result_status(server, job_id):
+    '''
+    Function used to get the status of the result of a job without reading
+    it: 'done' if it is in the result store, 'running' if it may still be
+    saved, or the reason given by 'missing_result' if it never will, in
+    which case the clients must not wait for it.
+    '''
+    if job_id in server.tasks_runner.results:
+        return 'done'
+    return missing_result(server, job_id) or 'running'
+
+def missing_response(reason):
+    '''
+    Function used to get the response for a result given by
+    'missing_result': the 'expired' status for an expired one and an error
+    for an evicted one or for a failed job.
+    '''
+    if reason == 'expired':
+        return {
+            'status': 'expired',
+            'reason': 'Result expired'
+        }
+    if reason == 'failed':
+        return {
+            'status': 'error',
+            'reason': 'Job failed'
+        }
+    return {
+        'status': 'error',
+        'reason': 'Result evicted'
+    }
+
+def job_result(server, jid):
+    '''
+    Function used to get the status of a job from the result store of the
+    threadpool, which has its result as soon as the thread that processed
+    it saved it. If the job failed or its result was removed from the
+    store by its retention policy, the response of 'missing_response' is
+    returned, and in a contrary case, the job is still running. A finished
+    job gets the EncodedResult from the store, which holds the whole
+    response. The outcome of the lookup is counted in the metrics.
+    '''
+    results = server.tasks_runner.results
+    try:
+        encoded = results.get_encoded(jid)
+    except KeyError:
+        reason = missing_result(server, jid)
+        if reason is not None:
+            RESULT_LOOKUPS.inc(reason)
+            return missing_response(reason)
+        RESULT_LOOKUPS.inc('miss')
+        return {
+            'status': 'running',
+        }
+
+    RESULT_LOOKUPS.inc('hit')
+    return encoded
+
+def unknown_batch(server, bid):
+    '''
+    Function used to get the response for a batch_id that is not in the
+    batches of the server: a batch forgotten by the compactor has expired,
+    while any other batch_id is invalid.
+    '''
+    if isinstance(bid, int) and 0 < bid < server.batch_counter:
+        return missing_response('expired')
+    return {'status': 'error', 'reason': 'Invalid batch_id'}
+
+def batch_result(server, job_ids):
+    '''
+    Function used to get the results of all the given jobs of a batch, as a
+    dictionary from job_id to result, once all of them are done, built as
+    an EncodedResult from the encoded results of the jobs. Until then, the
+    number of finished jobs is returned with the 'running' status. If a
+    job failed or its result was removed, the batch gets the response of
+    'missing_response'. The job ids are read from the batches by the
+    caller, only once, since the compactor can forget the batch meanwhile.
+    '''
+    results = server.tasks_runner.results
+
+    data = {}
+    for job_id in job_ids:
+        try:
+            data["job_id_" + str(job_id)] = results.get_encoded(job_id)
+        except KeyError:
+            reason = missing_result(server, job_id)
+            if reason is not None:
+                return missing_response(reason)
+
+    if len(data) < len(job_ids):
+        return {
+            'status': 'running',
+            'done': len(data),
+            'total': len(job_ids)
+        }
+
+    return encode_batch(data)
+
+def page_args(args):
+    '''
+    Function used to get the status filter, the cursor and the limit of a
+    '/api/jobs' request from its 'status', 'after' and 'limit' query
+    parameters. The cursor is the job_id after which the page starts, as a
+    'job_id_{number}' string or a number, 0 by default. The limit is
+    JOBS_PAGE_LIMIT by default and it is capped at JOBS_MAX_PAGE_LIMIT. A
+    ValueError is raised for a negative cursor or a limit that is not
+    positive.
+    '''
+    after = args.get('after', '0')
+    after = parse_id(after) if after.startswith('job_id_') else int(after)
+    limit = min(int(args.get('limit', JOBS_PAGE_LIMIT)), JOBS_MAX_PAGE_LIMIT)
+    if after < 0 or limit <= 0:
+        raise ValueError((after, limit))
+    return args.get('status'), after, limit
+
+def jobs_status(server, args=None):
+    '''
+    Function used to get the status of the jobs from the job registry of
+    the threadpool, a page at a time, in the order of their ids, or only
+    the ones with a given status ('queued', 'running', 'done' or 'failed'),
+    as parsed by 'page_args'. The next page starts after the job_id given
+    as 'next', which is None on the last page. The registry counts the jobs
+    of each status, so the total is returned without going through them.
+    With the 'details' query parameter, each job is described by its
+    command and the times it was received, started and finished.
+    '''
+    args = args or {}
+    registry = server.tasks_runner.registry
+    try:
+        status, after, limit = page_args(args)
+        page = registry.page(status, after, limit)
+    except ValueError:
+        return {'status': 'error', 'reason': 'Invalid jobs query'}
+
+    if args.get('details', '').lower() in ('1', 'true', 'yes'):
+        jobs_list = [record.describe(job_id) for (job_id, record) in page]
+    else:
+        jobs_list = [{"job_id_" + str(job_id): record.status} for (job_id, record) in page]
+
+    return {'status': 'done',
+            'jobs': jobs_list,
+            'total': registry.count(*([status] if status else [])),
+            'limit': limit,
+            'next': "job_id_" + str(page[-1][0]) if len(page) == limit else None}
+
+def num_jobs_status(server):
+    '''
+    Function used to get the number of jobs that are not finished, the
+    queued and the running ones, from the counters of the job registry.
+    If the server is shutting down and all of them are finished, the
+    status is 'done'.
+    '''
+    num_jobs = server.tasks_runner.registry.count('queued', 'running')
+    if server.tasks_runner.shutdown.is_set() and num_jobs == 0:
+        return {'status': 'done', 'num_jobs': 0}
+
+    return {'status': 'running', "num_jobs": num_jobs}
+
+def retention_status(server):
+    '''
+    Function used to get the retention policy and the removal counters of
+    the result store, together with the counters of the compactor.
+    '''
+    return {'results': server.tasks_runner.results.stats(),
+            'compactor': server.compactor.stats()}
+
+def profile_status(server, args):
+    '''
+    Function used to get the profiles of the jobs, aggregated by command,
+    optionally only for the 'command' query parameter and with the number
+    of functions given by the 'limit' query parameter. A limit that is not
+    a number, or is negative, gets an error message.
+    '''
+    try:
+        limit = int(args.get('limit', 20))
+    except ValueError:
+        limit = -1
+    if limit < 0:
+        return {'status': 'error', 'reason': 'Invalid limit'}
+
+    return server.tasks_runner.profiler.report(args.get('command'), limit)
+
+def profile_configure(server, data):
+    '''
+    Function used to change the profiler at runtime, from a request of the
+    form {"enabled": ..., "sample_rate": ..., "reset": ..., "dump": ...},
+    where every key is optional. "enabled" must be a boolean and
+    "sample_rate" a number. With "dump", the profiles are written in the
+    directory of the profiler and the paths of the files are returned.
+    '''
+    if not isinstance(data, dict):
+        return {'status': 'error', 'reason': 'Invalid profiler settings'}
+
+    enabled = data.get('enabled')
+    sample_rate = data.get('sample_rate')
+    if ((enabled is not None and not isinstance(enabled, bool))
+            or ('sample_rate' in data and (isinstance(sample_rate, bool)
+                                           or not isinstance(sample_rate, (int, float))))):
+        return {'status': 'error', 'reason': 'Invalid profiler settings'}
+
+    profiler = server.tasks_runner.profiler
+    try:
+        profiler.configure(enabled,
+                           float(sample_rate) if 'sample_rate' in data else None,
+                           bool(data.get('reset')))
+    except (ValueError, TypeError) as error:
+        return {'status': 'error', 'reason': str(error)}
+
+    response = {'status': 'ok', 'enabled': profiler.enabled, 'sample_rate': profiler.sample_rate}
+    if data.get('dump'):
+        response['files'] = profiler.dump()
+    return response
+
+def reload_dataset(server, data):
+    '''
+    Function used to update a dataset of the server through its reloader,
+    from a request of the form {"mode": "append" | "full", "dataset": ...},
+    where the mode is optional and 'append' by default, and the dataset is
+    optional and 'default' by default.
+    '''
+    if not isinstance(data, dict):
+        data = {}
+    name = data.get('dataset', DEFAULT_DATASET)
+    if not isinstance(name, str) or name not in server.datasets:
+        return {'status': 'error', 'reason': 'Invalid dataset'}
+    try:
+        return server.reloader.reload(data.get('mode', 'append'), name)
+    except (OSError, ValueError) as error:
+        return {'status': 'error', 'reason': str(error)}
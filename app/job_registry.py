@@ -0,0 +1,186 @@
+'''
+Module used to keep the state of every job received by the webserver, so
+the '/api/jobs' and '/api/num_jobs' routes do not have to go through the
+queue or the result store.
+'''
+import time
+from threading import Lock
+
+STATUSES = ('queued', 'running', 'done', 'failed')
+SCAN_CHUNK = 1024
+
+class JobRecord:
+    '''
+    Class used to describe the state of a job in the registry: its command,
+    its status and the times (from time.time()) when it was received, when
+    a thread started it and when it finished, or None if it did not yet.
+    '''
+    __slots__ = ('command', 'status', 'created', 'started', 'finished')
+
+    def __init__(self, command, status, created):
+        self.command = command
+        self.status = status
+        self.created = created
+        self.started = None
+        self.finished = None
+
+    def describe(self, job_id):
+        '''
+        Method used to get the record as a dictionary, for the responses.
+        '''
+        return {'job_id': 'job_id_' + str(job_id),
+                'command': self.command,
+                'status': self.status,
+                'created': self.created,
+                'started': self.started,
+                'finished': self.finished}
+
+class JobRegistry:
+    '''
+    Class used to map each job id to its 'JobRecord'. A job is added as
+    'queued' when it is received and goes to 'running' when a thread starts
+    it, then to 'done' once its result is in the result store, or to
+    'failed'. Besides the records, the ids of the jobs of each status are
+    kept in a dictionary used as an ordered set, so the jobs are counted by
+    status in O(1) and listed by status without going through the others.
+    Every change is made under a single lock. The finished jobs are in the
+    order in which they finished, so 'prune' forgets the oldest ones from
+    the front of the 'done' and 'failed' dictionaries. The lowest and the
+    highest job ids in the registry, 'first_id' and 'last_id', bound the
+    ids that 'page' goes through.
+    '''
+    def __init__(self):
+        self.jobs = {}
+        self.by_status = {status: {} for status in STATUSES}
+        self.first_id = 0
+        self.last_id = 0
+        self.lock = Lock()
+
+    def add(self, job_id, command):
+        '''
+        Method used to add a new job, as 'queued'. It must be added before
+        it is put in the queue, so a thread never updates a missing job.
+        '''
+        with self.lock:
+            self.jobs[job_id] = JobRecord(command, 'queued', time.time())
+            self.by_status['queued'][job_id] = None
+            if not self.first_id or job_id < self.first_id:
+                self.first_id = job_id
+            self.last_id = max(self.last_id, job_id)
+
+    def set_status(self, job_id, status):
+        '''
+        Method used to change the status of a job and to save the time it
+        started or finished. The jobs that are not in the registry are
+        ignored.
+        '''
+        with self.lock:
+            record = self.jobs.get(job_id)
+            if record is None:
+                return
+
+            del self.by_status[record.status][job_id]
+            record.status = status
+            self.by_status[status][job_id] = None
+            if status == 'running':
+                record.started = time.time()
+            elif status in ('done', 'failed'):
+                record.finished = time.time()
+
+    def remove(self, job_id):
+        '''
+        Method used to forget a job whose id was never sent to its client,
+        because its request was rejected. The jobs that are not in the
+        registry are ignored.
+        '''
+        with self.lock:
+            record = self.jobs.pop(job_id, None)
+            if record is not None:
+                del self.by_status[record.status][job_id]
+
+    def status(self, job_id):
+        '''
+        Method used to get the status of a job, or None if the job is not in
+        the registry.
+        '''
+        with self.lock:
+            record = self.jobs.get(job_id)
+            return record.status if record is not None else None
+
+    def prune(self, ttl=0, max_finished=0):
+        '''
+        Method used to forget the finished jobs that finished more than
+        'ttl' seconds ago (if 'ttl' is not 0) and the oldest finished jobs
+        over 'max_finished' (if it is not 0). The queued and the running
+        jobs are always kept. The 'first_id' only grows, so moving it past
+        the forgotten ids takes O(1) time per job over the whole run. It
+        returns the number of forgotten jobs.
+        '''
+        pruned = 0
+        with self.lock:
+            done, failed = self.by_status['done'], self.by_status['failed']
+            deadline = time.time() - ttl
+            while done or failed:
+                oldest = min((job_ids for job_ids in (done, failed) if job_ids),
+                             key=lambda job_ids: self.jobs[next(iter(job_ids))].finished)
+                job_id = next(iter(oldest))
+                if not ((ttl and self.jobs[job_id].finished < deadline)
+                        or (max_finished and len(done) + len(failed) > max_finished)):
+                    break
+                del oldest[job_id]
+                del self.jobs[job_id]
+                pruned += 1
+            while self.first_id < self.last_id and self.first_id not in self.jobs:
+                self.first_id += 1
+        return pruned
+
+    def count(self, *statuses):
+        '''
+        Method used to get the number of jobs with one of the given statuses,
+        or of all the jobs if no status is given.
+        '''
+        with self.lock:
+            if not statuses:
+                return len(self.jobs)
+            return sum(len(self.by_status[status]) for status in statuses)
+
+    def counts(self):
+        '''
+        Method used to get the number of jobs of each status.
+        '''
+        with self.lock:
+            return {status: len(job_ids) for (status, job_ids) in self.by_status.items()}
+
+    def page(self, status=None, after=0, limit=100):
+        '''
+        Method used to get the (job_id, JobRecord) pairs of at most 'limit'
+        jobs with ids greater than 'after', in the order of their ids, all
+        of them or only the ones with the given status. The small statuses
+        are read from their own dictionary, while the others are found by
+        going through the ids from 'after', SCAN_CHUNK ids at a time, taking
+        the lock for each chunk only, so a deep page never keeps the threads
+        from updating their jobs. A ValueError is raised for an unknown
+        status.
+        '''
+        if status is not None and status not in STATUSES:
+            raise ValueError(f"Unknown job status: {status}")
+
+        with self.lock:
+            if status is not None and len(self.by_status[status]) <= SCAN_CHUNK:
+                job_ids = sorted(job_id for job_id in self.by_status[status] if job_id > after)
+                return [(job_id, self.jobs[job_id]) for job_id in job_ids[:limit]]
+            start = max(after + 1, self.first_id)
+            last_id = self.last_id
+
+        page = []
+        while start <= last_id and len(page) < limit:
+            end = min(start + SCAN_CHUNK, last_id + 1)
+            with self.lock:
+                for job_id in range(start, end):
+                    record = self.jobs.get(job_id)
+                    if record is not None and (status is None or record.status == status):
+                        page.append((job_id, record))
+                        if len(page) == limit:
+                            break
+            start = end
+        return page
@@ -0,0 +1,224 @@
+'''
+Module used to record the metrics of the webserver and to expose them on
+'/api/metrics' in the Prometheus text format. The metrics are kept in
+memory by a few small classes instead of a client library: recording a
+value takes a lock and updates a counter, so it can stay enabled in
+production.
+'''
+from bisect import bisect_left
+from threading import Lock
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(names, values):
+    '''
+    Function used to format the labels of a sample, as '{name="value",...}'.
+    '''
+    if not names:
+        return ''
+    labels = ','.join(f'{name}="{escape(value)}"' for (name, value) in zip(names, values))
+    return '{' + labels + '}'
+
+def escape(value):
+    '''
+    Function used to escape a label value for the text format.
+    '''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metric:
+    '''
+    Base class of the metrics. A metric has a name, a help text and the
+    names of its labels, and keeps one value for each combination of label
+    values it was recorded with.
+    '''
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = Lock()
+
+    def header(self):
+        '''
+        Method used to get the HELP and TYPE lines of the metric.
+        '''
+        return [f"# HELP {self.name} {self.documentation}",
+                f"# TYPE {self.name} {self.kind}"]
+
+    def render(self):
+        '''
+        Method used to get the lines of the metric in the text format.
+        '''
+        with self.lock:
+            values = sorted(self.values.items())
+        return self.header() + [f"{self.name}{format_labels(self.labels, key)} {value}"
+                                for (key, value) in values]
+
+class Counter(Metric):
+    '''
+    Class used for the values that only grow, like the number of requests.
+    '''
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        '''
+        Method used to increment the counter of the given label values.
+        '''
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    '''
+    Class used for the values that go up and down, like the busy workers.
+    '''
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        '''
+        Method used to set the value of the gauge for the given label values.
+        '''
+        with self.lock:
+            self.values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        '''
+        Method used to add to the value of the gauge for the given label values.
+        '''
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        '''
+        Method used to subtract from the value of the gauge for the given label values.
+        '''
+        self.inc(*labels, amount=-amount)
+
+class Histogram(Metric):
+    '''
+    Class used for the distribution of durations. For each combination of
+    label values it keeps the number of observations in each bucket, their
+    count and their sum; the cumulative counts of the text format are only
+    computed when the metric is rendered.
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        '''
+        Method used to record a value for the given label values.
+        '''
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def render(self):
+        with self.lock:
+            values = sorted((key, list(counts)) for (key, counts) in self.values.items())
+
+        lines = self.header()
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                labels = format_labels(self.labels + ('le',), key + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {total}")
+            labels = format_labels(self.labels, key)
+            lines.append(f"{self.name}_count{labels} {total}")
+            lines.append(f"{self.name}_sum{labels} {counts[-1]}")
+        return lines
+
+REQUESTS = Counter('webserver_requests_total',
+                   'Queries received, by command and query cache outcome.',
+                   ('command', 'outcome'))
+JOBS = Counter('webserver_jobs_total',
+               'Jobs processed by the TaskRunner threads, by command and status.',
+               ('command', 'status'))
+QUEUE_WAIT = Histogram('webserver_queue_wait_seconds',
+                       'Time the jobs spent in the queue, by command.',
+                       ('command',))
+COMPUTE_TIME = Histogram('webserver_compute_seconds',
+                         'Time spent solving the jobs, by command.',
+                         ('command',))
+RESULT_LOOKUPS = Counter('webserver_result_lookups_total',
+                         'Lookups of job results in the result store, by outcome.',
+                         ('outcome',))
+BUSY_WORKERS = Gauge('webserver_workers_busy',
+                     'TaskRunner threads that are processing a task.')
+
+METRICS = (REQUESTS, JOBS, QUEUE_WAIT, COMPUTE_TIME, RESULT_LOOKUPS, BUSY_WORKERS)
+
+def collect(server):
+    '''
+    Function used to build the gauges whose values are read from the state
+    of the server when the metrics are requested: the idle workers, the
+    queued tasks and the rejected ones, the jobs of each status from the
+    job registry, the results kept and removed by the result store, the
+    counters of the query cache and the ingestion timings and the memory of the loaded datasets.
+    '''
+    pool = server.tasks_runner
+
+    idle = Gauge('webserver_workers_idle', 'TaskRunner threads waiting for a task.')
+    idle.set(pool.num_threads - BUSY_WORKERS.values.get((), 0))
+
+    scheduler = pool.jobs_queue.stats()
+    queued = Gauge('webserver_queue_tasks', 'Tasks in the queue, by priority class.',
+                   ('class',))
+    rejected = Counter('webserver_rejected_tasks_total',
+                       'Tasks rejected by the admission control, by priority class.',
+                       ('class',))
+    for name, stats in scheduler['classes'].items():
+        queued.set(stats['queued'], name)
+        rejected.inc(name, amount=stats['rejected'])
+
+    jobs = Gauge('webserver_jobs', 'Jobs in the job registry, by status.', ('status',))
+    for status, count in pool.registry.counts().items():
+        jobs.set(count, status)
+
+    store = pool.results.stats()
+    results = Gauge('webserver_results', 'Results kept by the result store.')
+    results.set(store['entries'])
+    removed = Counter('webserver_results_removed_total',
+                      'Results removed from the result store, by reason.', ('reason',))
+    for reason, count in store['removed'].items():
+        removed.inc(reason, amount=count)
+
+    cache = pool.query_cache.stats()
+    lookups = Counter('webserver_query_cache_lookups_total',
+                      'Lookups in the query cache, by outcome.', ('outcome',))
+    for outcome in ('hits', 'misses', 'coalesced'):
+        lookups.inc(outcome, amount=cache[outcome])
+    entries = Gauge('webserver_query_cache_entries', 'Results kept by the query cache.')
+    entries.set(cache['entries'])
+
+    ingestion = Gauge('webserver_ingestion_seconds',
+                      'Time spent loading the loaded datasets, by dataset and phase.',
+                      ('dataset', 'phase'))
+    for name, data_ingestor in server.datasets.loaded_datasets():
+        for phase, seconds in data_ingestor.timings.items():
+            ingestion.set(seconds, name, phase)
+    datasets = server.datasets.stats()
+    memory = Gauge('webserver_datasets_memory_bytes',
+                   'Estimated memory taken by the loaded datasets.')
+    memory.set(datasets['memory_used'])
+
+    return (idle, queued, rejected, jobs, results, removed, lookups, entries, ingestion, memory)
+
+def render(server):
+    '''
+    Function used to get all the metrics in the Prometheus text format.
+    '''
+    lines = []
+    for metric in METRICS + collect(server):
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
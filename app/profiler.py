@@ -0,0 +1,169 @@
+'''
+Module used to profile the jobs processed by the TaskRunner threads with
+cProfile, on demand, and to aggregate the profiles by command.
+'''
+import os
+import random
+import pstats
+import cProfile
+from threading import Lock
+
+class ProfileData:
+    '''
+    Class used to pass the raw statistics of a profile, as built by
+    'cProfile.Profile.create_stats', to 'pstats.Stats'. It is used for the
+    profiles made in the worker processes, which cannot send back the
+    profiler itself.
+    '''
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        '''
+        Method called by 'pstats.Stats', the statistics are already built.
+        '''
+
+def profile_call(function, *args):
+    '''
+    Function used to call a function under cProfile. It returns the result
+    of the call and the raw statistics of the profile.
+    '''
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        result = function(*args)
+    finally:
+        profile.disable()
+    profile.create_stats()
+    return result, profile.stats
+
+class JobProfiler:
+    '''
+    Class used to decide which jobs are profiled and to keep their profiles.
+    While the profiler is enabled, a job is profiled if it was sent with the
+    'debug' flag or, for the other jobs, with a probability of 'sample_rate'.
+    The profiles of the jobs with the same command are added together in a
+    'pstats.Stats' object, which can be read through 'report' or written in
+    'directory' as a '<command>.prof' file, readable by the pstats module or
+    by tools such as snakeviz. Both settings can be changed while the server
+    runs, through 'configure'.
+    Only one job is profiled at a time in the webserver process, because a
+    thread cannot start cProfile while another thread uses it on recent
+    Python versions; a sampled job that finds the profiler busy just runs
+    without it. The jobs solved in the worker processes are profiled there.
+    '''
+    def __init__(self, enabled=False, sample_rate=0.0, directory='profiles'):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.directory = directory
+
+        self.stats = {}
+        self.jobs = {}
+        self.lock = Lock()
+        self.busy = Lock()
+
+    def configure(self, enabled=None, sample_rate=None, reset=False):
+        '''
+        Method used to change the settings of the profiler at runtime. The
+        settings that are None are not changed. If 'reset' is set, the
+        profiles collected so far are dropped.
+        '''
+        if sample_rate is not None:
+            if not 0 <= sample_rate <= 1:
+                raise ValueError(f"Invalid sample rate: {sample_rate}")
+            self.sample_rate = sample_rate
+        if enabled is not None:
+            self.enabled = enabled
+        if reset:
+            with self.lock:
+                self.stats.clear()
+                self.jobs.clear()
+
+    def wants(self, job):
+        '''
+        Method used to decide if a job is profiled.
+        '''
+        if not self.enabled:
+            return False
+        return getattr(job, 'debug', False) or random.random() < self.sample_rate
+
+    def run(self, job, function, *args):
+        '''
+        Method used to call the function that solves a job, under cProfile
+        if the job is profiled.
+        '''
+        if not self.wants(job):
+            return function(*args)
+        if not self.busy.acquire(blocking=False): # pylint: disable=consider-using-with
+            return function(*args)
+        try:
+            result, stats = profile_call(function, *args)
+        finally:
+            self.busy.release()
+        self.add(job.command, stats)
+        return result
+
+    def add(self, command, stats):
+        '''
+        Method used to add the raw statistics of a profiled job to the
+        profile of its command.
+        '''
+        with self.lock:
+            if command in self.stats:
+                self.stats[command].add(ProfileData(stats))
+            else:
+                self.stats[command] = pstats.Stats(ProfileData(stats))
+            self.jobs[command] = self.jobs.get(command, 0) + 1
+
+    def report(self, command=None, limit=20):
+        '''
+        Method used to get, for each command (or only the given one), the
+        number of profiled jobs, their total time and the 'limit' functions
+        with the largest cumulative time.
+        '''
+        with self.lock:
+            report = {}
+            for name, stats in self.stats.items():
+                if command is not None and name != command:
+                    continue
+                functions = sorted(stats.stats.items(), key=lambda item: item[1][3],
+                                   reverse=True)[:limit]
+                report[name] = {
+                    'jobs': self.jobs[name],
+                    'total_time': stats.total_tt,
+                    'functions': [{'function': pstats.func_std_string(function),
+                                   'calls': calls,
+                                   'tottime': tottime,
+                                   'cumtime': cumtime}
+                                  for (function, (_, calls, tottime, cumtime, _))
+                                  in functions]
+                }
+            return {'enabled': self.enabled,
+                    'sample_rate': self.sample_rate,
+                    'commands': report}
+
+    def dump(self):
+        '''
+        Method used to write the profile of each command in 'directory'. It
+        returns the paths of the written files.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        paths = []
+        with self.lock:
+            for command, stats in self.stats.items():
+                path = os.path.join(self.directory, command + '.prof')
+                stats.dump_stats(path)
+                paths.append(path)
+        return paths
+
+def create_profiler():
+    '''
+    Function used to create the profiler of the threadpool, configured
+    through the environment variables: PROFILE_ENABLED ('1' to profile from
+    the start), PROFILE_SAMPLE_RATE (the fraction of the jobs to profile,
+    0 to profile only the jobs with the 'debug' flag) and PROFILE_DIR (the
+    directory of the dump files).
+    '''
+    return JobProfiler(os.environ.get('PROFILE_ENABLED', '0').lower() in ('1', 'true', 'yes'),
+                       float(os.environ.get('PROFILE_SAMPLE_RATE', 0)),
+                       os.environ.get('PROFILE_DIR', 'profiles'))
@@ -0,0 +1,107 @@
+'''
+Module used to memoize the results of the queries and to coalesce the
+identical queries that are processed at the same time.
+'''
+from collections import OrderedDict
+from threading import Lock
+
+STATE_COMMANDS = ('state_mean', 'state_diff_from_mean', 'state_mean_by_category')
+
+class QueryCache:
+    '''
+    Class used to remember the result of each query, keyed by the normalized
+    query and the version of the dataset it was computed on, so the same query
+    is not computed again while the dataset does not change. The completed
+    results are kept in an OrderedDict used as a LRU cache of at most
+    'max_entries' entries. While a query is computed, the ids of the jobs
+    with the same query are kept in 'in_flight', so they receive the result
+    of the job that is already running instead of being queued again.
+    '''
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.results = OrderedDict()
+        self.in_flight = {}
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def key(command, question, state, version, years=None):
+        '''
+        Method used to build the key of a query. The state is part of the
+        key only for the commands that use it, and the range of years only
+        for the queries restricted to one. The question and the state are
+        used as they are, since the solvers receive the same strings: the
+        spaces around them are stripped when the query is received.
+        '''
+        if command in STATE_COMMANDS:
+            return (command, question, state, version, years)
+        return (command, question, None, version, years)
+
+    def lookup(self, key, job_id):
+        '''
+        Method used to look for a query in the cache. It returns a tuple
+        with the outcome and the result: ('hit', result) if the query was
+        already computed, ('coalesced', None) if it is being computed now,
+        in which case the job is attached to the running one, and ('miss',
+        None) if the job must be computed, in which case the query is marked
+        as in flight until 'complete' is called for it.
+        '''
+        with self.lock:
+            if key in self.results:
+                self.hits += 1
+                self.results.move_to_end(key)
+                return 'hit', self.results[key]
+
+            if key in self.in_flight:
+                self.coalesced += 1
+                self.in_flight[key].append(job_id)
+                return 'coalesced', None
+
+            self.misses += 1
+            self.in_flight[key] = []
+            return 'miss', None
+
+    def complete(self, key, result):
+        '''
+        Method used to save the result of a query and to return the ids of
+        the jobs that were attached to it while it was computed.
+        '''
+        with self.lock:
+            if self.max_entries:
+                self.results[key] = result
+                while len(self.results) > self.max_entries:
+                    self.results.popitem(last=False)
+            return self.in_flight.pop(key, [])
+
+    def fail(self, key):
+        '''
+        Method used to forget a query whose computation failed, so the next
+        identical query is computed again. It returns the ids of the jobs
+        that were attached to it.
+        '''
+        with self.lock:
+            return self.in_flight.pop(key, [])
+
+    def detach(self, key, job_id):
+        '''
+        Method used to detach a job from the running query it was attached
+        to by 'lookup', so it does not receive its result.
+        '''
+        with self.lock:
+            job_ids = self.in_flight.get(key)
+            if job_ids is not None and job_id in job_ids:
+                job_ids.remove(job_id)
+
+    def stats(self):
+        '''
+        Method used to get the counters of the cache.
+        '''
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'coalesced': self.coalesced,
+                    'entries': len(self.results),
+                    'in_flight': len(self.in_flight)}
@@ -0,0 +1,115 @@
+'''
+Module used to ingest the rows appended to the CSV files while the server
+runs, without restarting it, so the job queue and the counters are kept.
+'''
+import os
+import logging
+from threading import Thread, Event, Lock
+from app.data_ingestor import DataIngestor
+from app.datasets import DEFAULT_DATASET
+
+class DatasetReloader:
+    '''
+    Class used to update the datasets of the server. An 'append' reads only
+    the rows written in the CSV file of a dataset after the ones already
+    ingested and builds a new DataIngestor from them through
+    'DataIngestor.extended', while a 'full' reload parses the whole file
+    again. Either way, the new DataIngestor is swapped in the registry of
+    the datasets through 'DatasetRegistry.put', in a single assignment, so
+    the new jobs get the new version while the jobs already created keep
+    the DataIngestor they were given. The query cache needs no
+    invalidation, because its keys contain the version of the dataset.
+    If 'interval' is positive, a thread checks the size of the files of the
+    loaded datasets every 'interval' seconds and appends the new rows by
+    itself. If a file got smaller, it was replaced, so it is loaded again
+    from the start.
+    '''
+    def __init__(self, server, interval=0):
+        self.server = server
+        self.interval = interval
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+
+    def reload(self, mode='append', name=DEFAULT_DATASET):
+        '''
+        Method used to update a dataset of the server, loading it first if
+        it is not loaded, and to get a summary of the update: the dataset,
+        the mode, the old and the new version, the number of appended rows
+        and the timings of the new DataIngestor. An append
+        without new rows keeps the current version. A ValueError is raised
+        for an unknown mode.
+        '''
+        if mode not in ('append', 'full'):
+            raise ValueError(f"Unknown reload mode: {mode}")
+
+        with self.lock:
+            current = self.server.datasets.get(name)
+            rows = None
+            if mode == 'append':
+                try:
+                    rows, offset = DataIngestor.read_rows(current.csv_path, current.offset)
+                except ValueError:
+                    mode = 'full'
+
+            if mode == 'full':
+                new = DataIngestor(current.csv_path,
+                                   'columnar' if current.columnar is not None else 'dict')
+            elif rows:
+                new = current.extended(rows, offset)
+            else:
+                current.offset = offset
+                new = current
+
+            if new is not current:
+                self.server.datasets.put(name, new)
+                self.server.logger.info(f"Dataset {name} reloaded ({mode}): version "
+                                        f"{current.version} -> {new.version}")
+
+        return {'status': 'done',
+                'dataset': name,
+                'mode': mode,
+                'old_version': current.version,
+                'version': new.version,
+                'rows': len(rows) if rows is not None else None,
+                'timings': new.timings if new is not current else {}}
+
+    def start(self):
+        '''
+        Method used to start the thread that watches the CSV files, if the
+        reloader has an interval.
+        '''
+        if self.interval <= 0:
+            return
+        self.thread = Thread(target=self.watch, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Method used to stop the thread that watches the CSV files.
+        '''
+        self.stopped.set()
+
+    def watch(self):
+        '''
+        Method run by the watching thread. A file is read only when its
+        size is not the one of the ingested data, and the errors are logged
+        so the thread keeps watching. The datasets that are not loaded are
+        not watched, they are read whole when they are loaded.
+        '''
+        while not self.stopped.wait(self.interval):
+            for name, current in self.server.datasets.loaded_datasets():
+                try:
+                    if os.path.getsize(current.csv_path) != current.offset:
+                        self.reload('append', name)
+                except Exception: # pylint: disable=broad-exception-caught
+                    logging.getLogger('webserver.log').exception(f"Dataset {name} reload failed")
+
+def create_reloader(server):
+    '''
+    Function used to create the reloader of the server, configured through
+    the DATA_WATCH_INTERVAL environment variable: the number of seconds
+    between two checks of the CSV file, or 0 (the default) to update the
+    datasets only through '/api/reload'.
+    '''
+    return DatasetReloader(server, float(os.environ.get('DATA_WATCH_INTERVAL', 0)))
@@ -0,0 +1,96 @@
+'''
+Module used to serialize the results of the jobs once, when they are
+computed, so the routes send the same bytes to every client that asks for
+a result instead of encoding it again for each request.
+'''
+import os
+import json
+import gzip
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ENCODER = os.environ.get('RESPONSE_ENCODER', 'auto')
+GZIP_MIN_BYTES = int(os.environ.get('RESPONSE_GZIP_MIN_BYTES', 0))
+GZIP_LEVEL = 6
+
+DONE_PREFIX = b'{"status":"done","data":'
+
+def dumps(obj):
+    '''
+    Function used to encode an object as compact JSON bytes, with orjson if
+    the RESPONSE_ENCODER environment variable is 'orjson', or is 'auto' (the
+    default) and orjson is installed, and with the json module otherwise.
+    '''
+    if ENCODER == 'orjson' or (ENCODER == 'auto' and orjson is not None):
+        if orjson is None:
+            raise ImportError("The orjson encoder requires orjson to be installed")
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+class EncodedResult:
+    '''
+    Class used to keep the result of a job already serialized, in the whole
+    '{"status": "done", "data": ...}' response of '/api/get_results', so the
+    response is sent as it is. The gzip version of the response is computed
+    the first time a client accepts it and kept as well.
+    '''
+    __slots__ = ('response', 'compressed')
+
+    def __init__(self, body):
+        self.response = DONE_PREFIX + body + b'}'
+        self.compressed = None
+
+    @classmethod
+    def encode(cls, result):
+        '''
+        Method used to serialize a result.
+        '''
+        return cls(dumps(result))
+
+    @property
+    def body(self):
+        '''
+        The JSON encoding of the result alone, without the response around it.
+        '''
+        return self.response[len(DONE_PREFIX):-1]
+
+    def decode(self):
+        '''
+        Method used to get the result back as a Python object.
+        '''
+        return json.loads(self.body)
+
+    def gzipped(self):
+        '''
+        Method used to get the response compressed with gzip. Two threads
+        may compress it at the same time, in which case both get the same
+        bytes and one of them is kept.
+        '''
+        if self.compressed is None:
+            self.compressed = gzip.compress(self.response, GZIP_LEVEL)
+        return self.compressed
+
+def encode_batch(results):
+    '''
+    Function used to build the response of a finished batch from the
+    encoded results of its jobs, given as a dictionary from job_id to
+    EncodedResult, without decoding them.
+    '''
+    body = b','.join(b'"' + job_id.encode('utf-8') + b'":' + encoded.body
+                     for (job_id, encoded) in results.items())
+    return EncodedResult(b'{' + body + b'}')
+
+def encoded_response(encoded, accept_encoding):
+    '''
+    Function used to get the body and the extra headers of the response of
+    an encoded result. The body is compressed with gzip if the client
+    accepts it (from the 'Accept-Encoding' header) and the response has at
+    least GZIP_MIN_BYTES bytes, when RESPONSE_GZIP_MIN_BYTES is not 0.
+    '''
+    if (GZIP_MIN_BYTES and len(encoded.response) >= GZIP_MIN_BYTES
+            and 'gzip' in (accept_encoding or '').lower()):
+        return encoded.gzipped(), {'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'}
+    return encoded.response, {}
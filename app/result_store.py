@@ -0,0 +1,380 @@
+'''
+Module used to keep the results of the jobs processed by the TaskRunner
+threads until they are requested through '/api/get_results/<job_id>'.
+'''
+import os
+import time
+from collections import OrderedDict
+from threading import Lock, Event
+from app.responses import EncodedResult
+
+REMOVAL_REASONS = ('expired', 'evicted')
+MIN_REMEMBERED = 10000
+
+class ResultStore:
+    '''
+    Base class of the result stores. A store maps a job id to the result of
+    the job, kept serialized as an 'EncodedResult', so the routes send it
+    without encoding it again; 'put' receives the EncodedResult or the
+    result itself, which is then encoded. The 'get_encoded' method raises a
+    KeyError if the result of the job is not in the store (the job is still
+    running or the result was removed), because None is a valid result for
+    a job, and 'get' does the same, but decodes the result. The clients
+    that want to know when a result is saved register a callback for that
+    job, which is called by 'notify' once the result is in the store.
+    The stores keep their results in 'entries', in the order in which they
+    were saved or used, and remove them by their retention policy: the
+    results older than 'ttl' seconds (if 'ttl' is not 0) are 'expired' and,
+    when there are more than 'max_entries' results (if it is not 0), the
+    oldest ones are 'evicted'. The reason of the last removals is kept for
+    the clients that still ask for those results, and 'compact' removes
+    the results that are due, from the thread of the 'ResultCompactor'.
+    '''
+    def __init__(self, max_entries=0, ttl=0):
+        self.waiters = {}
+        self.waiters_lock = Lock()
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.removed = OrderedDict()
+        self.removals = dict.fromkeys(REMOVAL_REASONS, 0)
+        self.lock = Lock()
+
+    def put(self, job_id, result):
+        '''
+        Method used to save the result of a job.
+        '''
+        raise NotImplementedError
+
+    def get_encoded(self, job_id):
+        '''
+        Method used to get the EncodedResult of a job.
+        '''
+        raise NotImplementedError
+
+    def get(self, job_id):
+        '''
+        Method used to get the result of a job, as a Python object.
+        '''
+        return self.get_encoded(job_id).decode()
+
+    def compact(self):
+        '''
+        Method used to remove the results that are due by the retention
+        policy. It returns the number of removed results.
+        '''
+        return 0
+
+    def remember_removal(self, job_id, reason):
+        '''
+        Method used to count a removed result and to remember why it was
+        removed, for the last max(max_entries, MIN_REMEMBERED) removals. It
+        must be called with the lock held.
+        '''
+        self.removed[job_id] = reason
+        self.removals[reason] += 1
+        while len(self.removed) > max(self.max_entries, MIN_REMEMBERED):
+            self.removed.popitem(last=False)
+
+    def removal_reason(self, job_id):
+        '''
+        Method used to get why the result of a job was removed from the
+        store, 'expired' or 'evicted', or None if it was not, or if it was
+        removed too long ago to be remembered.
+        '''
+        with self.lock:
+            return self.removed.get(job_id)
+
+    def is_evicted(self, job_id):
+        '''
+        Method used to check if the result of a job was removed from the store.
+        '''
+        return self.removal_reason(job_id) is not None
+
+    def stats(self):
+        '''
+        Method used to get the retention policy of the store, the number of
+        results it keeps and the number of removed results, by reason.
+        '''
+        with self.lock:
+            return {'max_entries': self.max_entries,
+                    'ttl': self.ttl,
+                    'entries': len(self.entries),
+                    'removed': dict(self.removals)}
+
+    def notify(self, job_id):
+        '''
+        Method called by the stores after saving the result of a job, to
+        call the callbacks of the clients waiting for it.
+        '''
+        with self.waiters_lock:
+            callbacks = self.waiters.pop(job_id, [])
+        for callback in callbacks:
+            callback()
+
+    def subscribe(self, job_id, callback):
+        '''
+        Method used to register a callback, without arguments, that is
+        called once the result of the given job is saved. It is registered
+        before checking the store, so a result saved in between is not
+        missed, and it is called right away if the result is already in the
+        store, which means that it may be called twice and must be idempotent.
+        The callback is called from the thread that saved the result.
+        '''
+        with self.waiters_lock:
+            self.waiters.setdefault(job_id, []).append(callback)
+        if job_id in self:
+            callback()
+
+    def unsubscribe(self, job_id, callback):
+        '''
+        Method used to remove a callback registered by 'subscribe', if it
+        was not called yet.
+        '''
+        with self.waiters_lock:
+            callbacks = self.waiters.get(job_id, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+                if not callbacks:
+                    del self.waiters[job_id]
+
+    def wait(self, job_id, timeout):
+        '''
+        Method used to block until the result of the given job is saved,
+        for at most 'timeout' seconds. Each client waits on its own event,
+        set by a callback registered through 'subscribe'. It returns True
+        if the result is in the store.
+        '''
+        event = Event()
+        self.subscribe(job_id, event.set)
+        done = event.wait(timeout)
+        self.unsubscribe(job_id, event.set)
+        return done or job_id in self
+
+    def __contains__(self, job_id):
+        '''
+        Method used to check if the result of a job is in the store and is
+        not expired, only from the index of the store, without reading the
+        result, expiring it or changing its order.
+        '''
+        raise NotImplementedError
+
+class DiskResultStore(ResultStore):
+    '''
+    Class used to keep each result in a 'job_id_{number}.json' file from the
+    given directory. The file is created only after the result is written
+    to a temporary file, so a partially written result is never read.
+    The time each result was saved is kept in 'entries', so the unknown
+    jobs are answered without touching the directory and the files due by
+    the retention policy are found without listing it. The job ids start
+    again from 1 when the server starts, so the result files left by a
+    previous run are removed, instead of being served for the new jobs.
+    '''
+    def __init__(self, directory='results', max_entries=0, ttl=0):
+        super().__init__(max_entries, ttl)
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        for name in os.listdir(directory):
+            if name.startswith('job_id_') and name.endswith(('.json', '.json.tmp')):
+                os.remove(os.path.join(directory, name))
+
+    def path(self, job_id):
+        '''
+        Method used to get the path of the result file of a job.
+        '''
+        return os.path.join(self.directory, 'job_id_' + str(job_id) + '.json')
+
+    def put(self, job_id, result):
+        if not isinstance(result, EncodedResult):
+            result = EncodedResult.encode(result)
+        with open(self.path(job_id) + '.tmp', 'wb') as file:
+            file.write(result.body)
+        os.replace(self.path(job_id) + '.tmp', self.path(job_id))
+        with self.lock:
+            self.entries[job_id] = time.monotonic()
+        self.notify(job_id)
+
+    def get_encoded(self, job_id):
+        with self.lock:
+            created = self.entries[job_id]
+            expired = self.ttl and time.monotonic() - created > self.ttl
+            if expired:
+                self.remove(job_id, 'expired')
+        if expired:
+            self.delete_files([job_id])
+            raise KeyError(job_id)
+
+        try:
+            with open(self.path(job_id), 'rb') as file:
+                return EncodedResult(file.read())
+        except FileNotFoundError as error:
+            raise KeyError(job_id) from error
+
+    def __contains__(self, job_id):
+        with self.lock:
+            created = self.entries.get(job_id)
+            return created is not None and not (self.ttl
+                                                and time.monotonic() - created > self.ttl)
+
+    def remove(self, job_id, reason):
+        '''
+        Method used to remove a result from the index of the store. Its file
+        is deleted by the caller, through 'delete_files', after the lock is
+        released. It must be called with the lock held.
+        '''
+        del self.entries[job_id]
+        self.remember_removal(job_id, reason)
+
+    def delete_files(self, job_ids):
+        '''
+        Method used to delete the result files of the given jobs.
+        '''
+        for job_id in job_ids:
+            try:
+                os.remove(self.path(job_id))
+            except FileNotFoundError:
+                pass
+
+    def compact(self):
+        '''
+        The results are kept in the order in which they were saved, so the
+        expired ones and the ones over 'max_entries' are at the front.
+        '''
+        removed = []
+        with self.lock:
+            now = time.monotonic()
+            while self.entries:
+                job_id, created = next(iter(self.entries.items()))
+                if self.ttl and now - created > self.ttl:
+                    reason = 'expired'
+                elif self.max_entries and len(self.entries) > self.max_entries:
+                    reason = 'evicted'
+                else:
+                    break
+                self.remove(job_id, reason)
+                removed.append(job_id)
+        self.delete_files(removed)
+        return len(removed)
+
+class MemoryResultStore(ResultStore):
+    '''
+    Class used to keep the encoded results in memory, in an
+    OrderedDict used as a LRU cache. When there are more than 'max_entries'
+    results, the least recently used one is evicted as soon as a new one is
+    saved, so the memory taken by the results stays bounded, while the
+    results older than 'ttl' seconds (if 'ttl' is not 0) expire when they
+    are requested or when the store is compacted. If
+    'spill_bytes' is not 0, the results whose JSON encoding is larger than
+    'spill_bytes' are written in 'spill_dir' and only their file is kept in
+    memory.
+    '''
+    def __init__(self, max_entries=10000, ttl=0, spill_bytes=0, spill_dir='results'):
+        super().__init__(max_entries, ttl)
+        self.spill = DiskResultStore(spill_dir) if spill_bytes else None
+        self.spill_bytes = spill_bytes
+
+    def put(self, job_id, result):
+        if not isinstance(result, EncodedResult):
+            result = EncodedResult.encode(result)
+
+        spilled = False
+        if self.spill is not None and len(result.body) > self.spill_bytes:
+            self.spill.put(job_id, result)
+            spilled, result = True, None
+
+        removed = []
+        with self.lock:
+            self.entries[job_id] = (time.monotonic(), spilled, result)
+            self.entries.move_to_end(job_id)
+            while self.max_entries and len(self.entries) > self.max_entries:
+                removed.append(self.remove(next(iter(self.entries)), 'evicted'))
+        self.delete_spilled(removed)
+        self.notify(job_id)
+
+    def get_encoded(self, job_id):
+        with self.lock:
+            created, spilled, result = self.entries[job_id]
+            expired = self.ttl and time.monotonic() - created > self.ttl
+            if expired:
+                removed = self.remove(job_id, 'expired')
+            else:
+                self.entries.move_to_end(job_id)
+        if expired:
+            self.delete_spilled([removed])
+            raise KeyError(job_id)
+
+        if spilled:
+            return self.spill.get_encoded(job_id)
+        return result
+
+    def __contains__(self, job_id):
+        with self.lock:
+            entry = self.entries.get(job_id)
+            return entry is not None and not (self.ttl
+                                              and time.monotonic() - entry[0] > self.ttl)
+
+    def remove(self, job_id, reason):
+        '''
+        Method used to remove a result from the store. It returns the job id
+        if the result was spilled, so the caller deletes its file through
+        'delete_spilled' after the lock is released, and None otherwise.
+        It must be called with the lock held.
+        '''
+        _, spilled, _ = self.entries.pop(job_id)
+        self.remember_removal(job_id, reason)
+        return job_id if spilled else None
+
+    def delete_spilled(self, job_ids):
+        '''
+        Method used to delete the spilled results of the given jobs from the
+        spill store, ignoring the None values returned by 'remove'.
+        '''
+        for job_id in job_ids:
+            if job_id is None:
+                continue
+            with self.spill.lock:
+                self.spill.entries.pop(job_id, None)
+            self.spill.delete_files([job_id])
+
+    def compact(self):
+        '''
+        The LRU order is not the order in which the results were saved, so
+        all of them are checked for the TTL.
+        '''
+        if not self.ttl:
+            return 0
+
+        removed = []
+        with self.lock:
+            now = time.monotonic()
+            expired = [job_id for (job_id, (created, _, _)) in self.entries.items()
+                       if now - created > self.ttl]
+            for job_id in expired:
+                removed.append(self.remove(job_id, 'expired'))
+        self.delete_spilled(removed)
+        return len(removed)
+
+def create_result_store():
+    '''
+    Method used to create the result store configured through the environment
+    variables: RESULT_STORE ('memory', the default, or 'disk'),
+    RESULT_STORE_MAX_ENTRIES (the results kept by either store, 0 to keep all
+    of them), RESULT_STORE_TTL (seconds, 0 to keep the
+    results until they are evicted), RESULT_STORE_SPILL_BYTES
+    (0 to never spill) and RESULT_STORE_DIR (the directory of the result files).
+    '''
+    kind = os.environ.get('RESULT_STORE', 'memory')
+    directory = os.environ.get('RESULT_STORE_DIR', 'results')
+    max_entries = int(os.environ.get('RESULT_STORE_MAX_ENTRIES', 10000))
+    ttl = float(os.environ.get('RESULT_STORE_TTL', 0))
+
+    if kind == 'disk':
+        return DiskResultStore(directory, max_entries, ttl)
+    if kind == 'memory':
+        return MemoryResultStore(max_entries,
+                                 ttl,
+                                 int(os.environ.get('RESULT_STORE_SPILL_BYTES', 0)),
+                                 directory)
+    raise ValueError(f"Unknown result store: {kind}")
@@ -0,0 +1,133 @@
+'''
+Module used to remove the results and the records of the finished jobs
+that are due by the retention policy, from a thread of its own, so the
+requests never pay for it.
+'''
+import os
+import time
+import logging
+from threading import Thread, Event, Lock
+
+class ResultCompactor:
+    '''
+    Class used to compact the result store of the threadpool, through its
+    'compact' method, which removes the expired results and the ones over
+    the maximum number of results, and to prune the finished jobs from the
+    job registry, keeping the ones that finished in the last 'jobs_ttl'
+    seconds (if it is not 0) and at most 'max_finished_jobs' of them (if it
+    is not 0). The batches, given as the dictionary from batch_id to the
+    ids of their jobs, are forgotten once all their jobs were pruned; they
+    are checked from the oldest one and the first batch with a job still in
+    the registry stops the check, so only the batches that can go are read.
+    If 'interval' is positive, a thread compacts them every
+    'interval' seconds. The number of runs, of removed results, of
+    forgotten jobs and batches and the duration of the last run are kept
+    for the stats.
+    '''
+    def __init__(self, pool, interval=0, jobs_ttl=0, max_finished_jobs=0, batches=None):
+        self.pool = pool
+        self.batches = batches if batches is not None else {}
+        self.interval = interval
+        self.jobs_ttl = jobs_ttl
+        self.max_finished_jobs = max_finished_jobs
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+
+        self.runs = 0
+        self.removed_results = 0
+        self.pruned_jobs = 0
+        self.pruned_batches = 0
+        self.last_seconds = 0
+
+    def compact(self):
+        '''
+        Method used to compact the result store, the job registry and the
+        batches once, and to get the number of removed results and of
+        forgotten jobs and batches.
+        '''
+        with self.lock:
+            start = time.perf_counter()
+            removed = self.pool.results.compact()
+            pruned = self.pool.registry.prune(self.jobs_ttl, self.max_finished_jobs)
+            pruned_batches = self.prune_batches()
+
+            self.runs += 1
+            self.removed_results += removed
+            self.pruned_jobs += pruned
+            self.pruned_batches += pruned_batches
+            self.last_seconds = time.perf_counter() - start
+
+        return {'results': removed, 'jobs': pruned, 'batches': pruned_batches}
+
+    def prune_batches(self):
+        '''
+        Method used to forget the oldest batches whose jobs are no longer in
+        the job registry. The new batches are added at the end of the
+        dictionary by the requests, while the first one is removed here.
+        '''
+        pruned = 0
+        while self.batches:
+            batch_id, job_ids = next(iter(self.batches.items()))
+            if any(self.pool.registry.status(job_id) is not None for job_id in job_ids):
+                break
+            del self.batches[batch_id]
+            pruned += 1
+        return pruned
+
+    def stats(self):
+        '''
+        Method used to get the configuration and the counters of the compactor.
+        '''
+        with self.lock:
+            return {'interval': self.interval,
+                    'jobs_ttl': self.jobs_ttl,
+                    'max_finished_jobs': self.max_finished_jobs,
+                    'runs': self.runs,
+                    'removed_results': self.removed_results,
+                    'pruned_jobs': self.pruned_jobs,
+                    'pruned_batches': self.pruned_batches,
+                    'last_seconds': self.last_seconds}
+
+    def start(self):
+        '''
+        Method used to start the compacting thread, if the compactor has an
+        interval.
+        '''
+        if self.interval <= 0:
+            return
+        self.thread = Thread(target=self.watch, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Method used to stop the compacting thread.
+        '''
+        self.stopped.set()
+
+    def watch(self):
+        '''
+        Method run by the compacting thread. The errors are logged, so the
+        thread keeps compacting.
+        '''
+        while not self.stopped.wait(self.interval):
+            try:
+                self.compact()
+            except Exception: # pylint: disable=broad-exception-caught
+                logging.getLogger('webserver.log').exception("Result compaction failed")
+
+def create_compactor(pool, batches):
+    '''
+    Function used to create the compactor of the threadpool and of the
+    given batches, configured through the environment variables:
+    RESULT_COMPACT_INTERVAL (the number
+    of seconds between two compactions, 60 by default, or 0 to never
+    compact), JOB_REGISTRY_TTL (seconds, 0 by default, to keep the finished
+    jobs until they are over the maximum) and JOB_REGISTRY_MAX_FINISHED
+    (100000 by default, or 0 to keep all of them).
+    '''
+    return ResultCompactor(pool,
+                           float(os.environ.get('RESULT_COMPACT_INTERVAL', 60)),
+                           float(os.environ.get('JOB_REGISTRY_TTL', 0)),
+                           int(os.environ.get('JOB_REGISTRY_MAX_FINISHED', 100000)),
+                           batches)
@@ -2,45 +2,53 @@
 Module used to define the routes of the webserver and the functions that are
 called when a request is made to a certain route.
 '''
-import os
-import json
-import copy
-from flask import request, jsonify
+import time
+from flask import request, jsonify, Response
 from app import webserver
+from app.scheduler import QueueFull
+from app import metrics
+from app.responses import EncodedResult, encoded_response
+from app.handlers import (parse_id, wait_timeout, client_key, submit_query, submit_batch,
+                          job_result, batch_result, jobs_status, num_jobs_status,
+                          profile_status, profile_configure, reload_dataset,
+                          retention_status, result_status, unknown_batch)
 
-def treat_route(server, req, route):
+def respond(response):
     '''
-    Function used to treat a certain route given as parameter.
-    The given request is parsed and a new job_id is initialised
-    for the new received job. The operations are made as long as
-    the server did not receive the shutdown command(which closes
-    the threadpool). The question, the state(if it exists), the
-    new id, the data_ingestor object from __init__.py(which
-    encapsulates all the data needed to do the computations) and
-    the route name(the one after '/api/') are sent to the threadpool.
-    The job_counter is incremented and the new job_id is returned.
-    If the server is shutting down, an error message is returned.
+    Function used to send back the response of a handler: the bytes of an
+    EncodedResult as they are, compressed if the client accepts it, or any
+    other dictionary through 'jsonify'.
     '''
-    data = req.json
-
-    server.logger.info(f"Received data: {data}")
-
-    job_id = server.job_counter
-
-    if not server.tasks_runner.shutdown.is_set():
-        server.tasks_runner.jobs_queue.put((data["question"],
-                                            data["state"] if "state" in data.keys() else None,
-                                            job_id,
-                                            server.data_ingestor,
-                                            route.split("/")[2]))
-
-        server.job_counter += 1
-
-        server.logger.info(f"Added job with id: job_id_{job_id} to the queue")
+    if isinstance(response, EncodedResult):
+        body, headers = encoded_response(response, request.headers.get('Accept-Encoding'))
+        return Response(body, mimetype='application/json', headers=headers)
+    return jsonify(response)
 
-        return jsonify({"job_id": "job_id_" + str(job_id)})
-
-    return jsonify({"status": "error", "reason": "Server is shutting down"})
+def treat_route(server, req, route):
+    '''
+    Function used to treat a certain route given as parameter.
+    The given request is parsed and a new job is created for it
+    through 'submit_query', with the route name(the one after '/api/')
+    as the command, on the dataset named by the "dataset" field of the
+    body. The new job_id is returned, or an error message if the server
+    is shutting down or the dataset is unknown.
+    '''
+    return jsonify(submit_query(server, req.json, route.split("/")[2],
+                                client_key(req.headers, req.remote_addr)))
+
+@webserver.errorhandler(QueueFull)
+def queue_full(error):
+    '''
+    Method used to answer a request whose job was not admitted by the
+    scheduler, because the queue is full, with the 429 status and the
+    'Retry-After' header.
+    '''
+    response = jsonify({
+        'status': 'error',
+        'reason': 'Server overloaded',
+        'retry_after': error.retry_after
+        })
+    return response, 429, {'Retry-After': str(error.retry_after)}
 
 @webserver.route('/api/post_endpoint', methods=['POST'])
 def post_endpoint():
@@ -64,37 +72,37 @@ def get_response(job_id):
     'job_id_{number}' string and check if this number is smaller
     than the actual job_counter. If it isn't, than the given
     'job_id' is invalid and an error message is returned. If the
-    'job_id' is valid, I check if the file 'results/job_id_{number}.json'
-    exists and its size is different than 0(bigger, more precisely),
-    because this way I can be sure that the task was processed and
-    the computation were done and added to the file(I also check for
-    the size of the file because there is a chance that the file is
-    created but the task is not added in it, and so the thread did not
-    have time to write the results in the file). In a contrary case, I
-    simply return a message saying that the task is still running.
-    '''
-    jid = job_id.split("_")[2]
-    if int(jid) >= webserver.job_counter:
+    'job_id' is valid, its status is taken from the result store of
+    the threadpool through 'job_result': 'done' with the result, an
+    error if the result was evicted, or 'running'. The result is sent as
+    it was serialized by the thread that computed it.
+    With the 'timeout=<seconds>' (or 'wait=true') query parameter, the
+    request blocks until the thread saves the result of the task or the
+    timeout expires, instead of answering 'running' right away. A job that
+    failed or whose result was removed is answered without waiting.
+    '''
+    try:
+        jid = parse_id(job_id)
+    except ValueError:
+        jid = webserver.job_counter
+    if jid >= webserver.job_counter:
         return jsonify({
             'status': 'error',
             'reason': 'Invalid job_id'
             })
 
-    file_name = 'results/job_id_' + jid + '.json'
-    if os.path.exists(file_name) and os.path.getsize(file_name) > 0:
-        try:
-            with open(file_name, 'r', encoding='utf-8') as file:
-                file_data = json.load(file)
-                return jsonify({
-                    'status': 'done',
-                    'data': file_data
-                })
-        except json.JSONDecodeError:
-            return jsonify({'status': 'error'})
-    else:
+    try:
+        timeout = wait_timeout(request.args)
+    except ValueError:
         return jsonify({
-            'status': 'running',
-        })
+            'status': 'error',
+            'reason': 'Invalid timeout'
+            })
+
+    if timeout > 0 and result_status(webserver, jid) == 'running':
+        webserver.tasks_runner.results.wait(jid, timeout)
+
+    return respond(job_result(webserver, jid))
 
 @webserver.route('/api/states_mean', methods=['POST'])
 def states_mean_request():
@@ -159,50 +167,135 @@ def state_mean_by_category_request():
     '''
     return treat_route(webserver, request, "/api/state_mean_by_category")
 
+@webserver.route('/api/batch', methods=['POST'])
+def batch_request():
+    '''
+    Method used to treat the '/api/batch' route, which receives a list of
+    queries under the "queries" key and creates their jobs through
+    'submit_batch'. The new batch_id and the job_ids are returned.
+    '''
+    return jsonify(submit_batch(webserver, request.json,
+                                client_key(request.headers, request.remote_addr)))
+
+@webserver.route('/api/get_batch_results/<batch_id>', methods=['GET'])
+def get_batch_response(batch_id):
+    '''
+    Method used to get the results of all the jobs of a batch through
+    'batch_result'. The 'timeout' and 'wait' query parameters work as for
+    '/api/get_results', with the timeout applied to the whole batch. A
+    batch that is not in the batches gets the response of 'unknown_batch'.
+    '''
+    try:
+        bid = parse_id(batch_id)
+    except ValueError:
+        bid = None
+    job_ids = webserver.batches.get(bid)
+    if job_ids is None:
+        return jsonify(unknown_batch(webserver, bid))
+
+    try:
+        timeout = wait_timeout(request.args)
+    except ValueError:
+        return jsonify({
+            'status': 'error',
+            'reason': 'Invalid timeout'
+            })
+
+    deadline = time.monotonic() + timeout
+    for job_id in job_ids:
+        remaining = deadline - time.monotonic()
+        status = result_status(webserver, job_id)
+        if remaining <= 0 or status not in ('done', 'running'):
+            break
+        if status == 'running':
+            webserver.tasks_runner.results.wait(job_id, remaining)
+
+    return respond(batch_result(webserver, job_ids))
+
 @webserver.route('/api/graceful_shutdown', methods=['GET'])
 def graceful_shutdown():
     '''
-    Method used to shutdown the server gracefully by setting
-    the event from the threadpool.
+    Method used to shutdown the server gracefully by stopping
+    the threadpool, which sets its event and wakes up its threads,
+    the thread that watches the CSV file and the compacting thread.
     '''
-    webserver.tasks_runner.shutdown.set()
+    webserver.tasks_runner.stop()
+    webserver.reloader.stop()
+    webserver.compactor.stop()
     return jsonify({"status": "ok"})
 
 @webserver.route('/api/jobs', methods=['GET'])
 def jobs():
     '''
-    Method used to get the status of all the tasks from the
-    queue. If the server is shutting down and the queue is empty,
-    I return a message saying that there are no jobs. Contrary,
-    I check if the file 'results/job_id_{number}.json' exists and
-    its size is different than 0 and this way I can add a new task
-    to the list.
+    Method used to get the status of the jobs, a page at a time, as
+    computed by 'jobs_status' from the query parameters.
     '''
-    if webserver.tasks_runner.shutdown.is_set() and webserver.tasks_runner.jobs_queue.empty():
-        return jsonify({'status': 'done', 'jobs': []})
-
-    jobs_list = []
-    q = copy.copy(webserver.tasks_runner.jobs_queue)
-    while not q.empty():
-        job = q.get()
-        file_name = 'results/job_id_' + job[2] + '.json'
-        if os.path.exists(file_name) and os.path.getsize(file_name) > 0:
-            jobs_list.append({"job_id_" + job[2]: "done"})
-        else:
-            jobs_list.append({"job_id_" + job[2]: "running"})
-
-    return jsonify({'status': 'done', 'jobs': jobs_list})
+    return jsonify(jobs_status(webserver, request.args))
 
 @webserver.route('/api/num_jobs', methods=['GET'])
 def num_jobs():
     '''
-    Method used to get the number of jobs from the queue. If the server
-    is shutting down(the threadpool actually), the queue size should be 0.
+    Method used to get the number of jobs that are not finished, as
+    computed by 'num_jobs_status'.
+    '''
+    return jsonify(num_jobs_status(webserver))
+
+@webserver.route('/api/query_cache', methods=['GET'])
+def query_cache_stats():
+    '''
+    Method used to get the hit, miss and coalesced counters of the query cache.
+    '''
+    return jsonify(webserver.tasks_runner.query_cache.stats())
+
+@webserver.route('/api/scheduler', methods=['GET'])
+def scheduler_stats():
+    '''
+    Method used to get the queue wait times of each priority class of the
+    scheduler and the cost estimates of the commands.
+    '''
+    return jsonify(webserver.tasks_runner.jobs_queue.stats())
+
+@webserver.route('/api/metrics', methods=['GET'])
+def metrics_request():
+    '''
+    Method used to get the metrics of the webserver in the Prometheus
+    text format.
     '''
-    if webserver.tasks_runner.shutdown.is_set() and webserver.tasks_runner.jobs_queue.empty():
-        return jsonify({'status': 'done', 'num_jobs': 0})
+    return Response(metrics.render(webserver), mimetype=metrics.CONTENT_TYPE)
 
-    return jsonify({'status': 'running', "num_jobs": webserver.tasks_runner.jobs_queue.qsize()})
+@webserver.route('/api/profile', methods=['GET', 'POST'])
+def profile_request():
+    '''
+    Method used to get the profiles of the jobs by command ('GET') or to
+    enable, disable, reset or dump the profiler at runtime ('POST').
+    '''
+    if request.method == 'POST':
+        return jsonify(profile_configure(webserver, request.json))
+    return jsonify(profile_status(webserver, request.args))
+
+@webserver.route('/api/datasets', methods=['GET'])
+def datasets_request():
+    '''
+    Method used to get the registered datasets, which of them are loaded
+    and the memory they take.
+    '''
+    return jsonify(webserver.datasets.stats())
+
+@webserver.route('/api/retention', methods=['GET'])
+def retention_request():
+    '''
+    Method used to get the retention policy of the results and the number
+    of removed results, as computed by 'retention_status'.
+    '''
+    return jsonify(retention_status(webserver))
+
+@webserver.route('/api/reload', methods=['POST'])
+def reload_request():
+    '''
+    Method used to ingest the rows appended to the CSV file, or to load it
+    again, without restarting the server.
+    '''
+    return jsonify(reload_dataset(webserver, request.get_json(silent=True)))
 
 @webserver.route('/')
 @webserver.route('/index')
@@ -0,0 +1,313 @@
+'''
+Module used to decide in which order the TaskRunner threads process the
+tasks received by the webserver, instead of the order in which they arrived.
+'''
+import os
+import math
+import time
+from queue import Full
+from collections import OrderedDict, deque
+from threading import Condition
+from app.metrics import QUEUE_WAIT
+
+PRIORITY_CLASSES = ('interactive', 'standard', 'bulk')
+
+COMMAND_CLASSES = {
+    'state_mean': 'interactive',
+    'state_diff_from_mean': 'interactive',
+    'global_mean': 'interactive',
+    'state_mean_by_category': 'interactive',
+    'best5': 'standard',
+    'worst5': 'standard',
+    'states_mean': 'standard',
+    'diff_from_mean': 'standard',
+    'mean_by_category': 'bulk',
+}
+
+DEFAULT_COSTS = {
+    'state_mean': 0.0001,
+    'state_diff_from_mean': 0.0001,
+    'global_mean': 0.0001,
+    'state_mean_by_category': 0.0005,
+    'best5': 0.0002,
+    'worst5': 0.0002,
+    'states_mean': 0.0002,
+    'diff_from_mean': 0.0005,
+    'mean_by_category': 0.005,
+}
+
+DEFAULT_WEIGHTS = {'interactive': 8, 'standard': 2, 'bulk': 1}
+
+COST_ALPHA = 0.1
+WAIT_SAMPLES = 1024
+DRAIN_WINDOW = 10.0
+MAX_RETRY_AFTER = 60
+
+class QueueFull(Full):
+    '''
+    Exception raised by 'JobScheduler.admit' when a task is rejected, with
+    the number of seconds after which the client should try again.
+    '''
+    def __init__(self, priority_class, retry_after):
+        super().__init__(f"The queue is full for the {priority_class} tasks")
+        self.priority_class = priority_class
+        self.retry_after = retry_after
+
+def parse_weights(value):
+    '''
+    Function used to parse the weights of the priority classes from a
+    string of the form 'interactive=8,standard=2,bulk=1'. The classes that
+    are not given keep their default weight.
+    '''
+    weights = dict(DEFAULT_WEIGHTS)
+    for item in filter(None, value.split(',')):
+        name, weight = item.split('=')
+        if name.strip() not in weights:
+            raise ValueError(f"Unknown priority class: {name}")
+        weights[name.strip()] = float(weight)
+    return weights
+
+class JobScheduler:
+    '''
+    Class used instead of the FIFO queue of the threadpool, with the same
+    'put', 'get', 'empty' and 'qsize' methods. The tasks are split in
+    priority classes: a job, as well as a batch with a single queued job,
+    gets the class of its command from COMMAND_CLASSES, while the other
+    batches are 'bulk'. Inside a class, each client has its own FIFO queue
+    and the clients are served round-robin, so a client that sends many
+    tasks does not delay the others.
+
+    The class of the next task is chosen by stride scheduling: each class
+    has a 'pass' value, the non-empty class with the smallest pass is
+    served and its pass grows by the estimated cost of the task divided by
+    the weight of the class. A class with a larger weight, or with cheaper
+    tasks, is served more often, but no class is starved. The cost of a
+    command starts from DEFAULT_COSTS and follows the time its jobs really
+    take, through 'observe', as an exponential moving average.
+
+    The stop tasks of the threadpool are kept apart and returned only
+    when there are no other tasks, so the received tasks are all processed
+    before the threads stop. The time each task spent in the queue is
+    recorded for its class and reported by 'stats'.
+
+    If 'max_size' is not 0, the webserver calls 'admit' before adding a
+    task and the task is rejected once there are 'max_size' tasks in the
+    queue. The classes from 'shed_classes' are rejected earlier, once the
+    queue reaches 'high_watermark' (a fraction of 'max_size'), so the low
+    priority tasks are shed first. The client is told to retry after the
+    time the threads need to drain the excess tasks, at the rate at which
+    they took tasks from the queue in the last DRAIN_WINDOW seconds.
+    '''
+    def __init__(self, weights=None, max_size=0, high_watermark=1.0, shed_classes=('bulk',)):
+        self.weights = dict(weights or DEFAULT_WEIGHTS)
+        self.costs = dict(DEFAULT_COSTS)
+
+        self.max_size = max_size
+        self.limits = {name: max_size for name in PRIORITY_CLASSES}
+        for name in shed_classes:
+            self.limits[name] = max(1, int(max_size * high_watermark))
+        self.drained = deque()
+        self.rejected = dict.fromkeys(PRIORITY_CLASSES, 0)
+
+        self.classes = {name: OrderedDict() for name in PRIORITY_CLASSES}
+        self.passes = dict.fromkeys(PRIORITY_CLASSES, 0.0)
+        self.virtual_time = 0.0
+        self.size = 0
+        self.stop_tasks = deque()
+        self.condition = Condition()
+
+        self.waits = {name: {'count': 0, 'total': 0.0, 'max': 0.0,
+                             'recent': deque(maxlen=WAIT_SAMPLES)}
+                      for name in PRIORITY_CLASSES}
+
+    def priority_class(self, task):
+        '''
+        Method used to get the priority class of a task, from the command
+        of its only job, or 'bulk' if it has several jobs.
+        '''
+        jobs = task.jobs()
+        if len(jobs) != 1:
+            return 'bulk'
+        return COMMAND_CLASSES.get(jobs[0].command, 'standard')
+
+    def cost(self, task):
+        '''
+        Method used to estimate how many seconds a task takes.
+        '''
+        return sum(self.costs.get(job.command, 0.001) for job in task.jobs())
+
+    def observe(self, command, seconds):
+        '''
+        Method used to update the cost estimate of a command with the time
+        a job really took.
+        '''
+        with self.condition:
+            old = self.costs.get(command, seconds)
+            self.costs[command] = old + COST_ALPHA * (seconds - old)
+
+    def drain_rate(self):
+        '''
+        Method used to get how many tasks per second the threads took from
+        the queue in the last DRAIN_WINDOW seconds. It must be called with
+        the lock held.
+        '''
+        now = time.monotonic()
+        while self.drained and now - self.drained[0] > DRAIN_WINDOW:
+            self.drained.popleft()
+        return len(self.drained) / DRAIN_WINDOW
+
+    def admit(self, task):
+        '''
+        Method used to check if a task can be added in the queue. It raises
+        a QueueFull exception if the queue reached the limit of the class
+        of the task. The limit is checked before the task is added, so a
+        few requests received at the same time can exceed it slightly.
+        '''
+        if not self.max_size:
+            return
+
+        name = self.priority_class(task)
+        with self.condition:
+            excess = self.size - self.limits[name] + 1
+            if excess <= 0:
+                return
+            self.rejected[name] += 1
+            rate = self.drain_rate()
+
+        retry_after = math.ceil(excess / rate) if rate else MAX_RETRY_AFTER
+        raise QueueFull(name, min(max(retry_after, 1), MAX_RETRY_AFTER))
+
+    def put(self, task, stop=False):
+        '''
+        Method used to add a task in the queue of its client, in its class.
+        The stop tasks are added with 'stop' set.
+        '''
+        with self.condition:
+            if stop:
+                self.stop_tasks.append(task)
+            else:
+                name = self.priority_class(task)
+                clients = self.classes[name]
+                if not clients:
+                    self.passes[name] = max(self.passes[name], self.virtual_time)
+                client = getattr(task, 'client', None)
+                clients.setdefault(client, deque()).append((time.monotonic(), task))
+                self.size += 1
+            self.condition.notify()
+
+    def get(self):
+        '''
+        Method used to remove and return the next task, blocking until
+        there is one.
+        '''
+        with self.condition:
+            while not self.size and not self.stop_tasks:
+                self.condition.wait()
+
+            if not self.size:
+                return self.stop_tasks.popleft()
+
+            name = min((name for name in PRIORITY_CLASSES if self.classes[name]),
+                       key=lambda name: self.passes[name])
+            clients = self.classes[name]
+            client, tasks = next(iter(clients.items()))
+            enqueued, task = tasks.popleft()
+            if tasks:
+                clients.move_to_end(client)
+            else:
+                del clients[client]
+            self.size -= 1
+
+            self.virtual_time = self.passes[name]
+            self.passes[name] += self.cost(task) / self.weights[name]
+
+            now = time.monotonic()
+            self.drained.append(now)
+            self.drain_rate()
+
+            wait = now - enqueued
+            stats = self.waits[name]
+            stats['count'] += 1
+            stats['total'] += wait
+            stats['max'] = max(stats['max'], wait)
+            stats['recent'].append(wait)
+
+        for job in task.jobs():
+            QUEUE_WAIT.observe(wait, job.command)
+        return task
+
+    def empty(self):
+        '''
+        Method used to check if there are no tasks in the queue.
+        '''
+        with self.condition:
+            return not self.size and not self.stop_tasks
+
+    def qsize(self):
+        '''
+        Method used to get the number of tasks in the queue, without the
+        stop tasks.
+        '''
+        with self.condition:
+            return self.size
+
+    def tasks(self):
+        '''
+        Method used to get a list of the tasks in the queue, without
+        removing them.
+        '''
+        with self.condition:
+            return [task for clients in self.classes.values()
+                    for tasks in clients.values() for (_, task) in tasks]
+
+    def stats(self):
+        '''
+        Method used to get, for each priority class, the number of queued
+        tasks and the time the processed tasks waited in the queue: the
+        mean and the maximum over all of them and the 50th and the 99th
+        percentiles over the most recent ones. The cost estimates of the
+        commands are returned as well.
+        '''
+        with self.condition:
+            classes = {}
+            for name in PRIORITY_CLASSES:
+                stats = self.waits[name]
+                recent = sorted(stats['recent'])
+                classes[name] = {
+                    'weight': self.weights[name],
+                    'limit': self.limits[name],
+                    'rejected': self.rejected[name],
+                    'queued': sum(len(tasks) for tasks in self.classes[name].values()),
+                    'processed': stats['count'],
+                    'wait_mean': stats['total'] / stats['count'] if stats['count'] else 0.0,
+                    'wait_max': stats['max'],
+                    'wait_p50': recent[len(recent) // 2] if recent else 0.0,
+                    'wait_p99': recent[min(len(recent) - 1, len(recent) * 99 // 100)]
+                                if recent else 0.0,
+                }
+            return {'classes': classes,
+                    'costs': dict(self.costs),
+                    'max_size': self.max_size,
+                    'drain_rate': self.drain_rate()}
+
+def create_scheduler():
+    '''
+    Function used to create the scheduler of the threadpool, configured
+    through the environment variables: SCHEDULER_WEIGHTS (the weights of
+    the priority classes, for example 'interactive=8,standard=2,bulk=1'),
+    SCHEDULER_MAX_QUEUE (the maximum number of queued tasks, 0 for no
+    limit), SCHEDULER_HIGH_WATERMARK (the fraction of the limit from which
+    the tasks of the SCHEDULER_SHED_CLASSES classes are rejected, 1 to
+    reject them only when the queue is full) and SCHEDULER_SHED_CLASSES
+    (a comma separated list, 'bulk' by default).
+    '''
+    shed_classes = [name.strip() for name
+                    in os.environ.get('SCHEDULER_SHED_CLASSES', 'bulk').split(',') if name.strip()]
+    for name in shed_classes:
+        if name not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority class: {name}")
+
+    return JobScheduler(parse_weights(os.environ.get('SCHEDULER_WEIGHTS', '')),
+                        max_size=int(os.environ.get('SCHEDULER_MAX_QUEUE', 0)),
+                        high_watermark=float(os.environ.get('SCHEDULER_HIGH_WATERMARK', 1.0)),
+                        shed_classes=shed_classes)
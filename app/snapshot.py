@@ -0,0 +1,136 @@
+'''
+Module used to save the indexes built by the DataIngestor in a binary
+snapshot and to load them back on the next start, as long as the CSV
+file did not change in the meantime.
+'''
+import os
+import pickle
+import shutil
+import hashlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class Snapshot:
+    '''
+    Class used to manage the snapshot of one CSV file. The snapshot is a
+    directory from 'cache_dir' named after the hash of the absolute path
+    of the CSV file, which contains:
+      * 'key.pickle' - the path, the size, the mtime and the sha256 of the
+        content of the CSV file the snapshot was built from
+      * 'indexes.pickle' - the dictionaries built by the DataIngestor
+      * '<column>.npy' and 'columns.pickle' - the arrays and the labels of
+        the columnar engine, if it was used; the arrays are loaded back as
+        read-only memory-mapped arrays
+    The key of the CSV file is computed when the object is created, before
+    the file is parsed, and a snapshot is used only if its key is the same.
+    The key file is written after the indexes and 'columns.pickle' after
+    the arrays, so an interrupted save is never loaded.
+    '''
+    def __init__(self, csv_path, cache_dir):
+        self.csv_path = os.path.abspath(csv_path)
+        name = hashlib.sha1(self.csv_path.encode('utf-8')).hexdigest()
+        self.directory = os.path.join(cache_dir, name)
+        self.key = self.compute_key()
+
+    def compute_key(self):
+        '''
+        Method used to compute the key of the CSV file.
+        '''
+        stat = os.stat(self.csv_path)
+        content_hash = hashlib.sha256()
+        with open(self.csv_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                content_hash.update(chunk)
+
+        return {'path': self.csv_path,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns,
+                'sha256': content_hash.hexdigest()}
+
+    def path(self, name):
+        '''
+        Method used to get the path of a file from the snapshot directory.
+        '''
+        return os.path.join(self.directory, name)
+
+    def read(self, name):
+        '''
+        Method used to unpickle a file from the snapshot directory. It
+        returns None if the file does not exist or cannot be read.
+        '''
+        try:
+            with open(self.path(name), 'rb') as file:
+                return pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def write(self, name, obj):
+        '''
+        Method used to pickle an object in a file from the snapshot
+        directory, through a temporary file renamed in place at the end.
+        '''
+        with open(self.path(name + '.tmp'), 'wb') as file:
+            pickle.dump(obj, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.path(name + '.tmp'), self.path(name))
+
+    def is_valid(self):
+        '''
+        Method used to check if the snapshot was built from the current
+        content of the CSV file.
+        '''
+        return self.read('key.pickle') == self.key
+
+    def load_indexes(self):
+        '''
+        Method used to load the indexes from the snapshot. It returns None
+        if the snapshot is missing or it was built from another CSV file.
+        '''
+        if not self.is_valid():
+            return None
+        return self.read('indexes.pickle')
+
+    def save_indexes(self, indexes):
+        '''
+        Method used to replace the snapshot with the given indexes.
+        '''
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+
+        self.write('indexes.pickle', indexes)
+        self.write('key.pickle', self.key)
+
+    def load_columns(self):
+        '''
+        Method used to load the columns and the labels of the columnar
+        engine, with the arrays memory-mapped. It returns None if they
+        were not saved for the current CSV file.
+        '''
+        if np is None or not self.is_valid():
+            return None
+
+        labels = self.read('columns.pickle')
+        if labels is None:
+            return None
+
+        columns = {name: np.load(self.path(name + '.npy'), mmap_mode='r')
+                   for name in labels.pop('columns')}
+        return columns, labels
+
+    def save_columns(self, columns, labels):
+        '''
+        Method used to add the columns and the labels of the columnar
+        engine to the snapshot.
+        '''
+        if not self.is_valid():
+            return
+
+        for name, array in columns.items():
+            with open(self.path(name + '.npy.tmp'), 'wb') as file:
+                np.save(file, array)
+            os.replace(self.path(name + '.npy.tmp'), self.path(name + '.npy'))
+
+        self.write('columns.pickle', dict(labels, columns=list(columns)))
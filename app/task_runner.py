@@ -4,10 +4,107 @@ the 'POST' methods. It uses the ThreadPool class to create a pool of threads
 that will process the tasks. The tasks are processed by the TaskRunner class
 in the run method.
 '''
-from queue import Queue
-from threading import Thread, Event
+from threading import Thread, Event, Lock
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, get_all_start_methods
 import os
-import json
+import time
+import logging
+from app.result_store import create_result_store
+from app.query_cache import QueryCache
+from app.job_registry import JobRegistry
+from app.scheduler import create_scheduler
+from app.metrics import JOBS, COMPUTE_TIME, BUSY_WORKERS
+from app.profiler import create_profiler, profile_call
+from app.responses import EncodedResult
+
+EMPTY_NODE = (0, 0, {})
+
+COMMANDS = ('states_mean', 'state_mean', 'best5', 'worst5', 'global_mean',
+            'diff_from_mean', 'state_diff_from_mean', 'mean_by_category',
+            'state_mean_by_category')
+
+class Job:
+    '''
+    Class used to describe a task added in the queue of the threadpool:
+    the id of the job, the command (the route name after '/api/'), the
+    question, the state (None if the command does not use it), the
+    data_ingestor that holds the data needed to do the computations, the
+    key of the client that sent it, used by the scheduler, the 'debug'
+    flag, which asks for the job to be profiled, and the (year_from, year_to)
+    range of the years the query is restricted to, or None for all of them.
+    The jobs wait in the queue in large numbers, so their attributes are
+    kept in slots instead of a dictionary.
+    '''
+    __slots__ = ('job_id', 'command', 'question', 'state', 'data_ingestor', 'client',
+                 'debug', 'years')
+
+    def __init__(self, job_id, command, question, state, data_ingestor, client=None,
+                 debug=False, years=None):
+        self.job_id = job_id
+        self.command = command
+        self.question = question
+        self.state = state
+        self.data_ingestor = data_ingestor
+        self.client = client
+        self.debug = debug
+        self.years = years
+
+    def key(self):
+        '''
+        Method used to get the key of the job in the query cache.
+        '''
+        return QueryCache.key(self.command, self.question, self.state,
+                              self.data_ingestor.version, self.years)
+
+    def jobs(self):
+        '''
+        Method used to get the list of jobs to process for this task.
+        '''
+        return [self]
+
+class Batch:
+    '''
+    Class used to add the jobs of a '/api/batch' request in the queue as a
+    single task. The jobs are processed by the same thread, grouped by
+    question, so the data of a question is used for all its jobs at once.
+    '''
+    def __init__(self, batch_id, jobs, client=None):
+        self.batch_id = batch_id
+        self.batch_jobs = sorted(jobs, key=lambda job: job.question)
+        self.client = client
+
+    def jobs(self):
+        '''
+        Method used to get the list of jobs to process for this task.
+        '''
+        return self.batch_jobs
+
+STOP_TASK = Batch(None, [])
+
+SHARED_DATASETS = {}
+
+def init_worker(datasets):
+    '''
+    Function run in each worker process of the process executor, which
+    keeps the datasets shared by the threadpool, by version. The process
+    is forked, so the datasets are inherited from the webserver process
+    and their pages are shared copy-on-write, not pickled.
+    '''
+    SHARED_DATASETS.update(datasets)
+
+def solve_in_worker(command, question, state, version, years=None):
+    '''
+    Function run in a worker process to solve a command on a shared dataset.
+    '''
+    return TaskRunner(None).solve(command, question, state, SHARED_DATASETS[version], years)
+
+def profile_in_worker(command, question, state, version, years=None):
+    '''
+    Same as 'solve_in_worker', but the command is solved under cProfile and
+    the raw statistics of the profile are returned together with the result.
+    '''
+    return profile_call(solve_in_worker, command, question, state, version, years)
 
 class ThreadPool:
     '''
@@ -15,9 +112,21 @@ class ThreadPool:
     received from the webserver. The number of threads is set by the
     TP_NUM_OF_THREADS environment variable. If it is not set, the number
     of threads will be the number of CPUs available on the computer.
-    The threadpool contains a queue used to store all the received tasks.
+    The threadpool contains a queue used to store all the received tasks,
+    a 'JobScheduler' that decides which task is processed next by its
+    priority class, its cost and its client, and the result store where
+    the threads save the results of the tasks, together with the query
+    cache that memoizes the results of the queries and the 'JobRegistry'
+    that keeps the status of every job.
     It also has an 'Event' used to shutdown the threadpool the moment
     the 'graceful_shutdown' method from the 'routes' module is called.
+    The TP_EXECUTOR environment variable chooses where the jobs are solved:
+    'thread' (the default) solves them in the threads, while 'process'
+    sends them to a pool of 'num_threads' forked worker processes, so the
+    solvers are not limited by the GIL. The datasets used in the process
+    mode must be registered through 'share' before the first job.
+    The 'JobProfiler' of the threadpool profiles the sampled jobs, in the
+    threads or in the worker processes.
     '''
     def __init__(self):
         if 'TP_NUM_OF_THREADS' in os.environ:
@@ -25,11 +134,23 @@ class ThreadPool:
         else:
             self.num_threads = os.cpu_count()
 
-        self.jobs_queue = Queue()
+        self.jobs_queue = create_scheduler()
         self.shutdown = Event()
+        self.results = create_result_store()
+        self.query_cache = QueryCache(int(os.environ.get('QUERY_CACHE_MAX_ENTRIES', 1024)))
+        self.registry = JobRegistry()
+        self.profiler = create_profiler()
+        self.threads = []
+
+        self.executor = os.environ.get('TP_EXECUTOR', 'thread')
+        if self.executor not in ('thread', 'process'):
+            raise ValueError(f"Unknown executor: {self.executor}")
+        if self.executor == 'process' and 'fork' not in get_all_start_methods():
+            raise ValueError("The process executor needs the 'fork' start method")
 
-        if not os.path.exists('results'):
-            os.makedirs('results')
+        self.datasets = {}
+        self.process_pool = None
+        self.process_pool_lock = Lock()
 
     def start(self):
         '''
@@ -37,16 +158,81 @@ class ThreadPool:
         a number of 'num_threads' threads.
         '''
         for _ in range(self.num_threads):
-            TaskRunner(self).start()
+            thread = TaskRunner(self)
+            thread.start()
+            self.threads.append(thread)
+
+    def share(self, data_ingestor):
+        '''
+        Method used to register a dataset that the worker processes can use.
+        The worker processes are forked again, so they also inherit the new
+        dataset, while the jobs already sent to the old ones still finish.
+        In the thread mode nothing has to be done.
+        '''
+        if self.executor != 'process':
+            return
+
+        with self.process_pool_lock:
+            self.datasets[data_ingestor.version] = data_ingestor
+            old_pool = self.process_pool
+            self.process_pool = ProcessPoolExecutor(max_workers=self.num_threads,
+                                                    mp_context=get_context('fork'),
+                                                    initializer=init_worker,
+                                                    initargs=(dict(self.datasets),))
+        if old_pool is not None:
+            old_pool.shutdown(wait=False)
+
+    def forget(self, data_ingestor):
+        '''
+        Method used to remove a dataset that is no longer used from the ones
+        shared with the worker processes, so the next worker processes do
+        not inherit it. The current ones keep it until they are replaced.
+        '''
+        with self.process_pool_lock:
+            self.datasets.pop(data_ingestor.version, None)
+
+    def solve_in_process(self, job):
+        '''
+        Method used to solve a job in one of the worker processes. If the
+        job is profiled, the profile made in the worker process is added
+        to the profiler. A job whose dataset was forgotten in the meantime
+        is solved in the thread, because the worker processes may not have
+        its dataset anymore.
+        '''
+        with self.process_pool_lock:
+            pool = self.process_pool
+            shared = job.data_ingestor.version in self.datasets
+        if not shared:
+            return self.profiler.run(job, TaskRunner(None).solve, job.command, job.question,
+                                     job.state, job.data_ingestor, job.years)
+        args = (job.command, job.question, job.state, job.data_ingestor.version, job.years)
+
+        if not self.profiler.wants(job):
+            return pool.submit(solve_in_worker, *args).result()
+        result, stats = pool.submit(profile_in_worker, *args).result()
+        self.profiler.add(job.command, stats)
+        return result
+
+    def stop(self):
+        '''
+        Method used to shutdown the threadpool. The event is set and a stop
+        task is added in the queue for each thread, after all the received
+        tasks, so every thread wakes up and stops once the tasks are done.
+        '''
+        self.shutdown.set()
+        for _ in range(self.num_threads):
+            self.jobs_queue.put(STOP_TASK, stop=True)
 
     def join(self):
         '''
         Method used to join all the threads the moment
         the threadpool has been shutdown.
         '''
-        if self.shutdown.is_set() and self.jobs_queue.empty():
-            for _ in range(self.num_threads):
-                TaskRunner(self).join()
+        if self.shutdown.is_set():
+            for thread in self.threads:
+                thread.join()
+            if self.process_pool is not None:
+                self.process_pool.shutdown()
 
 class TaskRunner(Thread):
     '''
@@ -58,91 +244,86 @@ class TaskRunner(Thread):
         super().__init__()
         self.thread_pool = pool
 
-    def states_mean_solve(self, question, data):
+    def states_mean_solve(self, question, ranking):
         '''
         Method used to solve the 'states_mean' endpoint. It receives
-        the question and all the necessary data extracted from the csv
-        and computes the mean for each state that has the question.
-        The method returns a sorted dictionary representing the solution.
+        the question and the ranking from the aggregate index built in
+        'data_ingestor.py', where the states of each question are already
+        sorted by their mean. The method returns a sorted dictionary
+        representing the solution.
         '''
-        characteristics = data.items()
-        stats = {state: sum(numbers) / len(numbers)
-                for ((q, state), numbers) in characteristics
-                if q == question and len(numbers) != 0}
-        sorted_stats = sorted(stats.items(), key=lambda x: x[1])
-        return dict(sorted_stats)
+        return dict(ranking.get(question, []))
 
-    def state_mean_solve(self, question, state, data):
+    def state_mean_solve(self, question, state, aggregates):
         '''
         Method used to solve the 'state_mean' endpoint. It receives
-        the question, the state and all the necessary data extracted
-        from the csv and computes the mean for the state that has the
-        question. The method returns a dictionary representing the solution.
+        the question, the state and the aggregate index and returns a
+        dictionary with the precomputed mean of the state for the question.
         '''
-        return {state: sum(data[(question, state)]) / len(data[(question, state)])}
+        return {state: aggregates[(question, state)][2]}
 
-    def best5_solve(self, question, data, min_questions, max_questions):
+    def best5_solve(self, question, ranking, min_questions, max_questions):
         '''
         Method used to solve the 'best5' endpoint. It receives the question,
-        the data and the lists of questions from 'data_ingestor.py' and returns
+        the ranking and the lists of questions from 'data_ingestor.py' and returns
         a dictionary containing the 5 states with the best mean for the question.
         '''
+        states = ranking.get(question, [])
         if question in min_questions:
-            return dict(list(self.states_mean_solve(question, data).items())[:5])
+            return dict(states[:5])
         if question in max_questions:
-            return dict(list(self.states_mean_solve(question, data).items())[-5:])
+            return dict(states[-5:])
+        return None
 
-    def worst5_solve(self, question, data, min_questions, max_questions):
+    def worst5_solve(self, question, ranking, min_questions, max_questions):
         '''
         Same as best5, but returns the 5 states with the worst mean this time.
         '''
+        states = ranking.get(question, [])
         if question in min_questions:
-            return dict(list(self.states_mean_solve(question, data).items())[-5:])
+            return dict(states[-5:])
         if question in max_questions:
-            return dict(list(self.states_mean_solve(question, data).items())[:5])
+            return dict(states[:5])
+        return None
 
-    def global_mean_solve(self, data):
+    def global_mean_solve(self, question, global_means):
         '''
-        Method used to compute the mean of all the values from the data
-        processed in 'data_ingestor.py'.
+        Method used to get the mean of all the values the states have for
+        the given question, as precomputed in 'data_ingestor.py'.
         '''
-        mean = sum([sum(x) for x in data.values()]) / sum([len(x) for x in data.values()])
-        return {"global_mean": mean}
+        return {"global_mean": global_means[question]}
 
-    def diff_from_mean_solve(self, question, data, question_data):
+    def diff_from_mean_solve(self, question, ranking, global_means):
         '''
         Method used to compute the difference between the global mean
         and each state mean for a certain question.
         '''
-        global_mean = self.global_mean_solve(question_data)["global_mean"]
-        return {state: global_mean - self.state_mean_solve(question, state, data)[state]
-                for (q, state) in data.keys() if q == question}
+        global_mean = global_means[question]
+        return {state: global_mean - mean for (state, mean) in ranking[question]}
 
-    def state_diff_from_mean_solve(self, question, data, question_data, state):
+    def state_diff_from_mean_solve(self, question, aggregates, global_means, state):
         '''
         Method used to compute the difference between the global mean
         and the given state mean for a given question.
         '''
-        return {state: self.global_mean_solve(question_data)["global_mean"]
-                - self.state_mean_solve(question, state, data)[state]}
+        return {state: global_means[question]
+                - self.state_mean_solve(question, state, aggregates)[state]}
 
-    def mean_by_category_solve(self, question, category_data):
+    def mean_by_category_solve(self, question, category_cube):
         '''
         Method used to compute the mean for each tuple of the form:
-        (state, category, category_value). The method extracts those
-        tuples from the given data that correspond to the given question
-        and computes the mean for each tuple. It returns the result as
-        a sorted dictionary.
+        (state, category, category_value). The sums and the counts of the
+        tuples are read from the node of the question in the stratification
+        cube built in 'data_ingestor.py', where they are already in the
+        order of the keys of the result, so it needs no sorting.
         '''
-        data_by_category = {x: numbers for (x, numbers) in category_data.items()
-                            if x[0] == question and x[2] != '' and x[3] != ''}
-        result = {str((x[1], x[2], x[3])):
-            sum(data_by_category[x]) / len(data_by_category[x])
-            for x in data_by_category.keys()}
-
-        return dict(sorted(result.items(), key=lambda x: x[0]))
+        _, _, states = category_cube.get(question, EMPTY_NODE)
+        return {str((state, category, category_value)): total / count
+                for (state, (_, _, categories)) in states.items()
+                for (category, (_, _, values)) in categories.items()
+                for (category_value, (total, count)) in values.items()}
 
-    def state_mean_by_category_solve(self, question, category_data, state):
+    def state_mean_by_category_solve(self, question, category_cube, state):
         '''
         Same as the method above but this time the computations are made for
         a certain state and the result is a dictionary with the key being the
@@ -150,72 +331,127 @@ class TaskRunner(Thread):
         characterstics written as tuples and representing the key and the 
         value being the mean for that tuple.
         '''
-        data_by_category = {x: numbers for (x, numbers) in category_data.items()
-                            if x[0] == question and x[1] == state
-                            and x[2] != '' and x[3] != ''}
+        _, _, states = category_cube.get(question, EMPTY_NODE)
+        _, _, categories = states.get(state, EMPTY_NODE)
+        return {state: {str((category, category_value)): total / count
+                        for (category, (_, _, values)) in categories.items()
+                        for (category_value, (total, count)) in values.items()}}
+
+    def solve(self, command, question, state, data_ingestor, years=None):
+        '''
+        Method used to check what function from the ones above should be
+        used, depending on the command received, and to return its result.
+        If the data_ingestor was loaded with the columnar engine, the
+        command is solved by that engine instead. If a (year_from, year_to)
+        range is given, the command is solved on the 'YearSlice' of the
+        question built by the data_ingestor for the range.
+        '''
+        if years is not None:
+            data_ingestor = data_ingestor.year_slice(question, *years)
 
-        result = {str((x[2], x[3])):
-            sum(data_by_category[x]) / len(data_by_category[x])
-            for x in data_by_category.keys()}
+        if data_ingestor.columnar is not None:
+            return data_ingestor.columnar.solve(command, question, state)
 
-        return {state: dict(sorted(result.items(), key=lambda x: x[0]))}
+        if command == 'states_mean':
+            return self.states_mean_solve(question, data_ingestor.ranking)
+        if command == 'state_mean':
+            return self.state_mean_solve(question, state, data_ingestor.aggregates)
+        if command == 'best5':
+            return self.best5_solve(question,
+                                    data_ingestor.ranking,
+                                    data_ingestor.questions_best_is_min,
+                                    data_ingestor.questions_best_is_max)
+        if command == 'worst5':
+            return self.worst5_solve(question,
+                                     data_ingestor.ranking,
+                                     data_ingestor.questions_best_is_min,
+                                     data_ingestor.questions_best_is_max)
+        if command == 'global_mean':
+            return self.global_mean_solve(question, data_ingestor.global_means)
+        if command == 'diff_from_mean':
+            return self.diff_from_mean_solve(question,
+                                             data_ingestor.ranking,
+                                             data_ingestor.global_means)
+        if command == 'state_diff_from_mean':
+            return self.state_diff_from_mean_solve(question,
+                                                   data_ingestor.aggregates,
+                                                   data_ingestor.global_means,
+                                                   state)
+        if command == 'mean_by_category':
+            return self.mean_by_category_solve(question, data_ingestor.category_cube)
+        if command == 'state_mean_by_category':
+            return self.state_mean_by_category_solve(question,
+                                                     data_ingestor.category_cube,
+                                                     state)
+        return None
 
     def run(self):
         '''
         Method used to process all the tasks received from the webserver.
         In an infinite loop it first checks if the threadpool has been
         shutdown through the 'graceful_shutdown' method and all the tasks
-        have been processed(to break the loop and close the threadpool).
-        If there are more jobs to process, they are retrieved and checked
-        to see what function from the ones above should be used, depending
-        on the command received. The result is written in a file.
+        have been processed(to break the loop and close the threadpool),
+        or if it received the stop task added by the 'stop' method.
+        If there are more tasks to process, they are retrieved and each job
+        of the task (a single one, or all the jobs of a batch) is processed,
+        while the thread is counted as busy in the metrics.
         '''
         while True:
             if self.thread_pool.shutdown.is_set() and self.thread_pool.jobs_queue.empty():
                 break
 
-            (question, state, job_id, data_ingestor, command) = self.thread_pool.jobs_queue.get()
-            if command == 'states_mean':
-                with open('results/job_id_' + str(job_id) + '.json', 'w', encoding='utf-8') as file:
-                    json.dump(self.states_mean_solve(question,
-                                                    data_ingestor.data), file)
-            elif command == 'state_mean':
-                with open('results/job_id_' + str(job_id) + '.json', 'w', encoding='utf-8') as file:
-                    json.dump(self.state_mean_solve(question,
-                                                    state,
-                                                    data_ingestor.data), file)
-            elif command == 'best5':
-                with open('results/job_id_' + str(job_id) + '.json', 'w', encoding='utf-8') as file:
-                    json.dump(self.best5_solve(question,
-                                            data_ingestor.data,
-                                            data_ingestor.questions_best_is_min,
-                                            data_ingestor.questions_best_is_max), file)
-            elif command == 'worst5':
-                with open('results/job_id_' + str(job_id) + '.json', 'w', encoding='utf-8') as file:
-                    json.dump(self.worst5_solve(question,
-                                                data_ingestor.data,
-                                                data_ingestor.questions_best_is_min,
-                                                data_ingestor.questions_best_is_max), file)
-            elif command == 'global_mean':
-                with open('results/job_id_' + str(job_id) + '.json', 'w', encoding='utf-8') as file:
-                    json.dump(self.global_mean_solve(data_ingestor.helper(question)), file)
-            elif command == 'diff_from_mean':
-                with open('results/job_id_' + str(job_id) + '.json', 'w', encoding='utf-8') as file:
-                    json.dump(self.diff_from_mean_solve(question,
-                                                        data_ingestor.data,
-                                                        data_ingestor.helper(question)), file)
-            elif command == 'state_diff_from_mean':
-                with open('results/job_id_' + str(job_id) + '.json', 'w', encoding='utf-8') as file:
-                    json.dump(self.state_diff_from_mean_solve(question,
-                                                            data_ingestor.data,
-                                                            data_ingestor.helper(question),
-                                                            state), file)
-            elif command == 'mean_by_category':
-                with open('results/job_id_' + str(job_id) + '.json', 'w', encoding='utf-8') as file:
-                    json.dump(self.mean_by_category_solve(question,
-                                                        data_ingestor.data_by_category), file)
-            elif command == 'state_mean_by_category':
-                with open('results/job_id_' + str(job_id) + '.json', 'w', encoding='utf-8') as file:
-                    json.dump(self.state_mean_by_category_solve(question,
-                                                                data_ingestor.data_by_category,
-                                                                state), file)
+            task = self.thread_pool.jobs_queue.get()
+            if task is STOP_TASK:
+                break
+
+            BUSY_WORKERS.inc()
+            try:
+                for job in task.jobs():
+                    self.process(job)
+            finally:
+                BUSY_WORKERS.dec()
+
+    def process(self, job):
+        '''
+        Method used to solve a job and save its result in the query cache
+        and in the result store of the threadpool, for the job and for all
+        the identical jobs that were attached to it while it was running.
+        The result is serialized once, here, and the same EncodedResult is
+        saved for all of them.
+        If the job fails, the error is logged, the clients waiting for the
+        job and for the attached ones are woken up and the thread goes on
+        with the next job, so the other jobs of a batch are still processed.
+        The status of the job and of the attached ones is kept up to date
+        in the job registry, and a job is marked as 'done' only after its
+        result is in the result store.
+        The time the job took is sent to the scheduler, as the cost of
+        its command, and recorded in the metrics. The job is solved through
+        the profiler, which profiles it if it was sampled.
+        '''
+        key = job.key()
+        registry = self.thread_pool.registry
+        registry.set_status(job.job_id, 'running')
+        try:
+            start = time.perf_counter()
+            if self.thread_pool.process_pool is not None:
+                result = self.thread_pool.solve_in_process(job)
+            else:
+                result = self.thread_pool.profiler.run(job, self.solve, job.command,
+                                                       job.question, job.state,
+                                                       job.data_ingestor, job.years)
+            elapsed = time.perf_counter() - start
+            self.thread_pool.jobs_queue.observe(job.command, elapsed)
+            COMPUTE_TIME.observe(elapsed, job.command)
+            encoded = EncodedResult.encode(result)
+        except Exception: # pylint: disable=broad-exception-caught
+            JOBS.inc(job.command, 'failed')
+            for job_id in [job.job_id] + self.thread_pool.query_cache.fail(key):
+                registry.set_status(job_id, 'failed')
+                self.thread_pool.results.notify(job_id)
+            logging.getLogger('webserver.log').exception(f"Job job_id_{job.job_id} failed")
+            return
+
+        JOBS.inc(job.command, 'done')
+        for job_id in [job.job_id] + self.thread_pool.query_cache.complete(key, encoded):
+            self.thread_pool.results.put(job_id, encoded)
+            registry.set_status(job_id, 'done')
@@ -0,0 +1,49 @@
+'''
+Module with the helpers shared by the benchmark scripts.
+'''
+import os
+import sys
+import time
+import types
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CSV = os.path.join(ROOT_DIR, 'nutrition_activity_obesity_usa_subset.csv')
+
+COMMANDS = ['states_mean', 'state_mean', 'best5', 'worst5', 'global_mean',
+            'diff_from_mean', 'state_diff_from_mean', 'mean_by_category',
+            'state_mean_by_category']
+
+STATE_COMMANDS = ['state_mean', 'state_diff_from_mean', 'state_mean_by_category']
+
+def load_app():
+    '''
+    Method used to make the modules from the 'app' package importable without
+    running 'app/__init__.py', which would start the webserver and its threadpool.
+    '''
+    if 'app' not in sys.modules:
+        package = types.ModuleType('app')
+        package.__path__ = [os.path.join(ROOT_DIR, 'app')]
+        sys.modules['app'] = package
+
+def queries(data_ingestor):
+    '''
+    Method used to build every (command, question, state) query that can be
+    answered from the given data_ingestor.
+    '''
+    result = []
+    for command in COMMANDS:
+        for question, states in data_ingestor.data_by_question.items():
+            if command in STATE_COMMANDS:
+                result.extend((command, question, state) for state in states)
+            else:
+                result.append((command, question, None))
+    return result
+
+def timed(function, *args):
+    '''
+    Method used to call the given function and return its result together
+    with the elapsed time in seconds.
+    '''
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
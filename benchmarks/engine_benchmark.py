@@ -0,0 +1,58 @@
+'''
+Benchmark comparing the 'dict' and the 'columnar' data engines. For each
+engine it measures the time needed to load the CSV file and the mean time
+needed to solve each command over every question (and every state, for the
+commands that receive one).
+
+Usage: python benchmarks/engine_benchmark.py [csv_path] [repeat]
+'''
+import sys
+import json
+
+from common import DEFAULT_CSV, COMMANDS, load_app, queries, timed
+
+load_app()
+
+# pylint: disable=wrong-import-position
+from app.data_ingestor import DataIngestor
+from app.task_runner import TaskRunner
+
+def bench_engine(csv_path, engine, repeat):
+    '''
+    Method used to measure the load time and the time per query of an engine.
+    '''
+    data_ingestor, load_time = timed(DataIngestor, csv_path, engine)
+    task_runner = TaskRunner(None)
+    all_queries = queries(data_ingestor)
+
+    per_command = {}
+    for command in COMMANDS:
+        command_queries = [query for query in all_queries if query[0] == command]
+        _, elapsed = timed(lambda cq=command_queries: [
+            task_runner.solve(c, q, s, data_ingestor) for _ in range(repeat) for (c, q, s) in cq])
+        per_command[command] = elapsed / (repeat * max(len(command_queries), 1))
+
+    return {'load_seconds': load_time, 'seconds_per_query': per_command}
+
+def main():
+    '''
+    Method used to run the benchmark for both engines and print the results.
+    '''
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CSV
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    results = {engine: bench_engine(csv_path, engine, repeat) for engine in ('dict', 'columnar')}
+
+    print(f"{'':24}{'dict':>14}{'columnar':>14}{'speedup':>10}")
+    print(f"{'load':24}{results['dict']['load_seconds']:>13.4f}s"
+          f"{results['columnar']['load_seconds']:>13.4f}s")
+    for command in COMMANDS:
+        dict_time = results['dict']['seconds_per_query'][command]
+        columnar_time = results['columnar']['seconds_per_query'][command]
+        print(f"{command:24}{dict_time * 1e6:>12.1f}us{columnar_time * 1e6:>12.1f}us"
+              f"{dict_time / columnar_time:>9.2f}x")
+
+    print(json.dumps(results))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+'''
+Benchmark comparing the throughput of the 'thread' and the 'process'
+executors of the ThreadPool. The same jobs, cycling through every query
+that can be answered from the dataset, are added in the queue of a
+ThreadPool started in each mode and the time until all their results are
+saved is measured. The query cache is disabled, so every job is solved.
+
+Usage: python benchmarks/executor_benchmark.py [csv_path] [jobs] [workers] [commands]
+where 'commands' is a comma separated list of commands (all by default).
+'''
+import os
+import sys
+import json
+from itertools import cycle, islice
+
+from common import DEFAULT_CSV, COMMANDS, load_app, queries, timed
+
+load_app()
+
+# pylint: disable=wrong-import-position
+from app.data_ingestor import DataIngestor
+from app.task_runner import ThreadPool, Job
+
+def bench_executor(executor, data_ingestor, jobs_queries, workers):
+    '''
+    Method used to measure the number of jobs per second solved by a
+    ThreadPool using the given executor.
+    '''
+    os.environ.update({'TP_EXECUTOR': executor,
+                       'TP_NUM_OF_THREADS': str(workers),
+                       'QUERY_CACHE_MAX_ENTRIES': '0',
+                       'RESULT_STORE': 'memory',
+                       'RESULT_STORE_MAX_ENTRIES': str(len(jobs_queries))})
+    pool = ThreadPool()
+    pool.share(data_ingestor)
+    pool.start()
+
+    def run():
+        for job_id, (command, question, state) in enumerate(jobs_queries):
+            pool.jobs_queue.put(Job(job_id, command, question, state, data_ingestor))
+        for job_id in range(len(jobs_queries)):
+            pool.results.wait(job_id, None)
+
+    _, elapsed = timed(run)
+    pool.stop()
+    pool.join()
+    return {'seconds': elapsed, 'jobs_per_second': len(jobs_queries) / elapsed}
+
+def main():
+    '''
+    Method used to run the benchmark for both executors and print the results.
+    '''
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CSV
+    num_jobs = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+    commands = sys.argv[4].split(',') if len(sys.argv) > 4 else COMMANDS
+
+    data_ingestor = DataIngestor(csv_path)
+    all_queries = [query for query in queries(data_ingestor) if query[0] in commands]
+    jobs_queries = list(islice(cycle(all_queries), num_jobs))
+
+    results = {executor: bench_executor(executor, data_ingestor, jobs_queries, workers)
+               for executor in ('thread', 'process')}
+
+    print(f"{num_jobs} jobs, {workers} workers")
+    for executor, result in results.items():
+        print(f"{executor:8}{result['jobs_per_second']:>12.1f} jobs/s{result['seconds']:>10.3f}s")
+    print(json.dumps(results))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+'''
+Generator of synthetic datasets with the schema of
+'nutrition_activity_obesity_usa_subset.csv': the same 34 columns, the same
+questions, states and stratification categories, with random values. The
+size is given as a scale of BASE_ROWS, about the number of rows of the
+subset, and the same seed always gives the same file.
+
+The values of each (question, state) pair are drawn around a mean chosen
+for the pair, and each stratification value shifts them a little, so the
+means computed by the webserver differ between the states and the
+categories as in the real data. A small fraction of the rows have no value,
+as the rows with an insufficient sample size of the real data.
+
+Usage: python benchmarks/generate_dataset.py output_csv [scale] [seed]
+'''
+import sys
+import csv
+import random
+
+BASE_ROWS = 18650
+
+HEADER = ['', 'YearStart', 'YearEnd', 'LocationAbbr', 'LocationDesc', 'Datasource', 'Class',
+          'Topic', 'Question', 'Data_Value_Unit', 'Data_Value_Type', 'Data_Value',
+          'Data_Value_Alt', 'Data_Value_Footnote_Symbol', 'Data_Value_Footnote',
+          'Low_Confidence_Limit', 'High_Confidence_Limit ', 'Sample_Size', 'Total',
+          'Age(years)', 'Education', 'Gender', 'Income', 'Race/Ethnicity', 'GeoLocation',
+          'ClassID', 'TopicID', 'QuestionID', 'DataValueTypeID', 'LocationID',
+          'StratificationCategory1', 'Stratification1', 'StratificationCategoryId1',
+          'StratificationID1']
+
+OBESITY = ('Obesity / Weight Status', 'Obesity / Weight Status', 'OWS', 'OWS1')
+ACTIVITY = ('Physical Activity', 'Physical Activity - Behavior', 'PA', 'PA1')
+FRUITS = ('Fruits and Vegetables', 'Fruits and Vegetables - Behavior', 'FV', 'FV1')
+
+# (question, question id, (class, topic, class id, topic id), typical mean)
+QUESTIONS = [
+    ('Percent of adults aged 18 years and older who have obesity', 'Q036', OBESITY, 30),
+    ('Percent of adults aged 18 years and older who have an overweight classification',
+     'Q037', OBESITY, 35),
+    ('Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic '
+     'physical activity or 75 minutes a week of vigorous-intensity aerobic activity (or an '
+     'equivalent combination)', 'Q043', ACTIVITY, 50),
+    ('Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic '
+     'physical activity or 75 minutes a week of vigorous-intensity aerobic physical activity '
+     'and engage in muscle-strengthening activities on 2 or more days a week', 'Q044',
+     ACTIVITY, 20),
+    ('Percent of adults who achieve at least 300 minutes a week of moderate-intensity aerobic '
+     'physical activity or 150 minutes a week of vigorous-intensity aerobic activity (or an '
+     'equivalent combination)', 'Q045', ACTIVITY, 33),
+    ('Percent of adults who engage in muscle-strengthening activities on 2 or more days a week',
+     'Q046', ACTIVITY, 30),
+    ('Percent of adults who engage in no leisure-time physical activity', 'Q047', ACTIVITY, 25),
+    ('Percent of adults who report consuming fruit less than one time daily', 'Q018',
+     FRUITS, 38),
+    ('Percent of adults who report consuming vegetables less than one time daily', 'Q019',
+     FRUITS, 20),
+]
+
+# (abbreviation, name, location id)
+STATES = [
+    ('AL', 'Alabama', '01'), ('AK', 'Alaska', '02'), ('AZ', 'Arizona', '04'),
+    ('AR', 'Arkansas', '05'), ('CA', 'California', '06'), ('CO', 'Colorado', '08'),
+    ('CT', 'Connecticut', '09'), ('DE', 'Delaware', '10'),
+    ('DC', 'District of Columbia', '11'), ('FL', 'Florida', '12'), ('GA', 'Georgia', '13'),
+    ('HI', 'Hawaii', '15'), ('ID', 'Idaho', '16'), ('IL', 'Illinois', '17'),
+    ('IN', 'Indiana', '18'), ('IA', 'Iowa', '19'), ('KS', 'Kansas', '20'),
+    ('KY', 'Kentucky', '21'), ('LA', 'Louisiana', '22'), ('ME', 'Maine', '23'),
+    ('MD', 'Maryland', '24'), ('MA', 'Massachusetts', '25'), ('MI', 'Michigan', '26'),
+    ('MN', 'Minnesota', '27'), ('MS', 'Mississippi', '28'), ('MO', 'Missouri', '29'),
+    ('MT', 'Montana', '30'), ('NE', 'Nebraska', '31'), ('NV', 'Nevada', '32'),
+    ('NH', 'New Hampshire', '33'), ('NJ', 'New Jersey', '34'), ('NM', 'New Mexico', '35'),
+    ('NY', 'New York', '36'), ('NC', 'North Carolina', '37'), ('ND', 'North Dakota', '38'),
+    ('OH', 'Ohio', '39'), ('OK', 'Oklahoma', '40'), ('OR', 'Oregon', '41'),
+    ('PA', 'Pennsylvania', '42'), ('RI', 'Rhode Island', '44'),
+    ('SC', 'South Carolina', '45'), ('SD', 'South Dakota', '46'), ('TN', 'Tennessee', '47'),
+    ('TX', 'Texas', '48'), ('UT', 'Utah', '49'), ('VT', 'Vermont', '50'),
+    ('VA', 'Virginia', '51'), ('WA', 'Washington', '53'), ('WV', 'West Virginia', '54'),
+    ('WI', 'Wisconsin', '55'), ('WY', 'Wyoming', '56'), ('GU', 'Guam', '66'),
+    ('PR', 'Puerto Rico', '72'), ('VI', 'Virgin Islands', '78'),
+    ('US', 'National', '59'),
+]
+
+# category -> (category id, column of the value, [(value, value id)])
+STRATIFICATIONS = {
+    'Total': ('OVR', 'Total', [('Total', 'OVERALL')]),
+    'Age (years)': ('AGEYR', 'Age(years)', [
+        ('18 - 24', 'AGEYR1824'), ('25 - 34', 'AGEYR2534'), ('35 - 44', 'AGEYR3544'),
+        ('45 - 54', 'AGEYR4554'), ('55 - 64', 'AGEYR5564'), ('65 or older', 'AGEYR65PLUS')]),
+    'Education': ('EDU', 'Education', [
+        ('Less than high school', 'EDUHS'), ('High school graduate', 'EDUHSGRAD'),
+        ('Some college or technical school', 'EDUCOTEC'), ('College graduate', 'EDUCOGRAD')]),
+    'Gender': ('GEN', 'Gender', [('Male', 'MALE'), ('Female', 'FEMALE')]),
+    'Income': ('INC', 'Income', [
+        ('Less than $15,000', 'INCLESS15'), ('$15,000 - $24,999', 'INC1525'),
+        ('$25,000 - $34,999', 'INC2535'), ('$35,000 - $49,999', 'INC3550'),
+        ('$50,000 - $74,999', 'INC5075'), ('$75,000 or greater', 'INC75PLUS'),
+        ('Data not reported', 'INCNR')]),
+    'Race/Ethnicity': ('RACE', 'Race/Ethnicity', [
+        ('Non-Hispanic White', 'RACEWHT'), ('Non-Hispanic Black', 'RACEBLK'),
+        ('Hispanic', 'RACEHIS'), ('Asian', 'RACEASN'),
+        ('Hawaiian/Pacific Islander', 'RACEHPI'),
+        ('American Indian/Alaska Native', 'RACENAA'), ('2 or more races', 'RACE2PLUS'),
+        ('Other', 'RACEOTH')]),
+}
+
+YEARS = range(2011, 2023)
+
+MISSING_FRACTION = 0.02
+
+def build_row(rng, index, means, locations, strata):
+    '''
+    Method used to build a random row, with the given index, from the means
+    of the (question, state) pairs, the locations of the states and the list
+    of stratifications with their shifts.
+    '''
+    question, question_id, (class_name, topic, class_id, topic_id), _ = rng.choice(QUESTIONS)
+    abbr, state, location_id = rng.choice(STATES)
+    category, category_id, column, value, value_id, shift = rng.choice(strata)
+
+    row = [''] * len(HEADER)
+    row[0] = index
+    row[1] = row[2] = rng.choice(YEARS)
+    row[3], row[4], row[29] = abbr, state, location_id
+    row[5] = 'Behavioral Risk Factor Surveillance System'
+    row[6], row[7], row[8] = class_name, topic, question
+    row[10], row[28] = 'Value', 'VALUE'
+    row[24] = locations[state]
+    row[25], row[26], row[27] = class_id, topic_id, question_id
+    row[30], row[31], row[32], row[33] = category, value, category_id, value_id
+    row[HEADER.index(column)] = value
+
+    if rng.random() < MISSING_FRACTION:
+        row[13] = '~'
+        row[14] = 'Data not available because sample size is insufficient.'
+    else:
+        data_value = round(min(max(rng.gauss(means[(question, state)] + shift, 4), 0.5), 99.5), 1)
+        margin = round(rng.uniform(1, 6), 1)
+        row[11] = row[12] = data_value
+        row[15] = round(max(data_value - margin, 0.0), 1)
+        row[16] = round(min(data_value + margin, 100.0), 1)
+        row[17] = float(rng.randint(50, 5000))
+    return row
+
+def generate(path, scale=1, seed=0):
+    '''
+    Method used to write a synthetic dataset of 'scale' * BASE_ROWS rows in
+    the given file. It returns the number of rows.
+    '''
+    rng = random.Random(seed)
+    rows = int(BASE_ROWS * scale)
+
+    means = {(question[0], state[1]): question[3] + rng.uniform(-8, 8)
+             for question in QUESTIONS for state in STATES}
+    locations = {state[1]: f"({rng.uniform(20, 60):.9f}, {rng.uniform(-160, -65):.9f})"
+                 for state in STATES}
+    strata = [(category, category_id, column, value, value_id, rng.uniform(-5, 5))
+              for (category, (category_id, column, values)) in STRATIFICATIONS.items()
+              for (value, value_id) in values]
+
+    with open(path, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(HEADER)
+        for index in range(rows):
+            writer.writerow(build_row(rng, index, means, locations, strata))
+    return rows
+
+def main():
+    '''
+    Method used to generate a dataset from the command line arguments.
+    '''
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    path = sys.argv[1]
+    scale = float(sys.argv[2]) if len(sys.argv) > 2 else 1
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    rows = generate(path, scale, seed)
+    print(f"Wrote {rows} rows to {path}")
+
+if __name__ == '__main__':
+    main()
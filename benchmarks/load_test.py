@@ -0,0 +1,262 @@
+'''
+Load generator for a running webserver. It replays the checker inputs from
+'tests/<endpoint>/input/in-N.json' with a number of concurrent clients, each
+sending a query, waiting for its result and going on with the next one,
+and reports the throughput and the end-to-end latency (from the POST
+request until the result is received) as JSON, so the runs of different
+commits can be compared.
+
+The results are fetched through the long-poll mode of '/api/get_results'
+('?timeout=<seconds>'), or by polling every '--poll-interval' seconds if
+it is given. A query is counted as:
+  * an error, if a request fails, does not return 200 or 429, or the
+    result has the 'error' status
+  * rejected, if the webserver answers 429 (admission control)
+  * a timeout, if its result is not done after '--timeout' seconds
+
+Usage: python benchmarks/load_test.py [--url URL] [--concurrency N]
+       [--requests N | --duration SECONDS] [--mix best5=1,state_mean=4]
+       [--timeout SECONDS] [--poll-interval SECONDS] [--output FILE]
+'''
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from glob import glob
+
+import requests
+
+from common import ROOT_DIR, COMMANDS
+
+def load_inputs(tests_dir, commands):
+    '''
+    Method used to read the inputs of the checker for the given commands.
+    '''
+    inputs = {}
+    for command in commands:
+        paths = sorted(glob(os.path.join(tests_dir, command, 'input', 'in-*.json')))
+        if not paths:
+            raise ValueError(f"No inputs for {command} in {tests_dir}")
+        inputs[command] = []
+        for path in paths:
+            with open(path, 'r', encoding='utf-8') as file:
+                inputs[command].append(json.load(file))
+    return inputs
+
+def parse_mix(value):
+    '''
+    Method used to parse the request mix, of the form 'best5=1,state_mean=4',
+    in a dictionary of weights. Every command has the weight 1 by default.
+    '''
+    if not value:
+        return dict.fromkeys(COMMANDS, 1.0)
+
+    mix = {}
+    for item in value.split(','):
+        command, _, weight = item.partition('=')
+        if command not in COMMANDS:
+            raise ValueError(f"Unknown command: {command}")
+        mix[command] = float(weight or 1)
+    return mix
+
+def percentile(values, fraction):
+    '''
+    Method used to get a percentile from a sorted list of values.
+    '''
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class LoadTest:
+    '''
+    Class used to run the load test. Each client is a thread with its own
+    HTTP session, which takes queries until the number of requests is
+    reached or the duration expired, and records the outcome and the
+    latency of each query.
+    '''
+    def __init__(self, args, inputs):
+        self.args = args
+        self.inputs = inputs
+        self.commands = list(args.mix)
+        self.weights = [args.mix[command] for command in self.commands]
+
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.records = []
+        self.deadline = None
+
+    def next_query(self, rng):
+        '''
+        Method used to choose the next query, or None if the test is over.
+        '''
+        with self.lock:
+            if self.args.requests and self.sent >= self.args.requests:
+                return None
+            if self.deadline is not None and time.monotonic() >= self.deadline:
+                return None
+            self.sent += 1
+        command = rng.choices(self.commands, self.weights)[0]
+        return command, rng.choice(self.inputs[command])
+
+    def fetch_result(self, session, job_id, deadline):
+        '''
+        Method used to wait for the result of a job. It returns its final
+        status: 'done', 'error' or 'timeout'.
+        '''
+        url = f"{self.args.url}/api/get_results/{job_id}"
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return 'timeout'
+
+            if self.args.poll_interval:
+                response = session.get(url, timeout=self.args.timeout)
+            else:
+                response = session.get(url, params={'timeout': f"{remaining:.3f}"},
+                                       timeout=remaining + self.args.timeout)
+            if response.status_code != 200:
+                return 'error'
+
+            status = response.json().get('status')
+            if status != 'running':
+                return 'done' if status == 'done' else 'error'
+            if self.args.poll_interval:
+                time.sleep(min(self.args.poll_interval, max(remaining, 0)))
+
+    def run_query(self, session, command, body):
+        '''
+        Method used to send a query and wait for its result. It returns the
+        outcome of the query.
+        '''
+        start = time.monotonic()
+        deadline = start + self.args.timeout
+        try:
+            response = session.post(f"{self.args.url}/api/{command}", json=body,
+                                    timeout=self.args.timeout)
+            if response.status_code == 429:
+                return 'rejected'
+            job_id = response.json().get('job_id') if response.status_code == 200 else None
+            if job_id is None:
+                return 'error'
+            return self.fetch_result(session, job_id, deadline)
+        except (requests.RequestException, ValueError):
+            return 'error'
+
+    def client(self, seed):
+        '''
+        Method run by each client thread.
+        '''
+        rng = random.Random(seed)
+        session = requests.Session()
+        records = []
+        while True:
+            query = self.next_query(rng)
+            if query is None:
+                break
+            start = time.monotonic()
+            outcome = self.run_query(session, *query)
+            records.append((query[0], outcome, time.monotonic() - start))
+        with self.lock:
+            self.records.extend(records)
+
+    def run(self):
+        '''
+        Method used to run the clients and to build the report.
+        '''
+        start = time.monotonic()
+        if self.args.duration:
+            self.deadline = start + self.args.duration
+
+        threads = [threading.Thread(target=self.client, args=(self.args.seed + i,))
+                   for i in range(self.args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return self.report(time.monotonic() - start)
+
+    def report(self, elapsed):
+        '''
+        Method used to build the report, for all the queries and for each
+        command: the number of queries, the completed ones per second, the
+        latency percentiles of the completed queries, in seconds, and the
+        rates of the errors, of the rejected queries and of the timeouts.
+        '''
+        def summary(records):
+            total = len(records)
+            latencies = sorted(latency for (_, outcome, latency) in records
+                               if outcome == 'done')
+            outcomes = [outcome for (_, outcome, _) in records]
+            return {
+                'requests': total,
+                'completed': len(latencies),
+                'requests_per_second': len(latencies) / elapsed if elapsed else 0.0,
+                'latency_p50': percentile(latencies, 0.50),
+                'latency_p95': percentile(latencies, 0.95),
+                'latency_p99': percentile(latencies, 0.99),
+                'latency_max': latencies[-1] if latencies else None,
+                'error_rate': outcomes.count('error') / total if total else 0.0,
+                'rejected_rate': outcomes.count('rejected') / total if total else 0.0,
+                'timeout_rate': outcomes.count('timeout') / total if total else 0.0,
+            }
+
+        return {
+            'config': {
+                'url': self.args.url,
+                'concurrency': self.args.concurrency,
+                'requests': self.args.requests,
+                'duration': self.args.duration,
+                'mix': self.args.mix,
+                'timeout': self.args.timeout,
+                'poll_interval': self.args.poll_interval,
+                'seed': self.args.seed,
+            },
+            'elapsed': elapsed,
+            'total': summary(self.records),
+            'commands': {command: summary([record for record in self.records
+                                           if record[0] == command])
+                         for command in self.commands},
+        }
+
+def main():
+    '''
+    Method used to parse the arguments, run the load test and print the report.
+    '''
+    parser = argparse.ArgumentParser(description='Load test a running webserver.')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=0,
+                        help='number of queries to send (default 1000 without --duration)')
+    parser.add_argument('--duration', type=float, default=0,
+                        help='seconds to send queries for, instead of a number of queries')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(''),
+                        help="weights of the commands, e.g. 'best5=1,state_mean=4'")
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help='seconds after which a query is counted as a timeout')
+    parser.add_argument('--poll-interval', type=float, default=0,
+                        help='poll every N seconds instead of using the long-poll mode')
+    parser.add_argument('--tests-dir', default=os.path.join(ROOT_DIR, 'tests'))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file where the JSON report is also written')
+    args = parser.parse_args()
+
+    if not args.requests and not args.duration:
+        args.requests = 1000
+
+    report = LoadTest(args, load_inputs(args.tests_dir, list(args.mix))).run()
+
+    total = report['total']
+    print(f"{total['requests']} queries, {args.concurrency} clients, "
+          f"{total['requests_per_second']:.1f} req/s, "
+          f"p50 {total['latency_p50']}, p99 {total['latency_p99']}", file=sys.stderr)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+'''
+Benchmark measuring the peak RSS of the process while the DataIngestor
+loads CSV files of growing size. The files are built by repeating the data
+rows of the given CSV file and each one is loaded in a separate process,
+so the peak of a run is not hidden by the previous ones.
+
+Usage: python benchmarks/memory_benchmark.py [csv_path] [max_scale]
+'''
+import os
+import sys
+import json
+import resource
+import subprocess
+import tempfile
+
+from common import DEFAULT_CSV, load_app, timed
+
+def scaled_csv(csv_path, scale, directory):
+    '''
+    Method used to write a CSV file with the header of the given one and
+    its data rows repeated 'scale' times.
+    '''
+    path = os.path.join(directory, f'scale-{scale}.csv')
+    with open(csv_path, 'r', encoding='utf-8') as source:
+        header = source.readline()
+        rows = source.read()
+    if not rows.endswith('\n'):
+        rows += '\n'
+
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(header)
+        for _ in range(scale):
+            file.write(rows)
+    return path
+
+def measure(csv_path):
+    '''
+    Method run in the child process, which loads the given file and prints
+    the load time and the peak RSS in kilobytes.
+    '''
+    load_app()
+    from app.data_ingestor import DataIngestor # pylint: disable=import-outside-toplevel
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    _, elapsed = timed(DataIngestor, csv_path, 'dict', '')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'load_seconds': elapsed, 'baseline_kb': baseline, 'peak_kb': peak}))
+
+def main():
+    '''
+    Method used to run the benchmark for the scales 1, 2, 4, ... max_scale.
+    '''
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CSV
+    max_scale = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        scale = 1
+        while scale <= max_scale:
+            path = scaled_csv(csv_path, scale, directory)
+            output = subprocess.run([sys.executable, __file__, '--child', path],
+                                    check=True, capture_output=True, text=True).stdout
+            result = json.loads(output)
+            result.update(scale=scale, file_mb=os.path.getsize(path) / 2 ** 20)
+            results.append(result)
+            os.remove(path)
+            scale *= 2
+
+    print(f"{'scale':>6}{'file MB':>10}{'peak RSS MB':>14}{'delta MB':>11}{'load s':>9}")
+    for result in results:
+        print(f"{result['scale']:>6}{result['file_mb']:>10.1f}"
+              f"{result['peak_kb'] / 1024:>14.1f}"
+              f"{(result['peak_kb'] - result['baseline_kb']) / 1024:>11.1f}"
+              f"{result['load_seconds']:>9.3f}")
+    print(json.dumps(results))
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--child':
+        measure(sys.argv[2])
+    else:
+        main()
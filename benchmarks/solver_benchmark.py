@@ -0,0 +1,113 @@
+'''
+Micro-benchmark measuring how the DataIngestor and the TaskRunner solvers
+grow with the size of the data. For each scale, a synthetic dataset is
+generated with 'generate_dataset.py' and the benchmark measures the time
+needed to build the DataIngestor from it and the mean time of each
+'TaskRunner.*_solve' method, over every question and up to 'states' states
+per question for the commands that receive one.
+
+For each command, the scaling curve is summarized by its exponent: the
+slope of log(time) over log(rows) between the smallest and the largest
+scale, which is about 0 for the lookups in the precomputed indexes and
+about 1 for the solvers that go through all the rows of a question.
+
+Usage: python benchmarks/solver_benchmark.py [scales] [engine] [repeat] [states] [seed]
+where 'scales' is a comma separated list (1,10,100 by default; scale 1 is
+about the size of the subset) and 'engine' is 'dict' or 'columnar'.
+'''
+import os
+import sys
+import json
+import math
+import tempfile
+
+from common import COMMANDS, STATE_COMMANDS, load_app, timed
+from generate_dataset import generate
+
+load_app()
+
+# pylint: disable=wrong-import-position
+from app.data_ingestor import DataIngestor
+from app.task_runner import TaskRunner
+
+def sample_queries(data_ingestor, states):
+    '''
+    Method used to build the queries of each command: every question, with
+    at most 'states' of its states for the commands that receive one.
+    '''
+    result = {}
+    for command in COMMANDS:
+        result[command] = []
+        for question, question_states in data_ingestor.data_by_question.items():
+            if command in STATE_COMMANDS:
+                result[command].extend((question, state)
+                                       for state in sorted(question_states)[:states])
+            else:
+                result[command].append((question, None))
+    return result
+
+def bench_scale(csv_path, engine, repeat, states):
+    '''
+    Method used to measure the load time and the mean time of each solver
+    on the given dataset.
+    '''
+    data_ingestor, load_time = timed(DataIngestor, csv_path, engine, '')
+    task_runner = TaskRunner(None)
+
+    per_command = {}
+    for command, command_queries in sample_queries(data_ingestor, states).items():
+        _, elapsed = timed(lambda c=command, cq=command_queries: [
+            task_runner.solve(c, q, s, data_ingestor) for _ in range(repeat) for (q, s) in cq])
+        per_command[command] = elapsed / (repeat * max(len(command_queries), 1))
+
+    return {'load_seconds': load_time, 'seconds_per_query': per_command}
+
+def exponent(first, last, first_rows, last_rows):
+    '''
+    Method used to get the slope of log(time) over log(rows) between two scales.
+    '''
+    if first <= 0 or last <= 0 or first_rows == last_rows:
+        return None
+    return math.log(last / first) / math.log(last_rows / first_rows)
+
+def main():
+    '''
+    Method used to run the benchmark for every scale and print the results.
+    '''
+    scales = [float(scale) for scale in sys.argv[1].split(',')] if len(sys.argv) > 1 \
+        else [1, 10, 100]
+    engine = sys.argv[2] if len(sys.argv) > 2 else 'dict'
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    states = int(sys.argv[4]) if len(sys.argv) > 4 else 10
+    seed = int(sys.argv[5]) if len(sys.argv) > 5 else 0
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for scale in scales:
+            path = os.path.join(directory, f'scale-{scale:g}.csv')
+            rows = generate(path, scale, seed)
+            result = bench_scale(path, engine, repeat, states)
+            result.update({'scale': scale, 'rows': rows})
+            results.append(result)
+            os.remove(path)
+
+    first, last = results[0], results[-1]
+    curves = {name: exponent(first_time, last_time, first['rows'], last['rows'])
+              for (name, first_time, last_time) in
+              [('load', first['load_seconds'], last['load_seconds'])]
+              + [(command, first['seconds_per_query'][command],
+                  last['seconds_per_query'][command]) for command in COMMANDS]}
+
+    print(f"{'':24}" + ''.join(f"{result['rows']:>14}" for result in results) + f"{'exponent':>10}")
+    print(f"{'load':24}" + ''.join(f"{result['load_seconds']:>13.3f}s" for result in results)
+          + (f"{curves['load']:>10.2f}" if curves['load'] is not None else ''))
+    for command in COMMANDS:
+        print(f"{command:24}"
+              + ''.join(f"{result['seconds_per_query'][command] * 1e6:>12.1f}us"
+                        for result in results)
+              + (f"{curves[command]:>10.2f}" if curves[command] is not None else ''))
+
+    print(json.dumps({'engine': engine, 'seed': seed, 'results': results, 'exponents': curves}))
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,45 @@
+import os
+import csv
+import copy
+import shutil
+import tempfile
+import time
+import threading
 import unittest
+import unittest.mock
 import json
+import asyncio
+import types
+import logging
+import gzip
+try:
+    import numpy as np
+except ImportError:
+    np = None
 from app.data_ingestor import DataIngestor
+from app.snapshot import Snapshot
+from app.result_store import MemoryResultStore, DiskResultStore
+from app.responses import EncodedResult, encode_batch, encoded_response
+from app.query_cache import QueryCache
+from app.job_registry import JobRegistry
+from app.handlers import (jobs_status, num_jobs_status, job_result, submit_query,
+                          submit_batch, profile_status, range_has_data, query_fields,
+                          submit_job, profile_configure)
+from app.retention import ResultCompactor
+from app.scheduler import JobScheduler, QueueFull
+from app.metrics import Counter, Histogram
+from app.profiler import JobProfiler
+from app.asgi import wait_result, get_response, get_batch_response, loading_needed
+from app.reloader import DatasetReloader
+from app.datasets import DatasetRegistry
 from unittests.task_runner import TaskRunner, ThreadPool
+from app.task_runner import TaskRunner as AppTaskRunner, ThreadPool as AppThreadPool, Job, Batch, STOP_TASK
 
 ONLY_LAST = False
 
 class TestWebserver(unittest.TestCase):
     task_runner = TaskRunner(ThreadPool())
+    app_task_runner = AppTaskRunner(ThreadPool())
     data_ingestor = DataIngestor("./unittests/test_table.csv")
     
     def retrieve_info(self, end_point):
@@ -93,6 +126,738 @@ class TestWebserver(unittest.TestCase):
         
         self.assertEqual(result, ref)
         
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_aggregate_index(self):
+        q, _ = self.retrieve_info("states_mean")
+        values = self.data_ingestor.helper(q)
+        for state in values:
+            total, count, mean = self.data_ingestor.aggregates[(q, state)]
+            self.assertEqual(total, sum(values[state]))
+            self.assertEqual(count, len(values[state]))
+            self.assertEqual(mean, total / count)
+
+        means = [mean for (_, mean) in self.data_ingestor.ranking[q]]
+        self.assertEqual(means, sorted(means))
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_states_mean_from_index(self):
+        q, _ = self.retrieve_info("states_mean")
+        result = self.app_task_runner.states_mean_solve(q, self.data_ingestor.ranking)
+        ref = self.retrieve_output("states_mean")
+
+        self.assertEqual(list(result.items()), list(ref.items()))
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_best5_worst5_from_index(self):
+        min_questions = self.data_ingestor.questions_best_is_min
+        max_questions = self.data_ingestor.questions_best_is_max
+        for end_point, solve in (("best5", self.app_task_runner.best5_solve),
+                                 ("worst5", self.app_task_runner.worst5_solve)):
+            q, _ = self.retrieve_info(end_point)
+            result = solve(q, self.data_ingestor.ranking, min_questions, max_questions)
+            self.assertEqual(result, self.retrieve_output(end_point))
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_diff_from_mean_from_index(self):
+        q, _ = self.retrieve_info("diff_from_mean")
+        result = self.app_task_runner.diff_from_mean_solve(q, self.data_ingestor.ranking,
+                                                           self.data_ingestor.global_means)
+        ref = self.retrieve_output("diff_from_mean")
+
+        self.assertEqual(result, ref)
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_question_indexes(self):
+        q, _ = self.retrieve_info("mean_by_category")
+        index = self.data_ingestor.category_cube
+        result = self.app_task_runner.mean_by_category_solve(q, index)
+        self.assertEqual(result, self.retrieve_output("mean_by_category"))
+
+        q, state = self.retrieve_info("state_mean_by_category")
+        result = self.app_task_runner.state_mean_by_category_solve(q, index, state)
+        self.assertEqual(result, self.retrieve_output("state_mean_by_category"))
+
+        self.assertEqual(self.data_ingestor.helper(q),
+                         {s: v for ((question, s), v) in self.data_ingestor.data.items()
+                          if question == q})
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_columnar_engine(self):
+        columnar_ingestor = DataIngestor("./unittests/test_table.csv", engine="columnar")
+        for end_point in ("states_mean", "state_mean", "best5", "worst5", "global_mean",
+                          "diff_from_mean", "state_diff_from_mean", "mean_by_category",
+                          "state_mean_by_category"):
+            q, state = self.retrieve_info(end_point)
+            expected = self.app_task_runner.solve(end_point, q, state, self.data_ingestor)
+            result = self.app_task_runner.solve(end_point, q, state, columnar_ingestor)
+
+            self.assertEqual(sorted(result), sorted(expected))
+            if end_point in ("states_mean", "best5", "worst5"):
+                self.assertEqual(list(result), list(expected))
+            if end_point.endswith("by_category"):
+                result, expected = result.get(state, result), expected.get(state, expected)
+            for key, value in expected.items():
+                self.assertAlmostEqual(result[key], value)
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_snapshot_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            csv_path = os.path.join(cache_dir, "table.csv")
+            shutil.copy("./unittests/test_table.csv", csv_path)
+
+            built = DataIngestor(csv_path, engine="dict", cache_dir=cache_dir)
+            snapshot = Snapshot(csv_path, cache_dir)
+            self.assertIsNotNone(snapshot.load_indexes())
+
+            loaded = DataIngestor(csv_path, engine="dict", cache_dir=cache_dir)
+            for name in DataIngestor.INDEXES:
+                self.assertEqual(getattr(loaded, name), getattr(built, name))
+
+            with open(csv_path, "r", encoding="utf-8") as file:
+                lines = file.readlines()
+            with open(csv_path, "w", encoding="utf-8") as file:
+                file.writelines(lines[:-1])
+
+            self.assertIsNone(Snapshot(csv_path, cache_dir).load_indexes())
+            rebuilt = DataIngestor(csv_path, engine="dict", cache_dir=cache_dir)
+            self.assertNotEqual(rebuilt.data_by_category, built.data_by_category)
+
+            if np is not None:
+                DataIngestor(csv_path, engine="columnar", cache_dir=cache_dir)
+                columns, _ = Snapshot(csv_path, cache_dir).load_columns()
+                self.assertIsInstance(columns["value"], np.memmap)
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_incremental_ingestion(self):
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, "table.csv")
+            with open("./unittests/test_table.csv", "r", encoding="utf-8") as file:
+                lines = file.readlines()
+            with open(csv_path, "w", encoding="utf-8") as file:
+                file.writelines(lines[:10])
+
+            server = types.SimpleNamespace(datasets=DatasetRegistry(AppThreadPool()),
+                                           logger=unittest.mock.Mock())
+            server.datasets.register("default", csv_path)
+            old = server.datasets.get()
+            old_indexes = {name: copy.deepcopy(getattr(old, name))
+                           for name in DataIngestor.INDEXES}
+            reloader = DatasetReloader(server)
+            self.assertIs(reloader.reload()["version"], old.version)
+
+            with open(csv_path, "a", encoding="utf-8") as file:
+                file.writelines(lines[10:])
+                file.write(lines[10][:20])
+
+            summary = reloader.reload()
+            self.assertEqual(summary["rows"], len(lines) - 10)
+            new = server.datasets.get()
+            self.assertEqual(new.version, summary["version"])
+            self.assertNotEqual(new.version, old.version)
+            for name in DataIngestor.INDEXES:
+                self.assertEqual(getattr(old, name), old_indexes[name])
+                self.assertEqual(getattr(new, name), getattr(self.data_ingestor, name))
+
+            with open(csv_path, "w", encoding="utf-8") as file:
+                file.writelines(lines[:5])
+            self.assertEqual(reloader.reload()["mode"], "full")
+            self.assertRaises(ValueError, reloader.reload, "partial")
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_dataset_registry(self):
+        pool = unittest.mock.Mock()
+        registry = DatasetRegistry(pool)
+        for name in ("a", "b", "c"):
+            registry.register(name, "./unittests/test_table.csv")
+        self.assertEqual(registry.stats()["memory_used"], 0)
+
+        first = registry.get("a")
+        self.assertIs(registry.get("a"), first)
+        pool.share.assert_called_once_with(first)
+        size = registry.stats()["datasets"]["a"]["size"]
+        self.assertGreater(size, 0)
+        self.assertRaises(KeyError, registry.get, "d")
+
+        registry.memory_budget = 2 * size
+        registry.get("b")
+        registry.get("a")
+        registry.get("c")
+        datasets = registry.stats()["datasets"]
+        self.assertEqual([name for name in "abc" if datasets[name]["loaded"]], ["a", "c"])
+        pool.forget.assert_called_once()
+        self.assertIsNot(registry.get("b"), first)
+        self.assertEqual([name for (name, _) in registry.loaded_datasets()], ["c", "b"])
+
+        server = types.SimpleNamespace(datasets=registry)
+        self.assertTrue(loading_needed(server, {"question": "q", "dataset": "a"}))
+        self.assertFalse(loading_needed(server, {"question": "q", "dataset": "b"}))
+        self.assertFalse(loading_needed(server, {"question": "q", "dataset": "d"}))
+        self.assertTrue(loading_needed(server, {"dataset": "b",
+                                                "queries": [{"dataset": "a"}, {}]}))
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_year_range(self):
+        end_points = ("states_mean", "state_mean", "best5", "worst5", "global_mean",
+                      "diff_from_mean", "state_diff_from_mean", "mean_by_category",
+                      "state_mean_by_category")
+        for end_point in end_points:
+            q, state = self.retrieve_info(end_point)
+            expected = self.app_task_runner.solve(end_point, q, state, self.data_ingestor)
+            result = self.app_task_runner.solve(end_point, q, state, self.data_ingestor,
+                                                (2011, None))
+            self.assertEqual(list(result), list(expected))
+            if end_point == "state_mean_by_category":
+                result, expected = result[state], expected[state]
+            for key, value in expected.items():
+                self.assertAlmostEqual(result[key], value)
+
+        q, _ = self.retrieve_info("states_mean")
+        with open("./unittests/test_table.csv", "r", encoding="utf-8") as file:
+            rows = [row for row in csv.reader(file)
+                    if row[8] == q and row[1] in ("2020", "2021")]
+        values = {}
+        for row in rows:
+            values.setdefault(row[4], []).append(float(row[11]))
+        result = self.app_task_runner.solve("states_mean", q, None, self.data_ingestor,
+                                            (2020, 2021))
+        self.assertEqual(result, dict(sorted(((state, sum(numbers) / len(numbers))
+                                              for (state, numbers) in values.items()),
+                                             key=lambda x: x[1])))
+        self.assertEqual(self.app_task_runner.solve("states_mean", q, None,
+                                                    self.data_ingestor, (2030, 2031)), {})
+        year_slice = self.data_ingestor.year_slice(q, 2011, None)
+        self.assertEqual(self.app_task_runner.global_mean_solve(q, year_slice.global_means),
+                         self.app_task_runner.global_mean_solve(q, self.data_ingestor.global_means))
+        self.assertIsNone(year_slice.cube)
+        self.assertEqual(year_slice.category_cube, {q: self.data_ingestor.category_cube[q]})
+        self.assertTrue(self.data_ingestor.has_years(q, None, 2011, None))
+        self.assertFalse(self.data_ingestor.has_years(q, None, 2030, 2031))
+        self.assertFalse(self.data_ingestor.has_years(q, "Nowhere", 2011, None))
+        self.assertFalse(self.data_ingestor.has_years("Unknown question", None, None, None))
+        self.assertTrue(range_has_data(self.data_ingestor, "global_mean", q, None, None))
+        self.assertTrue(range_has_data(self.data_ingestor, "global_mean", q, "Nowhere", (2011, None)))
+        self.assertFalse(range_has_data(self.data_ingestor, "state_mean", q, "Nowhere", (2011, None)))
+        self.assertNotEqual(QueryCache.key("states_mean", q, None, 1, (2020, 2021)),
+                            QueryCache.key("states_mean", q, None, 1))
+
+        server = types.SimpleNamespace(tasks_runner=AppThreadPool(),
+                                       datasets={"default": self.data_ingestor},
+                                       logger=logging.getLogger("test"), job_counter=1,
+                                       batch_counter=1, counter_lock=threading.Lock())
+        for command in ("global_mean", "diff_from_mean", "state_mean", "mean_by_category"):
+            self.assertEqual(submit_query(server, {"question": q, "state": "Ohio",
+                                                   "year_from": 2030}, command),
+                             {"status": "error", "reason": "No data in year range"})
+        self.assertEqual(submit_batch(server, {"queries": [
+                             {"endpoint": "states_mean", "question": q, "year_from": 2011},
+                             {"endpoint": "best5", "question": q, "year_to": 1990}]}),
+                         {"status": "error", "reason": "No data in year range at position 1"})
+        self.assertEqual(server.job_counter, 1)
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_category_cube(self):
+        for q, node in self.data_ingestor.category_cube.items():
+            result = self.app_task_runner.mean_by_category_solve(q, self.data_ingestor.category_cube)
+            self.assertEqual(list(result), sorted(result))
+            expected = {str((state, category, category_value)): sum(numbers) / len(numbers)
+                        for ((question, state, category, category_value), numbers)
+                        in self.data_ingestor.data_by_category.items()
+                        if question == q and category != '' and category_value != ''}
+            self.assertEqual(result, expected)
+
+            total, count, states = node
+            self.assertEqual(count, sum(state[1] for state in states.values()))
+            self.assertAlmostEqual(total, sum(state[0] for state in states.values()))
+            for state, (_, state_count, categories) in states.items():
+                self.assertEqual(state_count, sum(values[1] for values in categories.values()))
+                result = self.app_task_runner.state_mean_by_category_solve(
+                    q, self.data_ingestor.category_cube, state)[state]
+                self.assertEqual(list(result), sorted(result))
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_encoded_results(self):
+        q, _ = self.retrieve_info("mean_by_category")
+        result = self.app_task_runner.solve("mean_by_category", q, None, self.data_ingestor)
+        encoded = EncodedResult.encode(result)
+        self.assertEqual(json.loads(encoded.response), {"status": "done", "data": result})
+        self.assertEqual(list(encoded.decode()), list(result))
+
+        store = MemoryResultStore()
+        store.put(1, encoded)
+        store.put(2, None)
+        self.assertIs(store.get_encoded(1), encoded)
+        self.assertEqual(store.get(1), result)
+        batch = encode_batch({"job_id_1": encoded, "job_id_2": store.get_encoded(2)})
+        self.assertEqual(batch.decode(), {"job_id_1": result, "job_id_2": None})
+
+        self.assertEqual(encoded_response(encoded, "gzip"), (encoded.response, {}))
+        with unittest.mock.patch("app.responses.GZIP_MIN_BYTES", 10):
+            body, headers = encoded_response(encoded, "gzip, deflate")
+            self.assertEqual(gzip.decompress(body), encoded.response)
+            self.assertEqual(headers["Content-Encoding"], "gzip")
+            self.assertIs(encoded_response(encoded, "gzip")[0], body)
+            self.assertEqual(encoded_response(encoded, None), (encoded.response, {}))
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_memory_result_store(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            store = MemoryResultStore(max_entries=2, spill_bytes=20, spill_dir=spill_dir)
+            store.put(1, {"a": 1})
+            store.put(2, None)
+            store.get(1)
+            store.put(3, {"large": list(range(10))})
+
+            self.assertEqual(store.get(1), {"a": 1})
+            self.assertEqual(store.get(3), {"large": list(range(10))})
+            self.assertEqual(os.listdir(spill_dir), ["job_id_3.json"])
+            self.assertRaises(KeyError, store.get, 2)
+            self.assertTrue(store.is_evicted(2))
+            self.assertFalse(store.is_evicted(4))
+
+            store.get(1)
+            store.put(4, None)
+            self.assertIn(4, store)
+            self.assertNotIn(3, store)
+            self.assertEqual(os.listdir(spill_dir), [])
+
+        store = MemoryResultStore(max_entries=0)
+        store.put(1, "result")
+        self.assertEqual(store.get(1), "result")
+
+        store = MemoryResultStore(ttl=0.01)
+        store.put(1, "result")
+        time.sleep(0.02)
+        self.assertRaises(KeyError, store.get, 1)
+        self.assertTrue(store.is_evicted(1))
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_result_retention(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "job_id_1.json"), "w") as file:
+                file.write("{}")
+            store = DiskResultStore(directory, max_entries=2, ttl=0.05)
+            self.assertEqual(os.listdir(directory), [])
+            self.assertRaises(KeyError, store.get, 1)
+
+            for job_id in range(1, 4):
+                store.put(job_id, {"a": job_id})
+            self.assertEqual(store.compact(), 1)
+            self.assertEqual(store.removal_reason(1), "evicted")
+            self.assertEqual(store.get(2), {"a": 2})
+            self.assertIn(3, store)
+            time.sleep(0.06)
+            self.assertNotIn(3, store)
+            self.assertIn(3, store.entries)
+            self.assertIsNone(store.removal_reason(3))
+            self.assertRaises(KeyError, store.get, 2)
+            self.assertEqual(store.compact(), 1)
+            self.assertEqual(os.listdir(directory), [])
+            self.assertEqual(store.stats()["removed"], {"expired": 2, "evicted": 1})
+
+        store = MemoryResultStore(ttl=0.05)
+        store.put(1, "result")
+        store.get(1)
+        store.put(2, "result")
+        self.assertIn(1, store)
+        self.assertEqual(list(store.entries), [1, 2])
+        time.sleep(0.06)
+        store.put(3, "result")
+        self.assertEqual(store.compact(), 2)
+        self.assertIn(3, store)
+        self.assertEqual(store.removal_reason(1), "expired")
+
+        pool = AppThreadPool()
+        pool.results = store
+        server = types.SimpleNamespace(tasks_runner=pool)
+        for job_id in range(1, 5):
+            pool.registry.add(job_id, "states_mean")
+        for job_id in range(1, 4):
+            pool.registry.set_status(job_id, "done")
+        batches = {1: [1, 2], 2: [3], 3: [1]}
+        compactor = ResultCompactor(pool, max_finished_jobs=1, batches=batches)
+        self.assertEqual(compactor.compact(), {"results": 0, "jobs": 2, "batches": 1})
+        self.assertEqual(compactor.stats()["pruned_jobs"], 2)
+        self.assertEqual(list(batches), [2, 3])
+        self.assertEqual(pool.registry.count(), 2)
+        self.assertEqual(pool.registry.first_id, 3)
+
+        self.assertEqual(job_result(server, 1)["status"], "expired")
+        server.job_counter = 5
+        start = time.monotonic()
+        response = asyncio.run(get_response(server, "job_id_1", {"timeout": "5"}))
+        self.assertEqual(response["status"], "expired")
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(job_result(server, 3).decode(), "result")
+        self.assertEqual(job_result(server, 4), {"status": "running"})
+        store.removed.clear()
+        self.assertEqual(job_result(server, 2)["status"], "expired")
+
+        class ForgottenOnRead(dict):
+            def __getitem__(self, bid):
+                raise KeyError(bid)
+        server.batches, server.batch_counter = ForgottenOnRead(batches), 4
+        response = asyncio.run(get_batch_response(server, "batch_id_2", {}))
+        self.assertEqual(response.decode(), {"job_id_3": "result"})
+        response = asyncio.run(get_batch_response(server, "batch_id_1", {}))
+        self.assertEqual(response["status"], "expired")
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_query_cache(self):
+        cache = QueryCache(max_entries=1)
+        key = QueryCache.key("states_mean", "question", "Ohio", 1)
+        self.assertEqual(key, QueryCache.key("states_mean", "question", None, 1))
+        self.assertEqual(query_fields({"question": " question ", "state": "Ohio "}),
+                         ("question", "Ohio"))
+        self.assertEqual(query_fields({"question": "question"}), ("question", None))
+        for query in ({"question": 5}, {"question": "question", "state": 7}, {}, []):
+            self.assertRaises(ValueError, query_fields, query)
+        self.assertNotEqual(key, QueryCache.key("states_mean", "question", None, 2))
+
+        self.assertEqual(cache.lookup(key, 1), ("miss", None))
+        self.assertEqual(cache.lookup(key, 2), ("coalesced", None))
+        self.assertEqual(cache.lookup(key, 3), ("coalesced", None))
+        self.assertEqual(cache.complete(key, {"Ohio": 1.0}), [2, 3])
+        self.assertEqual(cache.lookup(key, 4), ("hit", {"Ohio": 1.0}))
+
+        other = QueryCache.key("state_mean", "question", "Ohio", 1)
+        self.assertEqual(cache.lookup(other, 5), ("miss", None))
+        self.assertEqual(cache.fail(other), [])
+        self.assertEqual(cache.lookup(other, 6), ("miss", None))
+        cache.complete(other, {"Ohio": 2.0})
+
+        self.assertEqual(cache.lookup(key, 7), ("miss", None))
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 4, "coalesced": 2,
+                                         "entries": 1, "in_flight": 1})
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_job_registry(self):
+        registry = JobRegistry()
+        for job_id in range(1, 6):
+            registry.add(job_id, "states_mean")
+        registry.set_status(2, "running")
+        registry.set_status(3, "running")
+        registry.set_status(3, "done")
+        registry.set_status(9, "done")
+        self.assertEqual(registry.counts(), {"queued": 3, "running": 1, "done": 1, "failed": 0})
+        self.assertEqual(registry.count("queued", "running"), 4)
+        self.assertEqual([job_id for (job_id, _) in registry.page(after=1, limit=2)], [2, 3])
+        self.assertEqual([job_id for (job_id, _) in registry.page("queued")], [1, 4, 5])
+        with unittest.mock.patch("app.job_registry.SCAN_CHUNK", 2):
+            self.assertEqual([job_id for (job_id, _) in registry.page("queued", 1, 1)], [4])
+            self.assertEqual([job_id for (job_id, _) in registry.page(after=2, limit=5)],
+                             [3, 4, 5])
+        self.assertRaises(ValueError, registry.page, "unknown")
+
+        record = registry.page("done")[0][1]
+        self.assertLessEqual(record.created, record.started)
+        self.assertLessEqual(record.started, record.finished)
+
+        pool = AppThreadPool()
+        server = types.SimpleNamespace(tasks_runner=pool)
+        runner = AppTaskRunner(pool)
+        for job_id in (1, 2):
+            pool.registry.add(job_id, "states_mean")
+        job = Job(1, "states_mean", "failing question", None, self.data_ingestor)
+        pool.query_cache.lookup(job.key(), 1)
+        pool.query_cache.lookup(job.key(), 2)
+        woken = []
+        pool.results.subscribe(2, lambda: woken.append(2))
+        with unittest.mock.patch.object(runner, "solve", side_effect=ValueError), \
+                self.assertLogs("webserver.log"):
+            runner.process(job)
+        self.assertEqual(woken, [2])
+        self.assertEqual(job_result(server, 2), {"status": "error", "reason": "Job failed"})
+        self.assertEqual(jobs_status(server, {"status": "failed"})["jobs"],
+                         [{"job_id_1": "failed"}, {"job_id_2": "failed"}])
+
+        q, _ = self.retrieve_info("states_mean")
+        pool.registry.add(3, "states_mean")
+        runner.process(Job(3, "states_mean", q, None, self.data_ingestor))
+        self.assertIn(3, pool.results)
+        response = jobs_status(server, {"limit": "2", "after": "job_id_1", "details": "true"})
+        self.assertEqual(response["next"], "job_id_3")
+        self.assertEqual(response["total"], 3)
+        self.assertEqual([job["job_id"] for job in response["jobs"]], ["job_id_2", "job_id_3"])
+        self.assertEqual(response["jobs"][1]["status"], "done")
+        self.assertEqual(jobs_status(server, {"limit": "0"})["status"], "error")
+        self.assertEqual(num_jobs_status(server), {"status": "running", "num_jobs": 0})
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_result_store_wait(self):
+        store = MemoryResultStore()
+        self.assertFalse(store.wait(1, 0.01))
+
+        timer = threading.Timer(0.05, store.put, (1, {"Ohio": 1.0}))
+        timer.start()
+        self.assertTrue(store.wait(1, 5))
+        self.assertEqual(store.get(1), {"Ohio": 1.0})
+        self.assertTrue(store.wait(1, 0))
+        self.assertEqual(store.waiters, {})
+        timer.join()
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_result_store_subscribe(self):
+        store = MemoryResultStore()
+        calls = []
+        store.subscribe(1, lambda: calls.append(1))
+        store.subscribe(2, lambda: calls.append(2))
+        store.unsubscribe(2, store.waiters[2][0])
+        store.put(1, None)
+        store.put(2, None)
+        self.assertEqual(calls, [1])
+        self.assertEqual(store.waiters, {})
+
+        store.subscribe(1, lambda: calls.append(3))
+        self.assertEqual(calls, [1, 3])
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_asgi_wait_result(self):
+        store = MemoryResultStore()
+        server = types.SimpleNamespace(tasks_runner=types.SimpleNamespace(results=store))
+
+        async def wait_all():
+            waiters = [asyncio.ensure_future(wait_result(server, 1, 5)) for _ in range(100)]
+            await asyncio.sleep(0.01)
+            threading.Thread(target=store.put, args=(1, {"Ohio": 1.0})).start()
+            await asyncio.gather(*waiters)
+            await wait_result(server, 2, 0.01)
+
+        asyncio.run(wait_all())
+        self.assertEqual(store.get(1), {"Ohio": 1.0})
+        self.assertEqual(store.waiters, {})
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_batch_groups_by_question(self):
+        jobs = [Job(i, "states_mean", q, None, self.data_ingestor)
+                for (i, q) in enumerate(["b", "a", "b", "a"])]
+        batch = Batch(1, jobs)
+
+        self.assertEqual([job.question for job in batch.jobs()], ["a", "a", "b", "b"])
+        self.assertEqual([job.job_id for job in batch.jobs()], [1, 3, 0, 2])
+        self.assertEqual(jobs[0].jobs(), [jobs[0]])
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_job_scheduler(self):
+        scheduler = JobScheduler()
+        heavy = [Job(i, "mean_by_category", "q", None, self.data_ingestor, "export")
+                 for i in range(10)]
+        for job in heavy:
+            scheduler.put(job)
+        scheduler.put(STOP_TASK, stop=True)
+        scheduler.put(Job(10, "state_mean", "q", "Ohio", self.data_ingestor, "a"))
+        scheduler.put(Job(11, "state_mean", "q", "Ohio", self.data_ingestor, "a"))
+        scheduler.put(Job(12, "state_mean", "q", "Ohio", self.data_ingestor, "b"))
+        self.assertEqual(scheduler.qsize(), 13)
+        self.assertEqual(len(scheduler.tasks()), 13)
+
+        order = [scheduler.get().job_id for _ in range(13)]
+        self.assertEqual(order[:4], [10, 0, 12, 11])
+        self.assertEqual(sorted(order), list(range(13)))
+        self.assertIs(scheduler.get(), STOP_TASK)
+        self.assertTrue(scheduler.empty())
+
+        stats = scheduler.stats()
+        self.assertEqual(stats["classes"]["interactive"]["processed"], 3)
+        self.assertEqual(stats["classes"]["bulk"]["processed"], 10)
+        scheduler.observe("state_mean", 1.0)
+        self.assertGreater(scheduler.stats()["costs"]["state_mean"], 0.05)
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_threadpool_stop_after_tasks(self):
+        with unittest.mock.patch.dict(os.environ, {"TP_NUM_OF_THREADS": "2"}):
+            pool = AppThreadPool()
+        for i in range(5):
+            pool.jobs_queue.put(Job(i, "mean_by_category", "q", None, self.data_ingestor,
+                                    "client"))
+            pool.jobs_queue.put(Job(i + 5, "state_mean", "q", "Ohio", self.data_ingestor,
+                                    "client"))
+        pool.stop()
+
+        order = [pool.jobs_queue.get() for _ in range(12)]
+        self.assertEqual(sorted(task.job_id for task in order[:10]), list(range(10)))
+        self.assertEqual(order[10:], [STOP_TASK, STOP_TASK])
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_job_scheduler_admission(self):
+        scheduler = JobScheduler(max_size=4, high_watermark=0.5)
+        heavy = Job(0, "mean_by_category", "q", None, self.data_ingestor)
+        light = Job(1, "state_mean", "q", "Ohio", self.data_ingestor)
+
+        for _ in range(2):
+            scheduler.admit(heavy)
+            scheduler.put(heavy)
+        with self.assertRaises(QueueFull) as context:
+            scheduler.admit(heavy)
+        self.assertEqual(context.exception.priority_class, "bulk")
+        self.assertEqual(context.exception.retry_after, 60)
+
+        for _ in range(2):
+            scheduler.admit(light)
+            scheduler.put(light)
+        self.assertRaises(QueueFull, scheduler.admit, light)
+
+        for _ in range(4):
+            scheduler.get()
+        scheduler.admit(heavy)
+        scheduler.put(heavy)
+        scheduler.put(heavy)
+        scheduler.put(light)
+        scheduler.put(light)
+        with self.assertRaises(QueueFull) as context:
+            scheduler.admit(light)
+        self.assertEqual(context.exception.retry_after, 3)
+        self.assertEqual(scheduler.stats()["classes"]["bulk"]["rejected"], 1)
+        self.assertEqual(scheduler.stats()["classes"]["interactive"]["rejected"], 2)
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_admission_after_query_cache(self):
+        pool = AppThreadPool()
+        pool.jobs_queue = JobScheduler(max_size=1)
+        server = types.SimpleNamespace(tasks_runner=pool, datasets={"default": self.data_ingestor},
+                                       logger=logging.getLogger("test"), job_counter=1,
+                                       batch_counter=1, counter_lock=threading.Lock(), batches={})
+        q, _ = self.retrieve_info("states_mean")
+
+        self.assertEqual(submit_query(server, {"question": q}, "states_mean"),
+                         {"job_id": "job_id_1"})
+        self.assertEqual(submit_query(server, {"question": q}, "states_mean"),
+                         {"job_id": "job_id_2"})
+        jobs, num_jobs = jobs_status(server), num_jobs_status(server)
+        self.assertRaises(QueueFull, submit_query, server, {"question": "other"}, "states_mean")
+        self.assertRaises(QueueFull, submit_batch, server, {"queries": [
+            {"endpoint": "states_mean", "question": q},
+            {"endpoint": "best5", "question": q},
+            {"endpoint": "best5", "question": q}]})
+        self.assertEqual(jobs_status(server), jobs)
+        self.assertEqual(num_jobs_status(server), num_jobs)
+        self.assertIsNone(pool.registry.status(3))
+        self.assertEqual(pool.query_cache.stats()["in_flight"], 1)
+
+        job = pool.jobs_queue.get()
+        self.assertEqual(pool.query_cache.complete(job.key(), EncodedResult.encode({})), [2])
+        pool.jobs_queue.put(job)
+        self.assertEqual(submit_query(server, {"question": q}, "states_mean"),
+                         {"job_id": "job_id_7"})
+        self.assertEqual(pool.registry.status(7), "done")
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_query_normalization(self):
+        pool = AppThreadPool()
+        server = types.SimpleNamespace(tasks_runner=pool, datasets={"default": self.data_ingestor},
+                                       logger=logging.getLogger("test"), job_counter=1,
+                                       batch_counter=1, counter_lock=threading.Lock())
+        q, _ = self.retrieve_info("states_mean")
+
+        self.assertEqual(submit_query(server, {"question": " " + q + " "}, "states_mean"),
+                         {"job_id": "job_id_1"})
+        self.assertEqual(submit_query(server, {"question": q}, "states_mean"),
+                         {"job_id": "job_id_2"})
+        self.assertEqual(pool.query_cache.stats()["coalesced"], 1)
+        job = pool.jobs_queue.get()
+        self.assertEqual((job.question, job.state), (q, None))
+        self.assertEqual(self.app_task_runner.solve(job.command, job.question, job.state,
+                                                    job.data_ingestor),
+                         self.app_task_runner.solve("states_mean", q, None, self.data_ingestor))
+
+        self.assertEqual(submit_query(server, {"question": 5}, "states_mean"),
+                         {"status": "error", "reason": "Invalid query"})
+        self.assertEqual(submit_query(server, {"question": q, "state": 7}, "state_mean"),
+                         {"status": "error", "reason": "Invalid query"})
+        self.assertEqual(submit_batch(server, {"queries": [
+                             {"endpoint": "states_mean", "question": q},
+                             {"endpoint": "state_mean", "question": q, "state": ["Ohio"]}]}),
+                         {"status": "error", "reason": "Invalid query at position 1"})
+        self.assertEqual(server.job_counter, 3)
+        self.assertEqual(pool.registry.count(), 2)
+
+        self.assertRaises(AttributeError, submit_job, server,
+                          Job(3, "states_mean", q, None, None))
+        self.assertEqual(pool.registry.count(), 2)
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_metrics_format(self):
+        counter = Counter("requests_total", "Requests.", ("command",))
+        counter.inc("best5")
+        counter.inc("best5", amount=2)
+        self.assertEqual(counter.render(), ["# HELP requests_total Requests.",
+                                            "# TYPE requests_total counter",
+                                            'requests_total{command="best5"} 3'])
+
+        histogram = Histogram("wait_seconds", "Wait.", ("command",), buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value, "best5")
+        self.assertEqual(histogram.render()[2:], [
+            'wait_seconds_bucket{command="best5",le="0.1"} 2',
+            'wait_seconds_bucket{command="best5",le="1.0"} 3',
+            'wait_seconds_bucket{command="best5",le="+Inf"} 4',
+            'wait_seconds_count{command="best5"} 4',
+            'wait_seconds_sum{command="best5"} 2.65'])
+        self.assertIn("indexes", self.data_ingestor.timings)
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_job_profiler(self):
+        profiler = JobProfiler()
+        q, _ = self.retrieve_info("mean_by_category")
+        job = Job(1, "mean_by_category", q, None, self.data_ingestor)
+        debug_job = Job(2, "mean_by_category", q, None, self.data_ingestor, debug=True)
+        args = ("mean_by_category", q, None, self.data_ingestor)
+
+        profiler.run(debug_job, self.app_task_runner.solve, *args)
+        self.assertEqual(profiler.report()["commands"], {})
+
+        profiler.configure(enabled=True)
+        result = profiler.run(debug_job, self.app_task_runner.solve, *args)
+        self.assertEqual(result, self.app_task_runner.solve(*args))
+        profiler.run(job, self.app_task_runner.solve, *args)
+        profiler.configure(sample_rate=1.0)
+        profiler.run(job, self.app_task_runner.solve, *args)
+
+        report = profiler.report(limit=5)["commands"]["mean_by_category"]
+        self.assertEqual(report["jobs"], 2)
+        self.assertEqual(len(report["functions"]), 5)
+        self.assertTrue(any("mean_by_category_solve" in function["function"]
+                            for function in report["functions"]))
+        self.assertRaises(ValueError, profiler.configure, sample_rate=2)
+
+        profiler.directory = tempfile.mkdtemp()
+        try:
+            self.assertEqual(profiler.dump(),
+                             [os.path.join(profiler.directory, "mean_by_category.prof")])
+        finally:
+            shutil.rmtree(profiler.directory)
+        profiler.configure(reset=True)
+        self.assertEqual(profiler.report()["commands"], {})
+
+        server = types.SimpleNamespace(tasks_runner=types.SimpleNamespace(profiler=profiler))
+        self.assertEqual(profile_status(server, {"limit": "abc"}),
+                         {"status": "error", "reason": "Invalid limit"})
+        self.assertEqual(profile_status(server, {"limit": "-1"})["status"], "error")
+        self.assertEqual(profile_status(server, {"limit": "3"})["commands"], {})
+        for settings in ({"sample_rate": None}, {"sample_rate": [0.5]}, {"sample_rate": "0.5"},
+                         {"sample_rate": True}, {"enabled": "false"}, {"enabled": 0}):
+            self.assertEqual(profile_configure(server, settings),
+                             {"status": "error", "reason": "Invalid profiler settings"})
+        self.assertEqual(profile_configure(server, {"sample_rate": 2})["status"], "error")
+        self.assertEqual(profile_configure(server, {"enabled": False, "sample_rate": 0}),
+                         {"status": "ok", "enabled": False, "sample_rate": 0.0})
+
+    @unittest.skipIf(ONLY_LAST, "Checking only the last added test")
+    def test_process_executor(self):
+        with unittest.mock.patch.dict(os.environ, {"TP_EXECUTOR": "process",
+                                                   "TP_NUM_OF_THREADS": "2"}):
+            pool = AppThreadPool()
+        pool.share(self.data_ingestor)
+        try:
+            for end_point in ("states_mean", "state_mean_by_category"):
+                q, state = self.retrieve_info(end_point)
+                job = Job(1, end_point, q, state, self.data_ingestor)
+                self.assertEqual(pool.solve_in_process(job),
+                                 self.app_task_runner.solve(end_point, q, state,
+                                                            self.data_ingestor))
+        finally:
+            pool.process_pool.shutdown()
+
 if __name__ == '__main__':
     try:
         unittest.main()